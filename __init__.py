@@ -36,14 +36,42 @@
 import sys
 import os
 import time
+import subprocess
+import shutil
+import hashlib
+import re
+import sqlite3
+import tracemalloc
+import tempfile
+import numpy as np
+import signal
+import queue
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from glob import glob
 
 # pymol.Qt is a wrapper which provides the PySide2/Qt5/Qt4 interface
 # if it has been installed in python before !
-from pymol.Qt import QtWidgets, QtCore
-from pymol import cmd
-from glob import glob
-from pymol.cgo import *
-from pymol.vfont import plain
+try:
+    from pymol.Qt import QtWidgets, QtCore
+    from pymol import cmd
+    from pymol.cgo import *
+    from pymol.vfont import plain
+except ImportError: # python __init__.py spec.txt runs job specs without PyMol, the dialog classes are defined but not usable
+    cmd = None
+
+    class QtCore:
+        QAbstractTableModel = object
+        QModelIndex = object
+
+        class Qt:
+            DisplayRole = None
+            AscendingOrder = None
+
+    class QtWidgets:
+        QDialog = object
 
 __version__ = "0.9.8.0"
 
@@ -53,6 +81,9 @@ def __init_plugin__(app=None):
     '''
     from pymol.plugins import addmenuitemqt
     addmenuitemqt('Smina', run_plugin_gui)
+    cmd.extend('smina_benchmark_parser', benchmark_pdbqt_parser)
+    cmd.extend('smina_run', run_job_spec)
+    cmd.extend('smina_find_pockets', find_pocket_boxes)
 
 
 # global reference to avoid garbage collection of our dialog
@@ -107,6 +138,11 @@ class Smina:
         self.form.doubleSpinBox_5.setMaximum(0)
         self.form.doubleSpinBox_5.setMinimum(-1000000)
         self.form.doubleSpinBox_5.setSingleStep(1)
+        self.form.spinBox_10.setMinimum(1)
+        self.form.spinBox_10.setMaximum(os.cpu_count() or 1)
+        self.form.spinBox_11.setMinimum(1)
+        self.form.spinBox_11.setMaximum(50)
+        self.form.spinBox_12.setMaximum(20)
 
         # make Buttongroups
         self.Buttongroup_1 = QtWidgets.QButtonGroup()
@@ -125,11 +161,15 @@ class Smina:
         self.form.doubleSpinBox_4.setValue(7.00)
         self.current_ligands = []
         self.loaded_poses_list = []
+        self.pose_outfiles = {} # pose -> docked file of the poses loaded from the All Results tab
         self.firstrun = True
         self.form.spinBox.setValue(8) # exhaustiveness
         self.form.spinBox_2.setValue(9) # maxposes
         self.form.spinBox_3.setValue(4) # autobox_buf
         self.form.doubleSpinBox_5.setValue(0) # seed
+        self.form.spinBox_10.setValue(1) # parallel jobs
+        self.form.spinBox_11.setValue(1) # ligands per smina process
+        self.form.spinBox_12.setValue(4) # box padding
         self.scoring_table_file = ""
         vinascr = [[-0.035579,'gauss(o=0,_w=0.5,_c=8)'],[-0.005156,'gauss(o=3,_w=2,_c=8)'],\
                     [0.840245,'repulsion(o=0,_c=8)'],[-0.035069,'hydrophobic(g=0.5,_b=1.5,_c=8)'],\
@@ -137,6 +177,35 @@ class Smina:
         approx_methods_list = ['linear', 'spline', 'exact']        
         self.scoring_list = vinascr
         self.current_poses_list = []
+        self.scheduler = None # runs smina in the background
+        self.collect_job = None
+        self.finish_jobs = None
+        self.feed_jobs = None
+        self.current_libraries = {} # multi-molecule files of the multirun list
+        self.results_store = None
+        self.results_model = None # All Results tab
+        self.rescoring_list = [] # scoring table the results are rescored with
+        self.max_result_tabs = 50 # larger multiruns are only listed in the All Results tab
+        self.large_run = False
+        self.skipped_jobs = 0
+        self.conversion_failures = []
+        self.ensemble = [] # receptor objects each ligand is docked against, empty : the selected structure only
+        self.record_users = {} # library record -> its dockings not collected yet
+        self.top_docked = TopK(0) # docked files kept loaded in the top K mode
+        self.docked_objects = {} # docked file -> its objects in pymol
+        self.leaderboard = Leaderboard(0) # best ligands of the current run, Top Ligands tab
+        self.promoted = set() # poses of the leaderboard sent to post-refinement
+        self.funnel_stage = False # the cheap first stage of a funnel screen is running
+        self.funnel_hits = None # ligands of a multirun docked by the second stage
+        self.replica_runs = {} # (receptor, ligand) -> [replicas launched, outfiles of the collected ones]
+        self.job_timer = QtCore.QTimer()
+        self.box_timer = QtCore.QTimer() # one box redraw for a burst of spin box changes
+        self.box_timer.setSingleShot(True)
+        self.receptor_cache = ReceptorCache(os.path.join(tmp_dir,'receptor_cache'))
+        self.receptor_keys = {} # receptor.pdbqt -> cache key of its current content
+        self.ligand_index = LigandIndex(os.path.join(tmp_dir,'ligand_index.db'))
+        self.cost_model = JobCostModel() # calibrated again on the timings of the working directory for each docking run
+        self.ligand_names = None # names shown in the ligand combo box
         #-----------------------------------------------------------
 
         # Config page
@@ -153,7 +222,8 @@ class Smina:
         the latest stable version of Openbabel at :<br> <a href="https://github.com/openbabel/openbabel/releases">
         github.com/openbabel/openbabel/releases</a>
         and smina.static at : <a href="https://sourceforge.net/projects/smina/files/">
-        sourceforge.net/projects/smina/files/</a>.
+        sourceforge.net/projects/smina/files/</a>.<br>
+        Under linux, select 'native' in 'Run smina with' : smina is then started directly, without wsl.
         </body></html>
         """
 
@@ -209,6 +279,12 @@ class Smina:
             self.scoring_table_dir_path = dirname
             self.config_settings['scoring_table_dir_path'] = dirname
 
+        def set_executor(name): # wsl : smina.static in the linux subsystem, native : smina started directly
+            if name not in executors:
+                name = SminaPipeline.defaults['executor']
+            self.form.comboBox_9.setCurrentText(name)
+            self.config_settings['executor'] = name
+
         def read_plugin_config_file():
             config_file_name = os.path.join(tmp_dir,"smina_plugin.conf")
             self.config_settings = {}
@@ -216,6 +292,7 @@ class Smina:
             self.config_settings['openbabel_exe'] = ''
             self.config_settings['ligand_dir_path'] = ''
             self.config_settings['scoring_table_dir_path'] = ''
+            self.config_settings['executor'] = SminaPipeline.defaults['executor']
             if os.path.isfile(config_file_name):
                 set_statusline('Reading configuration file: %s' % config_file_name)
                 with open(config_file_name,'r') as f:
@@ -228,6 +305,7 @@ class Smina:
                     set_openbabel_location(self.config_settings['openbabel_exe'])
                     set_ligand_dir_path(self.config_settings['ligand_dir_path'])
                     set_scoring_table_dir_path(self.config_settings['scoring_table_dir_path'])
+                    set_executor(self.config_settings['executor'])
             else:
                 set_statusline('ERROR : Plugin configuration file not found')
             return self.config_settings
@@ -241,6 +319,7 @@ class Smina:
                 self.config_settings['openbabel_exe'] = self.openbabel_location.text()
                 self.config_settings['ligand_dir_path'] = self.ligand_dir_location.text()
                 self.config_settings['scoring_table_dir_path'] = self.scoring_table_dir_location.text()
+                self.config_settings['executor'] = self.form.comboBox_9.currentText()
                 for key, val in self.config_settings.items():
                     print(key, '=', val, file=fp)
             set_statusline('Wrote smina-plugin configuration file %s' % config_file_name)
@@ -248,7 +327,9 @@ class Smina:
         # Run page buildup
         self.form.textBrowser.setHtml(install_text)
         self.form.textBrowser.setOpenExternalLinks(True)
+        self.form.comboBox_9.addItems(list(executors))
         self.config_settings = read_plugin_config_file()
+        set_executor(self.config_settings['executor'])
         
         # Box page
 
@@ -259,7 +340,10 @@ class Smina:
         The box can be centered around a selection of a residue imported from Pymol or entered manually
         in the coordinate input spaces.<br> * Existing parameter files for selected receptor objects are
         loaded automatically.<br> * An existing parameter file may also be loaded from eleswhere using
-        'Load config file'.<br>Don't forget to write the current parameter file in the current directory
+        'Load config file'.<br> * 'Fit box' centers and sizes the box around the selection (residues, an object
+        like a ligand or any PyMol selection) plus the padding. 'Fit sites' writes one 'receptor'_siteN_config.txt
+        for each site of the selection, the sites separated by ';'. 'Find pockets' writes the boxes of the largest
+        cavities of the receptor, 'receptor'_pocketN_config.txt.<br>Don't forget to write the current parameter file in the current directory
         with 'Write config file' beforre procceding. </body></html>
         """
 
@@ -307,18 +391,79 @@ class Smina:
                 cmd.delete("box_center")
                 Boxcenter_on_selection()
                 
-        def Boxcenter_on_selection():            
-            res_center = self.form.lineEdit_5.text()
-            res_i = res_center.strip('ACEGHILMNOPRSTUVY')
-            cmd.select("sele",("resi "+res_i))
-            cmd.create("box_center","sele")
-            cmd.delete("sele")
-            myspace ={'lst': []}
-            cmd.iterate_state(0,"box_center", "lst.append((x,y,z))", space=myspace)
-            self.form.doubleSpinBox.setValue(float(myspace["lst"][1][0]))
-            self.form.doubleSpinBox_2.setValue(float(myspace["lst"][1][1]))
-            self.form.doubleSpinBox_3.setValue(float(myspace["lst"][1][2]))
-            cmd.delete("box_center")
+        def box_selection_coords(site): # atom coordinates of residues like ARG12,TYR7, of an object or of a selection
+            site = site.strip()
+            if site in cmd.get_names("all"):
+                selection = site
+            else:
+                selection = residue_selection(site) or site
+            try:
+                coords = cmd.get_coords(selection, 0)
+            except Exception: # not a valid selection
+                coords = None
+            if coords is None or len(coords) == 0:
+                set_statusline("ERROR : no atoms in %s" % site)
+                return None
+            return coords
+
+        def set_Box(center, size=None):
+            self.form.doubleSpinBox.setValue(center[0])
+            self.form.doubleSpinBox_2.setValue(center[1])
+            self.form.doubleSpinBox_3.setValue(center[2])
+            if size is not None:
+                self.form.spinBox_4.setValue(size[0])
+                self.form.spinBox_5.setValue(size[1])
+                self.form.spinBox_6.setValue(size[2])
+
+        def Boxcenter_on_selection(): # centroid of the selected atoms
+            coords = box_selection_coords(self.form.lineEdit_5.text().split(";")[0])
+            if coords is not None:
+                set_Box(np.asarray(coords).mean(axis=0).tolist())
+
+        def fit_Box_selection():
+            coords = box_selection_coords(self.form.lineEdit_5.text().split(";")[0])
+            if coords is not None:
+                set_Box(*fit_box(coords, self.form.spinBox_12.value()))
+
+        def fit_Box_sites(): # one box and config file per site, for docking several sites of the receptor
+            prot = self.form.comboBox_3.currentText()
+            if prot == "":
+                set_statusline("No structure selected")
+                return
+            sites = [site for site in self.form.lineEdit_5.text().split(";") if site.strip() != ""]
+            for name in cmd.get_names("objects"):
+                if name.startswith("box_site"):
+                    cmd.delete(name)
+            written = 0
+            for i, site in enumerate(sites):
+                coords = box_selection_coords(site)
+                if coords is None:
+                    continue
+                center, size = fit_box(coords, self.form.spinBox_12.value())
+                display_Box([[c-l/2., c+l/2.] for c, l in zip(center, size)], "box_site%s" % (i+1))
+                write_box_config(prot+"_site%s_config.txt" % (i+1), center, size)
+                written = written+1
+            if written > 0:
+                set_statusline('Wrote %s site configuration files %s_siteN_config.txt' % (written, prot))
+
+        def find_receptor_pockets(): # boxes of the largest cavities of the receptor
+            prot = self.form.comboBox_3.currentText()
+            if prot == "":
+                set_statusline("No structure selected")
+                return
+            for name in cmd.get_names("objects"):
+                if name.startswith("box_pocket"):
+                    cmd.delete(name)
+            pockets = find_pocket_boxes(prot, padding=self.form.spinBox_12.value()).get(prot, [])
+            for i, (center, size, volume) in enumerate(pockets):
+                display_Box([[c-l/2., c+l/2.] for c, l in zip(center, size)], "box_pocket%s" % (i+1))
+            if pockets == []:
+                set_statusline("No pocket found in %s" % prot)
+            else:
+                set_statusline("Wrote %s pocket configuration files %s_pocketN_config.txt, the largest first" % (len(pockets), prot))
+
+        def schedule_Box(): # the box is redrawn once the spin boxes stopped changing
+            self.box_timer.start(100)
 
         def set_Receptor():
             prot = self.form.comboBox_3.currentText()
@@ -394,9 +539,8 @@ class Smina:
             cmd.delete('box')
             display_Box(box_coords)
 
-        def display_Box(box):
+        def display_Box(box, name="box"):
             view = cmd.get_view()
-            name = "box"
             obj = []
             # build cgo object
             color = [1.,1.,1.]
@@ -460,15 +604,9 @@ class Smina:
                 set_statusline("No structure selected")
             else:
                 smina_config_file_name = prot+"_config.txt" 
-                with open(smina_config_file_name,'w') as fp:
-                    self.smina_config['center_x'] = self.form.doubleSpinBox.value()
-                    self.smina_config['center_y'] = self.form.doubleSpinBox_2.value()
-                    self.smina_config['center_z'] = self.form.doubleSpinBox_3.value()
-                    self.smina_config['size_x'] = self.form.spinBox_4.value()
-                    self.smina_config['size_y'] = self.form.spinBox_5.value()
-                    self.smina_config['size_z'] = self.form.spinBox_6.value()
-                    for key, val in self.smina_config.items():
-                        print(key, '=', val, file=fp)
+                self.smina_config = write_box_config(smina_config_file_name,
+                    [self.form.doubleSpinBox.value(), self.form.doubleSpinBox_2.value(), self.form.doubleSpinBox_3.value()],
+                    [self.form.spinBox_4.value(), self.form.spinBox_5.value(), self.form.spinBox_6.value()])
                 set_statusline('Wrote smina configuration file %s' % smina_config_file_name)
 
         # Run page buildup
@@ -481,8 +619,9 @@ class Smina:
         <html><body> * Objects already loaded in PyMol are imported in the smina-plugin when opening it.<br>
          * You may import other receptors from Pymol by using 'Import object'.<br>
          * The selected receptor in the receptor Window will be used in all other plugin pages.<br>
-         * If no 'receptor'.pdbqt file of the 'receptor' is present in the working directory, it will be automatically
-        created with openbabel.<br> * If no flexible residues are entered, 'Rigid Sidechains' are selected for docking.<br>
+         * The 'receptor'.pdbqt file of the 'receptor' is automatically created with openbabel in the working directory.
+        It is only created again when the structure, the charge model or the pH changed : prepared receptors are
+        kept in a cache.<br> * If no flexible residues are entered, 'Rigid Sidechains' are selected for docking.<br>
          * To use 'Flexible sidechains' for docking, select flexible residues of the receptor in PyMol and import them
          in the flexible residues window. You can still delete residues in the window.<br> * Actually only
         'gasteiger' charges are supported in the .pdbqt file, but you might select a pH for the protonation state
@@ -571,9 +710,14 @@ class Smina:
 
         ligand_text = """
         <html><body> * Ligands are loaded from and are saved into the Ligand directory.<br>
+         * 'Add library' puts a multi-molecule .sdf or .pdbqt file on the multirun list. Its molecules are read and
+        docked a few at a time, without splitting the whole file first.<br>
          * If ligands are selected in .pdb format and their file in .pdbqt format is missing, the latter
-        is automatically generated in the Ligand directory : either before docking or when adding them to the
-        multirun list.<br> * When the multirun list is checked, ligands of the list are consecutively docked to the
+        is automatically generated in the Ligand directory before docking. Missing files of the multirun list are
+        converted together by a few openbabel processes ; 'Add all' adds every ligand of the selected type.<br>
+         * The files of the Ligand directory are indexed in ligand_index.db of the plugin directory, only new or changed files
+        are read again. 'Add matching' adds the ligands of the Query box : name pattern (* as wildcard), most heavy atoms and
+        rotatable bonds (any when unset) and an existing .pdbqt file.<br> * When the multirun list is checked, ligands of the list are consecutively docked to the
         receptor in the selected docking configuration (rigid or flexible SC).<br>
          * Ligands have no more limits in torsion angles like it was in vina.
         </body></html>
@@ -583,27 +727,27 @@ class Smina:
             File_type_list = ['pdbqt','pdb','sdf']
             self.form.comboBox_4.addItems(File_type_list)            
 
-        def import_ligands():
+        def ligand_directory(): # rescans the ligand directory for new, changed or removed files, None if it does not exist
+            directory = self.ligand_dir_path or "."
+            if not os.path.isdir(directory):
+                return None
+            self.ligand_index.scan(directory)
+            return directory
+
+        def import_ligands(): # ligands of the selected type, the combo box is filled again only when they changed
+            directory = ligand_directory()
+            ligand_list = []
+            if directory is not None:
+                ligand_list = self.ligand_index.names(directory, file_type=self.form.comboBox_4.currentText())
+            if ligand_list == self.ligand_names:
+                return
+            self.ligand_names = ligand_list
             self.form.comboBox_2.clear()
-            ligand_list =[]
-            list_raw = glob(os.path.join(self.ligand_dir_path,"*."+self.form.comboBox_4.currentText()))
-            for item in list_raw:
-                ligand_name_raw = item.split("\\")[-1]
-                ligand_name = ligand_name_raw.split(".")[0]
-                ligand_list.append(ligand_name) 
             self.form.comboBox_2.addItems(ligand_list)
 
         def make_ligand_pdbqt(ligand):
-            charge_model = self.form.comboBox_5.currentText()
-            ligand_pdbqt = ligand.split(".")[0]+".pdbqt"
             print("Running openbable to create ligand.pdbqt :")
-            command = 'call "%s" %s -O %s --partialcharge %s' % (self.openbabel_exe, ligand, ligand_pdbqt, charge_model)
-            if self.form.groupBox_17.isChecked() == True:
-                command = command+' -p %s' % (float(self.form.doubleSpinBox_4.value()))
-            else :
-                command = command+' -h'
-            print(command)
-            os.system(command)
+            ligand_pdbqt = current_pipeline().convert_ligand(ligand)
             if os.path.isfile(ligand_pdbqt):
                 set_statusline("Created %s" % ligand_pdbqt)
             else :
@@ -612,6 +756,7 @@ class Smina:
         def clear_multirun_list():
             self.form.listWidget_2.clear()
             self.current_ligands = []
+            self.current_libraries = {}
 
         def delete_ligands_from_list():
             sel = self.form.listWidget_2.selectedItems()
@@ -619,17 +764,61 @@ class Smina:
             for item in sel:
                 del_lig = self.form.listWidget_2.currentItem().text()
                 self.current_ligands.remove(del_lig)
+                self.current_libraries.pop(del_lig, None)
                 print("deleted: "+del_lig)
                 self.form.listWidget_2.takeItem(self.form.listWidget_2.row(item))            
 
-        def make_multirun_list():
+        def make_multirun_list(): # missing .pdbqt files are created in one batch before docking
             self.form.groupBox_14.setChecked(True)
-            ligand = self.ligand_dir_path+self.form.comboBox_2.currentText()+"."+self.form.comboBox_4.currentText()
-            if not (os.path.isfile(ligand.split(".")[0]+".pdbqt") or self.form.comboBox_4.currentText() == "pdbqt"):
-                make_ligand_pdbqt(ligand)
             self.form.listWidget_2.addItem(self.form.comboBox_2.currentText())
             self.current_ligands.append(self.form.comboBox_2.currentText())
 
+        def add_all_ligands(): # adds every ligand of the selected type to the multirun list
+            self.form.groupBox_14.setChecked(True)
+            for i in range(self.form.comboBox_2.count()):
+                ligand_name = self.form.comboBox_2.itemText(i)
+                if ligand_name not in self.current_ligands:
+                    self.form.listWidget_2.addItem(ligand_name)
+                    self.current_ligands.append(ligand_name)
+
+        def add_matching_ligands(): # adds the indexed ligands matching the Query box to the multirun list
+            directory = ligand_directory()
+            if directory is None:
+                set_statusline("ERROR : Ligand directory %s not found" % self.ligand_dir_path)
+                return
+            max_rotatable_bonds = self.form.spinBox_20.value()
+            names = self.ligand_index.names(directory, name=self.form.lineEdit_11.text().strip(),
+                max_heavy_atoms=self.form.spinBox_19.value() or None,
+                max_rotatable_bonds=max_rotatable_bonds if max_rotatable_bonds >= 0 else None,
+                pdbqt_ready=self.form.checkBox_12.isChecked())
+            listed = set(self.current_ligands)
+            added = [ligand_name for ligand_name in names if ligand_name not in listed]
+            self.form.groupBox_14.setChecked(True)
+            self.form.listWidget_2.addItems(added)
+            self.current_ligands.extend(added)
+            set_statusline("Added %s of %s matching ligands" % (len(added), len(names)))
+
+        def add_library(): # a multi-molecule .sdf or .pdbqt file, docked record by record
+            filedialog = QtWidgets.QFileDialog()
+            filename = filedialog.getOpenFileName(None, "Ligand library", self.ligand_dir_path, 'ligand libraries (*.sdf *.pdbqt)')
+            filename = filename[0]
+            if filename == "":
+                return
+            library_name = os.path.basename(filename)
+            if library_name in self.current_libraries:
+                return
+            self.form.groupBox_14.setChecked(True)
+            self.current_libraries[library_name] = filename
+            self.form.listWidget_2.addItem(library_name)
+            self.current_ligands.append(library_name)
+
+        def ligand_source_file(ligand_name): # a file of the ligand openbabel can convert to .pdbqt
+            for i in range(self.form.comboBox_4.count()):
+                file_type = self.form.comboBox_4.itemText(i)
+                if file_type != "pdbqt" and os.path.isfile(self.ligand_dir_path+ligand_name+"."+file_type):
+                    return self.ligand_dir_path+ligand_name+"."+file_type
+            return None
+
         def set_lig_directory_indicator(path):
             self.form.lineEdit_6.clear()
             self.form.lineEdit_6.insert(path)
@@ -649,27 +838,72 @@ class Smina:
          * Docking with Smina allows the use of user customed scoring tables. 
         The actual scoring table might be edited or new scoring tables can be created or loaded.<br>
          * A log-file containing all docking parameters is created if this option is checked.<br>
+         * Ligands of the multirun list are docked simultaneously by the number of 'Parallel jobs' selected.
+        With 'Skip finished', a multirun started again skips the ligands already docked with the same parameters.<br>
+         * Smina runs in the background : its progress is shown next to the status line and it can be cancelled.<br>
+         * Dockings predicted to take longest start first, from the size and torsions of the ligand, the box and the
+        runtimes of earlier dockings ; the status line shows the time left.<br>
          * Results are selectable and ancient results can be loaded on the results page.<br>
+         * The poses of all dockings are recorded in smina_results.db in the working directory.<br>
          * All results can be post refined.
          </body></html>
         """
 
-        def make_receptor_pdbqt(prot):
-            cmd.save(prot+".pdb", prot)
-            receptor = os.getcwd()+"\\"+prot+".pdbqt"
-            charge_model = self.form.comboBox_5.currentText()
-            print("running openbable to create %s.pdbqt :" % prot)
-            command = 'call "%s" %s.pdb -O %s --partialcharge %s' % (self.openbabel_exe, prot, receptor, charge_model)
+        def current_pipeline(): # docking settings of the dialog for the commands built by SminaPipeline
+            ph = None
             if self.form.groupBox_17.isChecked() == True:
-                command = command+' -p %s' % (float(self.form.doubleSpinBox_4.value()))
-            else :
-                command = command+' -h'
-            print(command)
-            os.system(command)
-            if os.path.isfile(receptor):
-                set_statusline("Created %s" % receptor)
-            else :
-                set_statusline("ERROR when trying to create %s" % receptor)            
+                ph = float(self.form.doubleSpinBox_4.value())
+            seed = None
+            if self.form.groupBox_25.isChecked() == True:
+                seed = int(self.form.doubleSpinBox_5.value())
+            flexres = []
+            if self.form.radioButton_2.isChecked() == True:
+                flexres = list(self.current_flexibles)
+            custom_scoring = ""
+            if self.form.groupBox_26.isChecked() == True and self.form.comboBox_6.currentText() != "vina":
+                custom_scoring = self.scoring_table_file
+            suffix = ""
+            if self.form.groupBox_15.isChecked() == True:
+                suffix = self.form.lineEdit_7.text()
+            pipeline = SminaPipeline(smina_exe=self.config_settings['smina_exe'], openbabel_exe=self.config_settings['openbabel_exe'],
+                executor=self.form.comboBox_9.currentText(), workdir=os.getcwd(), receptor=self.form.comboBox.currentText(),
+                ensemble=list(self.ensemble),
+                charge_model=self.form.comboBox_5.currentText(), ph=ph,
+                exhaustiveness=self.form.spinBox.value(), num_modes=self.form.spinBox_2.value(), seed=seed, flexres=flexres,
+                custom_scoring=custom_scoring, parallel_jobs=self.form.spinBox_10.value(), ligand_chunk=self.form.spinBox_11.value(),
+                log=self.form.checkBox.isChecked(),
+                suffix=suffix, skip_finished=self.form.checkBox_8.isChecked(),
+                minimize=self.form.checkBox_4.isChecked(), local_only=self.form.groupBox_30.isChecked(),
+                autobox_add=self.form.spinBox_3.value(), randomize=self.form.checkBox_5.isChecked(),
+                approximation=self.form.comboBox_8.currentText(), accurate_line=self.form.checkBox_3.isChecked(),
+                minimize_early_term=self.form.checkBox_6.isChecked(),
+                minimize_iters=self.form.spinBox_7.value() if self.form.groupBox_31.isChecked() == True else None,
+                factor=self.form.spinBox_8.value() if self.form.groupBox_33.isChecked() == True else None,
+                force_cap=self.form.spinBox_9.value() if self.form.groupBox_32.isChecked() == True else None,
+                refinement_log=self.form.checkBox_7.isChecked())
+            if self.form.groupBox_44.isChecked() == True: # Funnel
+                pipeline.settings.update(funnel_exhaustiveness=self.form.spinBox_15.value(), funnel_num_modes=self.form.spinBox_16.value(),
+                    funnel_top=0 if self.form.checkBox_11.isChecked() else self.form.spinBox_17.value(),
+                    funnel_percent=float(self.form.spinBox_17.value()) if self.form.checkBox_11.isChecked() else 0.0)
+            if self.form.groupBox_45.isChecked() == True: # Replicas
+                pipeline.settings.update(replicas=self.form.spinBox_18.value(), replica_rmsd=float(self.form.doubleSpinBox_8.value()),
+                    replica_affinity=float(self.form.doubleSpinBox_9.value()))
+            pipeline.replica_runs = self.replica_runs
+            pipeline.cost_model = self.cost_model
+            pipeline.receptor_keys = self.receptor_keys
+            pipeline.receptor_cache = self.receptor_cache
+            pipeline.report = set_statusline
+            return pipeline
+
+        def prepare_receptors(prots, finish): # (re)creates prot.pdbqt in the background when the structure or the conversion options changed
+            pipeline = current_pipeline()
+            jobs = []
+            for prot in prots:
+                cmd.save(prot+".pdb", prot)
+                job = pipeline.receptor_job(prot+".pdb")
+                if job is not None:
+                    jobs.append(job)
+            run_smina_jobs(jobs, pipeline.collect_receptor, finish)
 
         def use_custom_scoring():
             if self.form.groupBox_26.isChecked() == True:
@@ -755,14 +989,10 @@ class Smina:
                 cmd.load(filename)
             else:
                 filename = outfile
-            lst = open(filename, 'r').readlines()
+            result = parse_pdbqt(filename)
             score_list = []
-            for line in lst:
-                if 'MODEL' in line:
-                    modnum = line.strip(" MODEL\n")
-                if 'minimizedAffinity' in line:
-                    modE = line.strip('REMAK minzedAfty\n') 
-                    score_list.append(modnum+";"+modE)
+            for i in range(len(result.models)):
+                score_list.append("%s;%g" % (result.models[i], result.affinities[i]))
             if filename.split('.')[0].rsplit('_', 1)[-1] != "docked": # not a '_docked.pdbqt' file 
                 ligand_name = filename.translate(str.maketrans('\\','/','')).rsplit('/', 1)[-1].split('.')[0]
             else :
@@ -790,134 +1020,504 @@ class Smina:
                 score_table.setItem(i,2,check)
             score_table.cellClicked.connect(check_button_select) # this gets the current cell for selection
 
-        def combine_flexres(flexout): # merges all residues of the same model into a multi-model file starting with model 1
-            flexres_merged_name = "" # just in case no flexres is selected
-            if os.path.isfile(flexout.split(".")[0]+"_merged.pdbqt"):
-                os.remove(flexout.split(".")[0]+"_merged.pdbqt")
-            if os.path.isfile(flexout):
-                with open(flexout, 'r') as file:
-                    oldfile = file.readlines()
-                flexres_merged_name = flexout.split(".")[0]+"_merged.pdbqt"
-                for line in oldfile:
-                    if 'MODEL' in line:
-                        actual_model = line
-                        break
-                first_model = 1
-                with open(flexres_merged_name, 'a') as newfile:
-                    newfile.write("MODEL "+str(first_model)+"\n")
-                    for line in oldfile:
-                        if 'MODEL' in line and line != actual_model:
-                            newfile.write('ENDMDL\n')
-                            first_model = first_model + 1
-                            actual_model = line
-                            newfile.write("MODEL "+str(first_model)+"\n")
-                            continue
-                        if 'MODEL' in line and line == actual_model:
-                            continue        
-                        if 'ENDMDL' in line:
-                            continue
-                        else :
-                            newfile.write(line)
-                    newfile.write('ENDMDL\n')
-            return flexres_merged_name
-           
-        def smina_loop(ligand):
-            prot = self.form.comboBox.currentText()
-            if prot == "":
+        def make_conversion_job(ligand_files): # one openbabel process converting each file to .pdbqt next to it
+            return current_pipeline().conversion_job(ligand_files)
+
+        def collect_conversion_job(job):
+            if job.returncode is None and job.output != "":
+                print("ERROR : "+job.output)
+            for ligand in job.ligands:
+                if not os.path.isfile(ligand.rsplit(".", 1)[0]+".pdbqt"):
+                    self.conversion_failures.append(ligand)
+
+        def convert_ligands(ligand_files, finish): # converts many ligands with a few openbabel processes running in parallel
+            self.conversion_failures = []
+            chunk_size = max(1, min(200, -(-len(ligand_files)//self.form.spinBox_10.value())))
+            jobs = []
+            chunk = []
+            length = 0
+            for ligand in ligand_files:
+                if chunk != [] and (len(chunk) >= chunk_size or length+len(ligand) > 6000): # stay below the cmd.exe line limit
+                    jobs.append(make_conversion_job(chunk))
+                    chunk = []
+                    length = 0
+                chunk.append(ligand)
+                length = length+len(ligand)+3
+            if chunk != []:
+                jobs.append(make_conversion_job(chunk))
+            print("converting %s ligands to .pdbqt with %s openbabel processes" % (len(ligand_files), len(jobs)))
+            run_smina_jobs(jobs, collect_conversion_job, finish)
+
+        def report_conversion():
+            if self.conversion_failures != []:
+                for ligand in self.conversion_failures:
+                    print("ERROR : openbabel could not convert "+ligand)
+                set_statusline("ERROR : %s ligands could not be converted to .pdbqt" % len(self.conversion_failures))
+
+        def results_store(): # database of the poses docked in the working directory
+            filename = os.path.join(os.getcwd(), "smina_results.db")
+            if self.results_store is None or self.results_store.filename != filename:
+                if self.results_store is not None:
+                    self.results_store.close()
+                self.results_store = ResultsStore(filename)
+            return self.results_store
+
+        def prepare_smina_jobs(ligand): # builds the smina commands of one ligand without running them, one per receptor of the ensemble
+            if self.form.comboBox.currentText() == "":
                 set_statusline("ERROR : No structure selected")
+                return None
+            if self.form.radioButton_2.isChecked() == True and self.current_flexibles == []:
+                set_statusline("ERROR : No flexibles selected -> using rigid side chains")
+                self.Buttongroup_1.setExclusive(False)
+                self.form.radioButton.setChecked(True)
+                self.form.radioButton_2.setChecked(False)
+                self.Buttongroup_1.setExclusive(True)
+                print("Missing flexible residues switched to rigid side chains")
+                return None
+            pipeline = current_pipeline()
+            if self.funnel_stage == True: # cheap settings for all ligands
+                pipeline.store = results_store()
+                pipeline = pipeline.funnel_stage()
+            return pipeline.ligand_jobs(ligand)
+
+        def collect_smina_job(job): # loads the results of a finished smina job
+            if self.form.checkBox.isChecked() == True:
+                if os.path.isfile(job.logfile):
+                    lst = []
+                    with open(job.config, 'r') as f:
+                        lst = f.readlines()
+                    with open (job.logfile, 'a') as log_file:
+                        log_file.write("Parameters : \n"+subprocess.list2cmdline(job.command)+"\n"+str(lst))
+                else:
+                    set_statusline("ERROR : Could not find "+job.logfile)
+            if not os.path.isfile(job.outfile):
+                set_statusline('ERROR : smina failed for %s (%s)' % (job.name, failure_reason(job)))
+                results_store().job_failed(job)
+                submit_replicas(job)
                 return
-            else:
-                receptor = os.getcwd()+"\\"+prot+".pdbqt"
-                if ( not os.path.isfile(receptor)):
-                    make_receptor_pdbqt(prot)
-            ligand_name = ligand.split("/")[-1]
-            config = os.getcwd()+"\\"+prot+"_config.txt"
-            if self.form.groupBox_15.isChecked() == True: # add suffix to outfile
-                ligand_name = ligand_name+"_"+self.form.lineEdit_7.text()
-            outfile = os.getcwd()+"\\"+ligand_name+"_docked.pdbqt"
-            if ( not os.path.isfile(config)): # check presence of smina config file for receptor 
-                set_statusline('ERROR : Could not find %s_config.txt in current directory' % prot)
+            if not self.large_run:
+                fill_score_list(job.outfile)
+            flexres = {}
+            flexres_name = ""
+            if job.flexout != "": 
+                if os.path.isfile(job.flexout):
+                    flexres_name = job.flexout.rsplit(".", 1)[0].translate(str.maketrans('\\','/','')).split('/')[-1]
+                    if self.form.groupBox_15.isChecked() == True: # add suffix
+                        flexres_name = flexres_name+'_'+self.form.lineEdit_7.text()
+                    flexres = dict(combine_flexres(job.flexout))
+                else :
+                    set_statusline('ERROR : Could not find %s in current directory' % job.flexout)  
+            poses = store_docking_results(results_store(), job, flexres)
+            results_store().job_done(job)
+            self.leaderboard.add_poses(job, poses)
+            affinities = [affinity for model, affinity, rmsd_lb, rmsd_ub, residues in poses if affinity == affinity] # not nan
+            show_docked(job.outfile, min(affinities) if affinities != [] else float('nan'), flexres_name, flexres)
+            submit_replicas(job)
+
+        def unfinished_jobs(jobs): # skip finished : the jobs not docked yet, and the next seed of replicas docked before that do not agree
+            pipeline = current_pipeline()
+            pipeline.store = results_store()
+            return pipeline.unfinished(jobs)
+
+        def submit_replicas(job): # docks the ligand with the next seed until the best poses of its replicas agree
+            if job.replica is None or self.scheduler is None:
+                return
+            pipeline = current_pipeline()
+            pipeline.store = results_store()
+            if self.funnel_stage == True:
+                pipeline = pipeline.funnel_stage()
+            for replica in pipeline.replica_jobs(job):
+                replica.collect = job.collect
+                if job.collect == collect_record_job: # the record is kept for the next replica
+                    replica.ligands = list(job.ligands)
+                    for ligand in job.ligands:
+                        self.record_users[ligand] = self.record_users.get(ligand, 0)+1
+                self.scheduler.submit(replica)
+
+        def show_docked(outfile, affinity, flexres_name="", flexres={}): # loads a docked file unless the Load poses mode skips it
+            mode = self.form.comboBox_10.currentText()
+            if mode == "none": # load_result_poses loads them on demand
+                return
+            if mode == "top K":
+                for dropped in self.top_docked.push(outfile, affinity):
+                    for name in self.docked_objects.pop(dropped, []):
+                        cmd.delete(name)
+                if outfile not in self.top_docked:
+                    return
+            load_docked(outfile)
+            objects = [outfile.translate(str.maketrans('\\','/','')).rsplit('/', 1)[-1].rsplit('.', 1)[0]]
+            if flexres_name != "":
+                cmd.delete(flexres_name)
+                for model in sorted(flexres): # one state per model, no merged file
+                    cmd.load_raw(flexres[model], 'pdbqt', flexres_name, model)
+                objects.append(flexres_name)
+            self.docked_objects[outfile] = objects
+
+        def collect_batch_job(job): # splits the output of a multi-ligand smina process and collects each ligand
+            if not split_batch(job):
+                set_statusline("ERROR : could not split the poses of %s, docking its ligands one by one" % job.name)
+                for part in job.parts:
+                    self.scheduler.submit(part)
+                return
+            for part in job.parts:
+                if part.collect is not None:
+                    part.collect(part)
+                else:
+                    self.collect_job(part)
+
+        def submit_docking_jobs(jobs): # several ligands per smina process if set
+            for job in current_pipeline().batched(jobs):
+                if job.parts != []:
+                    job.collect = collect_batch_job
+                self.scheduler.submit(job)
+
+        def run_smina_jobs(jobs, collect, finish=None, feed=None): # starts the jobs in the background, each one is collected as soon as it is finished
+            # feed() submits more jobs while the run goes on and returns False once it has nothing left
+            if self.scheduler is not None:
+                set_statusline("ERROR : smina jobs are still running")
+                return
+            if jobs == [] and feed is None:
+                if finish is not None:
+                    finish()
+                return
+            self.scheduler = SminaScheduler(self.form.spinBox_10.value())
+            self.collect_job = collect
+            self.finish_jobs = finish
+            self.feed_jobs = feed
+            self.scheduler.submit_all(jobs)
+            print("running %s jobs with %s parallel processes :" % (len(jobs), self.scheduler.max_jobs))
+            if feed is not None: # total unknown
+                self.form.progressBar.setRange(0, 0)
+            self.form.progressBar.setValue(0)
+            self.form.pushButton_29.setEnabled(True)
+            for button in (self.form.pushButton, self.form.pushButton_23, self.form.pushButton_24):
+                button.setEnabled(False)
+            self.job_timer.start(200)
+
+        def poll_smina_jobs(): # called by the job timer in the Qt event loop
+            scheduler = self.scheduler
+            finished = scheduler.finished_jobs()
+            left = ""
+            if finished != []:
+                cmd.set('suspend_updates', 'on') # one redraw for all results loaded here
+            try:
+                eta = None
+                try:
+                    for job in finished:
+                        if not job.cancelled:
+                            record_runtime(job)
+                    if finished != [] and self.feed_jobs is None: # unknown while jobs are fed
+                        eta = scheduler.eta(self.cost_model.cost)
+                except Exception as error: # locked store, the results are collected anyway
+                    set_statusline("ERROR : could not record the runtimes (%s)" % error)
+                if eta is not None and eta >= 0.5:
+                    left = ", about %s left" % format_duration(eta)
+                for job in finished:
+                    if job.cancelled:
+                        continue
+                    try:
+                        if job.collect is not None:
+                            job.collect(job)
+                        else:
+                            self.collect_job(job)
+                    except Exception as error: # keep collecting the others
+                        set_statusline("ERROR : could not load results of %s (%s)" % (job.name, error))
+                        continue
+                    set_statusline("Finished %s (%s/%s)%s" % (job.name, scheduler.done, scheduler.submitted, left))
+            finally:
+                if finished != []:
+                    cmd.set('suspend_updates', 'off')
+            if self.leaderboard.changed:
+                show_leaderboard()
+            if self.feed_jobs is not None and not scheduler.cancelled and not scheduler.stopped:
+                if len(scheduler.pending) < scheduler.lookahead and not self.feed_jobs(): # keep the queue short
+                    self.feed_jobs = None
+            if self.feed_jobs is None:
+                self.form.progressBar.setValue(scheduler.progress())
+            if scheduler.is_finished() and (self.feed_jobs is None or scheduler.cancelled):
+                end_smina_jobs()
+
+        def record_runtime(job): # calibrates the cost model on a finished docking
+            timings = self.cost_model.observe(job)
+            if timings != []:
+                results_store().add_timings(timings)
+
+        def end_smina_jobs():
+            self.job_timer.stop()
+            cancelled = self.scheduler.cancelled
+            if cancelled:
+                set_statusline("Cancelled smina jobs (%s/%s finished)" % (self.scheduler.done, self.scheduler.submitted))
+            self.form.progressBar.setRange(0, 100)
+            if not cancelled:
+                self.form.progressBar.setValue(100)
+            self.feed_jobs = None
+            self.scheduler.shutdown()
+            self.scheduler = None
+            self.form.pushButton_29.setEnabled(False)
+            for button in (self.form.pushButton, self.form.pushButton_23, self.form.pushButton_24):
+                button.setEnabled(True)
+            if self.results_model is not None:
+                self.results_model.refresh()
+            if self.finish_jobs is not None and not cancelled: # next step of the run
+                self.finish_jobs()
+
+        def cancel_smina_jobs():
+            if self.scheduler is not None:
+                self.scheduler.cancel()
+                set_statusline("Cancelling smina jobs ...")
+
+        def stop_screen(): # no new dockings, the running ones are finished and collected
+            if self.scheduler is not None:
+                self.scheduler.stop(keep=lambda job: job.collect is collect_minimize_job) # promoted hits are still refined
+                self.feed_jobs = None
+                set_statusline("Stopping the screen after %s running jobs ..." % len(self.scheduler.processes))
+
+        def show_leaderboard(): # called after each poll with new results
+            table = self.form.tableWidget_2
+            rows = self.leaderboard.rows()
+            table.setRowCount(len(rows))
+            for i, (ligand, affinity, receptor, model, outfile) in enumerate(rows):
+                for column, text in enumerate((ligand, "%g" % affinity, receptor, str(model))):
+                    item = QtWidgets.QTableWidgetItem(text)
+                    if ligand in self.promoted:
+                        item.setForeground(QtCore.Qt.darkGreen)
+                    table.setItem(i, column, item)
+            self.leaderboard.changed = False
+
+        def refine_hits(): # post-refines the best pose of the selected leaderboard ligands, all of them if none is selected
+            rows = self.leaderboard.rows()
+            selected = sorted(set(index.row() for index in self.form.tableWidget_2.selectionModel().selectedRows()))
+            if selected != []:
+                rows = [rows[i] for i in selected if i < len(rows)]
+            pipeline = current_pipeline()
+            jobs = []
+            for ligand, affinity, receptor, model, outfile in rows:
+                if ligand in self.promoted:
+                    continue
+                docked = outfile.translate(str.maketrans('\\','/','')).rsplit('/', 1)[-1].rsplit('.', 1)[0]
+                pose = os.path.join(os.getcwd(), "pose%s_%s" % (model, docked.rsplit("_docked", 1)[0]))
+                if not extract_model(outfile, model, pose+".pdbqt"):
+                    set_statusline('ERROR : Could not find model %s in %s' % (model, outfile))
+                    continue
+                job = pipeline.minimize_job(pose, receptor if self.ensemble != [] else None)
+                if job is None:
+                    return
+                job.collect = collect_minimize_job
+                jobs.append(job)
+                self.promoted.add(ligand)
+            if self.scheduler is None:
+                run_smina_jobs(jobs, collect_minimize_job)
+            else: # refined while the docking goes on
+                for job in jobs:
+                    self.scheduler.submit(job)
+            show_leaderboard()
+            set_statusline("Refining %s hits" % len(jobs))
+
+        def submit_record_jobs(ligand_pdbqts): # docks records of a library
+            jobs = []
+            for ligand_pdbqt in ligand_pdbqts:
+                ligand_jobs = prepare_smina_jobs(ligand_pdbqt.rsplit(".", 1)[0])
+                if ligand_jobs is None:
+                    self.scheduler.cancel()
+                    return
+                if self.form.checkBox_8.isChecked() == True:
+                    ligand_jobs = unfinished_jobs(ligand_jobs)
+                for job in ligand_jobs:
+                    job.ligands = [ligand_pdbqt]
+                    job.collect = collect_record_job
+                if ligand_jobs == []: # all docked already, no collect removes the record
+                    if os.path.isfile(ligand_pdbqt):
+                        os.remove(ligand_pdbqt)
+                    continue
+                self.record_users[ligand_pdbqt] = len(ligand_jobs)
+                jobs.extend(ligand_jobs)
+            results_store().jobs_started(jobs)
+            submit_docking_jobs(jobs)
+
+        def collect_record_job(job):
+            collect_smina_job(job)
+            for ligand in job.ligands:
+                self.record_users[ligand] = self.record_users.get(ligand, 1)-1
+                if self.record_users[ligand] > 0: # still docked against other receptors of the ensemble
+                    continue
+                del self.record_users[ligand]
+                if os.path.isfile(ligand): # the record is not needed anymore
+                    os.remove(ligand)
+
+        def collect_record_conversion(job):
+            ligand_pdbqts = []
+            for ligand in job.ligands:
+                ligand_pdbqt = ligand.rsplit(".", 1)[0]+".pdbqt"
+                os.remove(ligand)
+                if os.path.isfile(ligand_pdbqt):
+                    ligand_pdbqts.append(ligand_pdbqt)
+                else:
+                    print("ERROR : openbabel could not convert %s (%s)" % (ligand, failure_reason(job)))
+            submit_record_jobs(ligand_pdbqts)
+
+        def submit_library_chunk(library, chunk): # writes a chunk of records and queues their conversion or docking
+            record_dir = self.ligand_dir_path+library.base+"_records/"
+            if not os.path.isdir(record_dir):
+                os.mkdir(record_dir)
+            ligand_files = []
+            for record_name, record in chunk:
+                if self.funnel_hits is not None and record_name not in self.funnel_hits:
+                    continue
+                if self.form.checkBox_8.isChecked() == True:
+                    ligand_jobs = prepare_smina_jobs(record_dir+record_name)
+                    if ligand_jobs is not None and unfinished_jobs(ligand_jobs) == []:
+                        self.skipped_jobs = self.skipped_jobs+len(ligand_jobs)
+                        continue
+                ligand_file = record_dir+record_name+"."+library.file_type
+                with open(ligand_file, 'w') as f:
+                    f.write(record)
+                ligand_files.append(ligand_file)
+            if ligand_files == []:
                 return
+            if library.file_type == "pdbqt":
+                submit_record_jobs(ligand_files)
             else:
-                print("running smina :")
-                receptor_wsl = "/mnt/c"+receptor.split(":")[-1].translate(str.maketrans('\\','/','')) # format receptor path for wsl
-                config_wsl = "/mnt/c"+config.split(":")[-1].translate(str.maketrans('\\','/','')) # format config path for wsl
-                outfile_wsl = "/mnt/c"+outfile.split(":")[-1].translate(str.maketrans('\\','/','')) # format outfile path for wsl
-                smina = "/mnt/c"+self.smina_exe.split(":")[-1] # format smina_path for wsl
-                ligand = "/mnt/c"+ligand.split(":")[-1] # format ligand_dir_path for wsl
-                exhaust = self.form.spinBox.value()
-                maxmodes = self.form.spinBox_2.value()
-                command = 'call wsl %s -r %s -l %s.pdbqt --config %s -o %s --flex_hydrogens --exhaustiveness %s --num_modes %s ' % (smina,
-                    receptor_wsl, ligand, config_wsl, outfile_wsl, exhaust, maxmodes)                 
-                if self.form.radioButton_2.isChecked() == True: # run smina with flexibles
-                    if self.current_flexibles != []:
-                        flex_raw = []
-                        for i in range(len(self.current_flexibles)):
-                            A = self.current_flexibles[i].split(":")[0]
-                            B = self.current_flexibles[i].split(":")[-1].strip(':ABCDEFGHIJKLMNOPQRSTUVWXYZ')
-                            flex_raw.append(A+":"+B)
-                        flexibles = str(flex_raw).strip('[]').translate(str.maketrans('','', "'")).translate(str.maketrans('','', " "))
-                        flexout = os.getcwd()+"\\"+ligand_name+"_flexres.pdbqt"
-                        flexout_wsl = "/mnt/c"+flexout.split(":")[-1].translate(str.maketrans('\\','/','')) # format outfile path for wsl
-                        command = command+' --flexres %s --out_flex %s' % (flexibles, flexout_wsl)
-                    else:
-                        set_statusline("ERROR : No flexibles selected -> using rigid side chains")
-                        self.Buttongroup_1.setExclusive(False)
-                        self.form.radioButton.setChecked(True)
-                        self.form.radioButton_2.setChecked(False)
-                        self.Buttongroup_1.setExclusive(True)
-                        print("Missing flexible residues switched to rigid side chains")
-                        return
-                if self.form.groupBox_25.isChecked() == True: # set seed
-                    seed = int(self.form.doubleSpinBox_5.value())
-                    command = command+' --seed %s' % (seed)
-                if self.form.groupBox_26.isChecked() == True: # custom score table
-                    if self.form.comboBox_6.currentText() == "vina":
-                        None
-                    else:
-                        custscrtbl = "/mnt/c"+self.scoring_table_file.split(":")[-1] # format score_table_path for wsl
-                        command = command+' --custom_scoring %s' % (custscrtbl)
-                if self.form.checkBox.isChecked() == True: # write smina Logfile
-                    if self.form.groupBox_15.isChecked() == True: # add suffix to logfile too !
-                        logfile = receptor.split(".")[0]+'_'+ligand.split('/')[-1].split('.')[0]+"_"+self.form.lineEdit_7.text()+'.log'
-                    else :
-                        logfile = receptor.split(".")[0]+'_'+ligand.split('/')[-1].split('.')[0]+'.log'
-                logfile_wsl = "/mnt/c"+logfile.split(":")[-1].translate(str.maketrans('\\','/','')) # format receptor path for wsl
-                command = command+' --log %s' % (logfile_wsl)
-                # print(command)
-                os.system(command)
-                if self.form.checkBox.isChecked() == True:
-                    if os.path.isfile(logfile):
-                        lst = []
-                        with open(config, 'r') as f:
-                            lst = f.readlines()
-                        with open (logfile, 'a') as log_file:
-                            log_file.write("Parameters : \n"+command+"\n"+str(lst))
-                    else:
-                        set_statusline("ERROR : Could not find "+logfile)
-                load_docked(outfile)
-                fill_score_list(outfile)
-                if self.form.radioButton_2.isChecked() == True: 
-                    flexres_merged = combine_flexres(flexout) # still has "_merged" in title !
-                    if os.path.isfile(flexres_merged):
-                        flexres_name = flexres_merged.rsplit("_",maxsplit=1)[0].split('\\')[-1]
-                        if self.form.groupBox_15.isChecked() == True: # add suffix
-                            flexres_name = flexres_name+'_'+self.form.lineEdit_7.text()
-                        cmd.load(flexres_merged, flexres_name) 
-                    else :
-                        set_statusline('ERROR : Could not find %s in current directory' % flexres_merged)  
+                job = make_conversion_job(ligand_files)
+                job.collect = collect_record_conversion
+                self.scheduler.submit(job)
+
+        def library_feed(libraries): # streams the libraries into the running scheduler
+            chunk_size = max(8, 4*self.form.spinBox_10.value())
+            chunks = ((library, chunk) for library in libraries for chunk in library.chunks(chunk_size))
+            def feed():
+                library_chunk = next(chunks, None)
+                if library_chunk is None:
+                    return False
+                submit_library_chunk(*library_chunk)
+                return True
+            return feed
+
+        def report_skipped_jobs():
+            if self.skipped_jobs > 0:
+                set_statusline("Skipped %s dockings already done with the same parameters" % self.skipped_jobs)
+
+        def finish_docking():
+            report_skipped_jobs()
+            if self.funnel_stage == True: # the best ligands of the first stage are docked with the settings of the dialog
+                pipeline = current_pipeline()
+                pipeline.store = results_store()
+                self.funnel_hits = set(pipeline.funnel_hits(pipeline.funnel_stage()))
+                self.funnel_stage = False
+                for outfile in list(self.top_docked.scores): # top K of the second stage
+                    for name in self.docked_objects.pop(outfile, []):
+                        cmd.delete(name)
+                self.top_docked = TopK(self.form.spinBox_13.value())
+                self.leaderboard = Leaderboard(self.form.spinBox_14.value())
+                self.promoted = set()
+                show_leaderboard()
+                set_statusline("Funnel : docking the best %s ligands with exhaustiveness %s" % (len(self.funnel_hits), self.form.spinBox.value()))
+                dock_multirun_list()
+                return
+            if self.ensemble != []:
+                pipeline = current_pipeline()
+                pipeline.store = results_store()
+                set_statusline("Best affinities of %s ligands over %s receptors in smina_ensemble.csv" % (pipeline.ensemble_summary(),
+                    len(self.ensemble)))
+
+        def ensemble_receptors(): # objects of the ensemble, else the states of the structure split into objects
+            names = self.form.lineEdit_10.text().replace(",", " ").split()
+            if names != []:
+                return names
+            prot = self.form.comboBox.currentText()
+            states = cmd.count_states(prot)
+            if states < 2:
+                set_statusline("ERROR : %s has a single state, enter the objects of the ensemble" % prot)
+                return []
+            for state in range(1, states+1):
+                cmd.create("%s_state%s" % (prot, state), prot, state, 1)
+                cmd.disable("%s_state%s" % (prot, state))
+            return ["%s_state%s" % (prot, state) for state in range(1, states+1)]
+
+        def dock_multirun_list():
+            report_conversion()
+            jobs = []
+            libraries = []
+            self.skipped_jobs = 0
+            for i in range(self.form.listWidget_2.count()):
+                ligand_name = self.form.listWidget_2.item(i).text()
+                if ligand_name in self.current_libraries:
+                    libraries.append(LigandLibrary(self.current_libraries[ligand_name]))
+                    continue
+                if self.funnel_hits is not None and ligand_name not in self.funnel_hits:
+                    continue
+                ligand = self.ligand_dir_path+ligand_name
+                if not os.path.isfile(ligand+".pdbqt"):
+                    continue # conversion failed
+                ligand_jobs = prepare_smina_jobs(ligand)
+                if ligand_jobs is None:
+                    return
+                if self.form.checkBox_8.isChecked() == True:
+                    todo = unfinished_jobs(ligand_jobs)
+                    self.skipped_jobs = self.skipped_jobs+len([job for job in ligand_jobs if job not in todo])
+                    ligand_jobs = todo
+                jobs.extend(ligand_jobs)
+            results_store().jobs_started(jobs)
+            report_skipped_jobs()
+            self.large_run = libraries != [] or len(jobs) > self.max_result_tabs
+            if self.large_run:
+                set_statusline("Large multirun : the results are listed in the All Results tab")
+            feed = None
+            if libraries != []:
+                feed = library_feed(libraries)
+            batches = []
+            for job in current_pipeline().batched(jobs):
+                if job.parts != []:
+                    job.collect = collect_batch_job
+                batches.append(job)
+            run_smina_jobs(batches, collect_smina_job, finish_docking, feed)
 
         def run_smina():                   
+            self.ensemble = []
+            self.skipped_jobs = 0
+            self.top_docked = TopK(self.form.spinBox_13.value()) # top K of this run
+            self.funnel_stage = self.form.groupBox_44.isChecked() == True and self.form.groupBox_14.isChecked() == True
+            self.funnel_hits = None
+            self.replica_runs = {}
+            self.cost_model = JobCostModel(results_store().timings())
+            self.leaderboard = Leaderboard(self.form.spinBox_14.value())
+            self.promoted = set()
+            show_leaderboard()
+            prots = []
+            if self.form.groupBox_40.isChecked() == True and self.form.comboBox.currentText() != "": # Ensemble
+                self.ensemble = ensemble_receptors()
+                if self.ensemble == []:
+                    return
+                prots = self.ensemble
+            elif self.form.comboBox.currentText() != "":
+                prots = [self.form.comboBox.currentText()]
+            prepare_receptors(prots, dock_ligands)
+
+        def dock_ligands(): # once the receptors are prepared
             if self.form.groupBox_14.isChecked() == True: # Multirun
+                missing = []
                 for i in range(self.form.listWidget_2.count()):
-                    ligand = self.ligand_dir_path+self.form.listWidget_2.item(i).text()
-                    smina_loop(ligand)
+                    ligand_name = self.form.listWidget_2.item(i).text()
+                    if ligand_name in self.current_libraries:
+                        continue
+                    if not os.path.isfile(self.ligand_dir_path+ligand_name+".pdbqt"):
+                        source = ligand_source_file(ligand_name)
+                        if source is not None:
+                            missing.append(source)
+                if missing != []:
+                    convert_ligands(missing, dock_multirun_list)
+                else:
+                    dock_multirun_list()
             else:
                 if ( not os.path.isfile(self.ligand_dir_path+self.form.comboBox_2.currentText()+".pdbqt")):
                     ligand = self.ligand_dir_path+self.form.comboBox_2.currentText()+"."+self.form.comboBox_4.currentText()
                     make_ligand_pdbqt(ligand)
                 ligand = self.ligand_dir_path+self.form.comboBox_2.currentText()
-                smina_loop(ligand)
+                jobs = prepare_smina_jobs(ligand)
+                if jobs is None:
+                    return
+                results_store().jobs_started(jobs)
+                self.large_run = False
+                run_smina_jobs(jobs, collect_smina_job, finish_docking)
 
         def synchronize_Radiobuttons_1():
             self.Buttongroup_1.setExclusive(False)
@@ -1016,6 +1616,84 @@ class Smina:
                     print("writing: "+"pose"+modnr+"_"+ligand+" to "+"pose"+modnr+"_"+ligand+".pdb")
                     cmd.save("pose"+modnr+"_"+ligand+".pdb", "pose"+modnr+"_"+ligand)            
 
+        def show_all_results(): # (re)attaches the results of the working directory to the All Results view
+            store = results_store()
+            if self.results_model is None or self.results_model.store is not store:
+                self.results_model = ResultsTableModel(store)
+                self.form.tableView_2.setModel(self.results_model)
+            filters = {'ligand': self.form.lineEdit_9.text().strip()}
+            if self.form.checkBox_9.isChecked() == True:
+                filters['max_affinity'] = self.form.doubleSpinBox_6.value()
+            self.results_model.set_filters(self.form.checkBox_10.isChecked(), **filters)
+            self.form.tableView_2.horizontalHeader().setSortIndicator(self.results_model._keys.index(self.results_model.order),
+                QtCore.Qt.DescendingOrder if self.results_model.descending else QtCore.Qt.AscendingOrder)
+            set_statusline("%s results" % self.results_model.total)
+
+        def load_result_poses(): # creates the selected poses, a docked file is loaded once
+            if self.results_model is None:
+                return
+            rows = sorted(set(index.row() for index in self.form.tableView_2.selectionModel().selectedRows()))
+            cmd.set('suspend_updates', 'on')
+            try:
+                load_result_rows(rows)
+            finally:
+                cmd.set('suspend_updates', 'off')
+            show_current_poses()
+
+        def load_result_rows(rows):
+            for row in rows:
+                record = self.results_model.row(row)
+                if record is None:
+                    continue
+                if self.results_model.best_only:
+                    model, outfile = record[3], record[4]
+                else:
+                    model, outfile = record[1], record[8]
+                if not os.path.isfile(outfile):
+                    set_statusline('ERROR : Could not find %s' % outfile)
+                    continue
+                docked = outfile.translate(str.maketrans('\\','/','')).rsplit('/', 1)[-1].rsplit('.', 1)[0]
+                if docked not in cmd.get_names('objects'):
+                    cmd.load(outfile, docked)
+                    cmd.disable(docked)
+                pose = "pose%s_%s" % (model, docked.rsplit("_docked", 1)[0])
+                cmd.create(pose, docked, model, 1)
+                residues = results_store().flexres(outfile, model)
+                if residues is not None:
+                    cmd.delete(pose+"_flexres")
+                    cmd.load_raw(residues, 'pdbqt', pose+"_flexres")
+                self.pose_outfiles[pose] = outfile
+                if pose not in self.loaded_poses_list:
+                    self.loaded_poses_list.append(pose)
+                    if not os.path.isfile(pose+".pdb"): # post-refinement reads the poses from cwd
+                        cmd.save(pose+".pdb", pose)
+
+        def rescore_results(): # ranks the stored poses with the current scoring table, smina only computes missing term values
+            if self.scheduler is not None:
+                set_statusline("ERROR : smina jobs are still running")
+                return
+            scoring_table = ""
+            if self.form.comboBox_6.currentText() != "vina":
+                scoring_table = self.scoring_table_file
+            self.rescoring_list = [[weight, term] for weight, term in self.scoring_list if term != ""]
+            pipeline = current_pipeline()
+            pipeline.store = results_store()
+            run_smina_jobs(list(pipeline.terms_jobs(self.rescoring_list, scoring_table)), pipeline.collect_terms, rerank_results)
+
+        def rerank_results(): # all term values are cached, a matrix vector product ranks the poses
+            pipeline = current_pipeline()
+            pipeline.store = results_store()
+            start = time.time()
+            try:
+                count = pipeline.rescore(self.rescoring_list)
+            except ValueError as error:
+                set_statusline("ERROR : %s" % error)
+                return
+            show_all_results()
+            if not self.results_model.best_only:
+                self.form.tableView_2.sortByColumn(self.results_model._keys.index('rescored'), QtCore.Qt.AscendingOrder)
+            set_statusline("Rescored %s poses with %s in %.0f ms" % (count, self.form.comboBox_6.currentText(), (time.time()-start)*1000))
+
         # Post refinement Page
 
         refinement_text = """
@@ -1051,9 +1729,65 @@ class Smina:
                     self.current_poses_list.append(selected_poses_list[i])
             for i in range(len(self.loaded_poses_list)):
                 self.current_poses_list.append(self.loaded_poses_list[i])
+            if self.form.groupBox_41.isChecked() == True: # cluster representatives only
+                poses = len(self.current_poses_list)
+                self.current_poses_list = cluster_representatives(self.current_poses_list)
+                set_statusline("%s of %s poses are cluster representatives" % (len(self.current_poses_list), poses))
             for i in range(len(self.current_poses_list)):
                 self.form.listWidget_3.addItem(self.current_poses_list[i])            
 
+        def pose_affinities(poses): # affinity of each pose read from the file it was taken from, nan if there is none
+            files = {} # file -> [(pose, model)], model None for a post-refined ligand
+            for name in poses:
+                prefix, ligand = (name.split("_", 1)+[""])[:2]
+                if prefix.startswith("pose") and prefix[4:].isdigit(): # pose3_lig from lig_docked.pdbqt
+                    outfile = self.pose_outfiles.get(name, os.path.join(os.getcwd(), ligand+"_docked.pdbqt"))
+                    files.setdefault(outfile, []).append((name, int(prefix[4:])))
+                else:
+                    files.setdefault(os.path.join(os.getcwd(), name+".pdbqt"), []).append((name, None))
+            affinities = {}
+            for outfile, models in files.items():
+                if not os.path.isfile(outfile):
+                    continue
+                try:
+                    result = parse_pdbqt(outfile)
+                except ValueError: # truncated
+                    continue
+                model_affinities = dict(zip(result.models, result.affinities.tolist()))
+                for name, model in models:
+                    if model is None:
+                        model = result.models[0] if result.models != [] else None
+                    affinities[name] = model_affinities.get(model, np.nan)
+            return affinities
+
+        def pose_ligand(name): # pose3_lig_receptor -> lig, poses of all receptors of the ensemble are clustered together
+            prefix, ligand = (name.split("_", 1)+[""])[:2]
+            if not (prefix.startswith("pose") and prefix[4:].isdigit()):
+                return name
+            for receptor in self.ensemble:
+                if ligand.endswith("_"+receptor):
+                    return ligand[:-len(receptor)-1]
+            return ligand
+
+        def cluster_representatives(poses): # drops the poses within the rmsd cutoff of a better pose of the same ligand
+            affinities = pose_affinities(poses)
+            groups = {} # (ligand, heavy atoms) -> poses
+            for name in poses:
+                coords = cmd.get_coords("%s and not elem H" % name)
+                if coords is None:
+                    groups[(name, 0)] = [(name, None)]
+                    continue
+                groups.setdefault((pose_ligand(name), len(coords)), []).append((name, coords))
+            representatives = set()
+            for group in groups.values():
+                if len(group) == 1:
+                    representatives.add(group[0][0])
+                    continue
+                clusters, best = cluster_poses(np.array([coords for name, coords in group]),
+                    np.array([affinities.get(name, np.nan) for name, coords in group]), self.form.doubleSpinBox_7.value())
+                representatives.update(group[i][0] for i in best)
+            return [name for name in poses if name in representatives]
+
         def delete_ligand_flexres(ligand_pdbqt): #delete flexible residues from file
             with open(ligand_pdbqt, 'r') as file:
                 ligand_file = file.readlines()
@@ -1067,6 +1801,45 @@ class Smina:
                         newfile.write(line)
             return
                     
+        def prepare_minimize_job(ligand_name): # builds the post-refinement command of one converted pose without running it
+            ligand = os.path.join(os.getcwd(), ligand_name)
+            # check if ligand_file has flexres                    
+            ligand_pdbqt = ligand+".pdbqt"
+            if len(parse_pdbqt(ligand_pdbqt).torsdof) > 1:
+                delete_ligand_flexres(ligand_pdbqt)
+            return current_pipeline().minimize_job(ligand)
+
+        def refinement_batch_jobs(jobs): # several poses per smina process
+            batches = []
+            for job in current_pipeline().batched_poses(jobs):
+                if job.parts != []:
+                    job.collect = collect_refinement_batch
+                batches.append(job)
+            return batches
+
+        def collect_refinement_batch(job): # splits the poses refined by one smina process and collects each of them
+            if not split_poses(job):
+                set_statusline("ERROR : could not split the poses of %s, refining them one by one" % job.name)
+                for part in job.parts:
+                    self.scheduler.submit(part)
+                return
+            for part in job.parts:
+                part.logfile = job.logfile # one log for the poses of the process
+                self.collect_job(part)
+
+        def collect_minimize_job(job): # loads the post-refined pose of a finished smina job
+            if self.form.checkBox_7.isChecked() == True:
+                if os.path.isfile(job.logfile):
+                    with open (job.logfile, 'a') as log_file:
+                        log_file.write(subprocess.list2cmdline(job.command))
+                else:
+                    set_statusline("ERROR : Could not find "+job.logfile)
+            if not os.path.isfile(job.outfile):
+                set_statusline('ERROR : smina failed for %s (%s)' % (job.name, failure_reason(job)))
+                return
+            load_docked(job.outfile)
+            fill_minimized_list(job.outfile)
+
         def minimize():
             if self.current_poses_list == []:
                 set_statusline("ERROR : No poses selected")
@@ -1076,134 +1849,65 @@ class Smina:
                     set_statusline("ERROR : Select post refinement method first")
                     return
                 else :
-                    for i in range(len(self.current_poses_list)):
-                        ligand_name = self.current_poses_list[i]
-                        cmd.save(ligand_name+".pdb", ligand_name) # create file just before use
-                        ligand = os.getcwd()+"\\"+ligand_name
-                        ligand_pdb = ligand+".pdb"
-                        make_ligand_pdbqt(ligand_pdb)
-                        os.remove(ligand_pdb) # cleanup
-                        # check if ligand_file has flexres                    
-                        ligand_pdbqt = ligand+".pdbqt"
-                        with open(ligand_pdbqt, 'r') as file: 
-                            ligand_file = file.readlines()
-                            ligand_flexres = 0
-                            for line in ligand_file:
-                                if 'TORSDOF' in line:
-                                    ligand_flexres = ligand_flexres +1
-                        if ligand_flexres > 1:
-                            delete_ligand_flexres(ligand_pdbqt)
-                        prot = self.form.comboBox.currentText()
-                        if prot == "":
-                            set_statusline("ERROR : No structure selected")
-                            return
-                        else:
-                            receptor = os.getcwd()+"\\"+prot+".pdbqt"
-                            if ( not os.path.isfile(receptor)):
-                                make_receptor_pdbqt(prot)
-                            config = os.getcwd()+"\\"+prot+"_config.txt"
-                            if ( not os.path.isfile(config)): # check presence of smina config file for receptor 
-                                set_statusline('ERROR : Could not find %s_config.txt in current directory' % (prot))
-                                return
-                            config_wsl = "/mnt/c"+config.split(":")[-1].translate(str.maketrans('\\','/','')) # format config path for wsl
-                            receptor_wsl = "/mnt/c"+receptor.split(":")[-1].translate(str.maketrans('\\','/','')) # format receptor path for wsl
-                            ligand_wsl = "/mnt/c"+ligand.split(":")[-1].translate(str.maketrans('\\','/','')) # format ligand path for wsl
-                            smina = "/mnt/c"+self.smina_exe.split(":")[-1] # format smina path for wsl
-                            command = 'call wsl %s -r %s -l %s.pdbqt --config %s ' % (smina, receptor_wsl, ligand_wsl, config_wsl)
-                            if self.form.groupBox_26.isChecked() == True: # custom score table
-                                if self.form.comboBox_6.currentText() == "vina":
-                                    None
-                                else:
-                                    custscrtbl = "/mnt/c"+self.scoring_table_file.split(":")[-1] # format score_table_path for wsl
-                                    command = command+' --custom_scoring %s' % (custscrtbl)
-                            if self.form.groupBox_30.isChecked() == True:
-                                print("running smina for local docking around "+ligand_name+" :")
-                                outfile = ligand+"_localdocked.pdbqt"
-                                outfile_wsl = "/mnt/c"+outfile.split(":")[-1].translate(str.maketrans('\\','/','')) # format outfile path for wsl
-                                autobox_buf = str(self.form.spinBox_3.value())
-                                command = 'call wsl %s -r %s -l %s.pdbqt -o %s --local_only --autobox_ligand %s.pdbqt --autobox_add %s' % (smina, receptor_wsl, ligand_wsl, outfile_wsl, ligand_wsl, autobox_buf) 
-                            if self.form.checkBox_5.isChecked() == True:
-                                print("running smina to randomize pose: "+ligand_name)
-                                outfile = ligand+"_randomize.pdbqt"
-                                outfile_wsl = "/mnt/c"+outfile.split(":")[-1].translate(str.maketrans('\\','/','')) # format outfile path for wsl
-                                command = command+' --randomized_only -o %s ' % (outfile_wsl)
-                            if self.form.checkBox_4.isChecked() == True:
-                                if self.form.checkBox_5.isChecked() == True or self.form.groupBox_30.isChecked() == True: # d'ont change their -out filename
-                                    command = command+' --minimize '
-                                else:
-                                    print("running smina to minimize pose: "+ligand_name)
-                                    outfile = ligand+"_minimized.pdbqt"
-                                    outfile_wsl = "/mnt/c"+outfile.split(":")[-1].translate(str.maketrans('\\','/','')) # format outfile path for wsl
-                                    command = command+' --minimize -o %s ' % (outfile_wsl)
-                                approx_method = self.form.comboBox_8.currentText()
-                                command = command+' --approximation %s ' % (approx_method)
-                                if self.form.checkBox_3.isChecked() == True:
-                                    command = command+' --accurate_line '
-                                if self.form.checkBox_6.isChecked() == True:
-                                    command = command+' --minimize_early_term '
-                                if self.form.groupBox_31.isChecked() == True:
-                                    minim_steps = str(self.form.spinBox_7.value())
-                                    command = command+' --minimize_iters %s ' % (minim_steps)
-                                if self.form.groupBox_33.isChecked() == True:
-                                    aprox_factor = str(self.form.spinBox_8.value())
-                                    command = command+' --factor %s ' % (aprox_factor)
-                                if self.form.groupBox_32.isChecked() == True:
-                                    force_cap = str(self.form.spinBox_9.value())
-                                    command = command+' --force_cap %s ' % (force_cap)
-                            if self.form.checkBox.isChecked() == True: # write smina Logfile
-                                logfile = outfile.split(".")[0]+'.log'
-                                logfile_wsl = "/mnt/c"+logfile.split(":")[-1].translate(str.maketrans('\\','/','')) # format outfile path for wsl
-                                command = command+' --log %s' % (logfile_wsl)
-                        # print(command)
-                        os.system(command)
-                        if self.form.checkBox_7.isChecked() == True:
-                            if os.path.isfile(logfile):
-                                with open (logfile, 'a') as log_file:
-                                    log_file.write(command)
-                            else:
-                                set_statusline("ERROR : Could not find "+logfile)
-                        load_docked(outfile)
-                        fill_minimized_list(outfile)
+                    if self.form.comboBox.currentText() == "":
+                        set_statusline("ERROR : No structure selected")
+                        return
+                    pose_files = []
+                    for ligand_name in self.current_poses_list:
+                        ligand = os.path.join(os.getcwd(), ligand_name)
+                        cmd.save(ligand+".pdb", ligand_name) # create file just before use
+                        if os.path.isfile(ligand+".pdbqt"): # outdated
+                            os.remove(ligand+".pdbqt")
+                        pose_files.append(ligand+".pdb")
+                    prepare_receptors([self.form.comboBox.currentText()],
+                        lambda: convert_ligands(pose_files, refine_poses)) # all poses with a few openbabel processes
+
+        def refine_poses():
+            report_conversion()
+            jobs = []
+            for ligand_name in self.current_poses_list:
+                ligand = os.path.join(os.getcwd(), ligand_name)
+                if os.path.isfile(ligand+".pdb"):
+                    os.remove(ligand+".pdb") # cleanup
+                if not os.path.isfile(ligand+".pdbqt"):
+                    continue # conversion failed
+                job = prepare_minimize_job(ligand_name)
+                if job is None:
+                    return
+                jobs.append(job)
+            run_smina_jobs(refinement_batch_jobs(jobs), collect_minimize_job)
+
+        def prepare_score_job(ligand_name): # builds the --score_only command of one converted pose without running it
+            return current_pipeline().score_job(os.path.join(os.getcwd(), ligand_name))
+
+        def collect_score_job(job): # prints the affinity of a scored pose
+            if not os.path.isfile(job.outfile):
+                set_statusline('ERROR : smina failed for %s (%s)' % (job.name, failure_reason(job)))
+                return
+            result = parse_pdbqt(job.outfile)
+            for affinity in result.affinities:
+                print("Affinty for %s : %g" % (job.name, affinity))
 
         def score_poses():
-            for i in range(len(self.current_poses_list)):
-                if not os.path.isfile(os.getcwd()+"\\"+self.current_poses_list[i]+".pdbqt"):
-                    ligand = os.getcwd()+"\\"+self.current_poses_list[i]+".pdb"
-                    make_ligand_pdbqt(ligand)
-                prot = self.form.comboBox.currentText()
-                if prot == "":
-                    set_statusline("ERROR : No structure selected")
-                else:
-                    receptor = os.getcwd()+"\\"+prot+".pdbqt"
-                    if ( not os.path.isfile(receptor)):
-                        make_receptor_pdbqt(prot)
-                    outfile = os.getcwd()+"\\"+self.current_poses_list[i]+"_scored.pdbqt"
-                    ligand = os.getcwd()+"\\"+self.current_poses_list[i]
-                    ligand_name = self.current_poses_list[i]
-                    if self.form.groupBox_15.isChecked() == True: # add suffix to outfile
-                        outfile = outfile.split(".")[0]+"_"+self.form.lineEdit_7.text()+".pdbqt"
-                    print("running smina to score pose "+ligand_name+" :")
-                    smina = "/mnt/c"+self.smina_exe.split(":")[-1] # format smina path for wsl
-                    receptor_wsl = "/mnt/c"+receptor.split(":")[-1].translate(str.maketrans('\\','/','')) # format receptor path for wsl
-                    ligand_wsl = "/mnt/c"+ligand.split(":")[-1].translate(str.maketrans('\\','/','')) # format ligand path for wsl
-                    outfile_wsl = "/mnt/c"+outfile.split(":")[-1].translate(str.maketrans('\\','/','')) # format outfile path for wsl
-                    command = 'call wsl %s -r %s -l %s.pdbqt --score_only -o %s' % (smina, receptor_wsl, ligand_wsl, outfile_wsl)
-                    if self.form.groupBox_26.isChecked() == True: # custom score table
-                            if self.form.comboBox_6.currentText() == "vina":
-                                None
-                            else:
-                                custscrtbl = "/mnt/c"+self.scoring_table_file.split(":")[-1] # format score_table_path for wsl
-                                command = command+' --custom_scoring %s' % (custscrtbl)
-                    # print(command)
-                    os.system(command)
-                    lst = []
-                    with open(outfile, 'r') as f:
-                        lst = f.readlines()
-                        for line in lst:
-                            if 'minimizedAffinity' in line:
-                                modE = line.strip('REMAK minzedAfty\n') 
-                                print("Affinty for "+ligand_name+" : "+modE)
-                    time.sleep(2) # to let the results be printed
+            if self.form.comboBox.currentText() == "":
+                set_statusline("ERROR : No structure selected")
+                return
+            missing = []
+            for ligand_name in self.current_poses_list:
+                ligand = os.path.join(os.getcwd(), ligand_name)
+                if not os.path.isfile(ligand+".pdbqt"):
+                    missing.append(ligand+".pdb")
+            prepare_receptors([self.form.comboBox.currentText()],
+                lambda: convert_ligands(missing, score_converted_poses) if missing != [] else score_converted_poses())
+
+        def score_converted_poses():
+            report_conversion()
+            jobs = []
+            for ligand_name in self.current_poses_list:
+                if not os.path.isfile(os.path.join(os.getcwd(), ligand_name+".pdbqt")):
+                    continue # conversion failed
+                jobs.append(prepare_score_job(ligand_name))
+            run_smina_jobs(refinement_batch_jobs(jobs), collect_score_job)
             
         def load_pose(): # (from anywhere)
             loaded_poses_list=[]
@@ -1264,11 +1968,15 @@ class Smina:
                 cmd.load(filename)
             else:
                 filename = outfile
-            lst = open(filename, 'r').readlines()
+            try:
+                result = parse_pdbqt(filename)
+            except (OSError, ValueError): # missing or truncated smina output
+                result = None
+            if result is None or len(result.affinities) == 0:
+                set_statusline('ERROR : no minimized affinity in %s' % filename)
+                return
             ligand_name = filename.translate(str.maketrans('\\','/','')).rsplit('/', 1)[-1].split('.')[0] #  complete name
-            for line in lst:
-                if 'minimizedAffinity' in line:
-                    modE = line.strip('REMAK minzedAfty\n') 
+            modE = "%g" % result.affinities[-1]
             new_row_number = self.form.tableWidget.rowCount()
             self.form.tableWidget.insertRow(new_row_number)
             check = QtWidgets.QTableWidgetItem("[X]")
@@ -1318,12 +2026,13 @@ class Smina:
         format_minimized_list()
                 
         # callback bindings
-        self.form.doubleSpinBox.valueChanged.connect(calculate_Box)
-        self.form.doubleSpinBox_2.valueChanged.connect(calculate_Box)
-        self.form.doubleSpinBox_3.valueChanged.connect(calculate_Box)
-        self.form.spinBox_4.valueChanged.connect(calculate_Box)
-        self.form.spinBox_5.valueChanged.connect(calculate_Box)
-        self.form.spinBox_6.valueChanged.connect(calculate_Box)
+        self.form.doubleSpinBox.valueChanged.connect(schedule_Box)
+        self.form.doubleSpinBox_2.valueChanged.connect(schedule_Box)
+        self.form.doubleSpinBox_3.valueChanged.connect(schedule_Box)
+        self.form.spinBox_4.valueChanged.connect(schedule_Box)
+        self.form.spinBox_5.valueChanged.connect(schedule_Box)
+        self.form.spinBox_6.valueChanged.connect(schedule_Box)
+        self.box_timer.timeout.connect(calculate_Box)
         self.form.comboBox_3.currentIndexChanged.connect(set_Receptor)
         self.form.lineEdit_5.returnPressed.connect(Boxcenter_on_selection)
         self.form.comboBox_4.currentIndexChanged.connect(import_ligands)
@@ -1332,8 +2041,10 @@ class Smina:
         self.form.comboBox_6.currentIndexChanged.connect(change_current_score_table)
         self.form.comboBox_7.currentIndexChanged.connect(select_scoring_table)
         self.scoring_table_dir_location.textChanged.connect(show_scoring_tables)
-        self.ligand_dir_location.textChanged.connect(import_ligands)
         self.form.checkBox_2.stateChanged.connect(show_current_poses)
+        self.form.groupBox_41.toggled.connect(show_current_poses)
+        self.form.doubleSpinBox_7.valueChanged.connect(show_current_poses)
+        self.job_timer.timeout.connect(poll_smina_jobs)
         self.Buttongroup_1.buttonClicked.connect(synchronize_Radiobuttons_2)
         self.Buttongroup_2.buttonClicked.connect(synchronize_Radiobuttons_1)
          
@@ -1372,8 +2083,153 @@ class Smina:
         self.form.pushButton_26.clicked.connect(get_minimized_file)
         self.form.pushButton_27.clicked.connect(export_current_minimization_results)
         self.form.pushButton_28.clicked.connect(export_minimization_pdbs)
+        self.form.pushButton_29.clicked.connect(cancel_smina_jobs)
+        self.form.pushButton_30.clicked.connect(add_all_ligands)
+        self.form.pushButton_31.clicked.connect(add_library)
+        self.form.pushButton_40.clicked.connect(add_matching_ligands)
+        self.form.pushButton_32.clicked.connect(show_all_results)
+        self.form.pushButton_33.clicked.connect(load_result_poses)
+        self.form.pushButton_34.clicked.connect(rescore_results)
+        self.form.pushButton_35.clicked.connect(fit_Box_selection)
+        self.form.pushButton_36.clicked.connect(fit_Box_sites)
+        self.form.pushButton_37.clicked.connect(find_receptor_pockets)
+        self.form.pushButton_38.clicked.connect(stop_screen)
+        self.form.pushButton_39.clicked.connect(refine_hits)
+        self.form.lineEdit_9.returnPressed.connect(show_all_results)
+        self.form.tableView_2.doubleClicked.connect(load_result_poses)
+        self.form.tableWidget_2.setColumnCount(4)
+        self.form.tableWidget_2.setHorizontalHeaderLabels(["Ligand", "Affinity", "Receptor", "Model"])
+        self.form.tableWidget_2.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.form.tableWidget_2.setEditTriggers(QtWidgets.QTableWidget.NoEditTriggers)
+        self.form.tableView_2.setSortingEnabled(True)
+        self.form.tableView_2.verticalHeader().setDefaultSectionSize(20) # fixed row height, the view never measures rows
         # ----------------------------------------------
 
+def residue_selection(site): # "resi 12+7" for a residue list like ARG12,TYR7, None for anything else
+    # the comma only separates residues, a pattern with optional parts repeated would backtrack exponentially on a typo
+    site = site.replace(" ", "")
+    if re.fullmatch(r'[A-Z]*-?\d+[A-Z]?(,[A-Z]*-?\d+[A-Z]?)*,?', site) is None:
+        return None
+    return "resi "+"+".join(re.sub(r'^[A-Z]+', '', residue) for residue in site.split(",") if residue != "")
+
+def fit_box(coords, padding=4.0): # center and whole edge lengths of the box around the atoms, padding added on each side
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    low = coords.min(axis=0)
+    high = coords.max(axis=0)
+    center = (low+high)/2. # middle of the extents, the box holds every atom
+    size = np.ceil(high-low+2*padding).astype(int)
+    return center.round(3).tolist(), size.tolist()
+
+def write_box_config(filename, center, size): # smina box file, key = value lines
+    config = {'center_x': center[0], 'center_y': center[1], 'center_z': center[2],
+        'size_x': size[0], 'size_y': size[1], 'size_z': size[2]}
+    with open(filename, 'w') as fp:
+        for key, val in config.items():
+            print(key, '=', val, file=fp)
+    return config
+
+pocket_directions = ((1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 1), (1, 1, -1), (1, -1, 1), (-1, 1, 1))
+
+def shift_grid(grid, direction, k, fill=False): # grid moved by k cells along direction, cells moved in are fill
+    shifted = np.full_like(grid, fill)
+    target = []
+    source = []
+    for d in direction:
+        step = d*k
+        if step > 0:
+            target.append(slice(step, None))
+            source.append(slice(None, -step))
+        elif step < 0:
+            target.append(slice(None, step))
+            source.append(slice(-step, None))
+        else:
+            target.append(slice(None))
+            source.append(slice(None))
+    shifted[tuple(target)] = grid[tuple(source)]
+    return shifted
+
+def enclosed(occupied, direction): # cells with protein on both sides along direction
+    before = occupied.copy()
+    after = occupied.copy()
+    k = 1
+    while k < max(occupied.shape): # prefix or by doubling the shift
+        before |= shift_grid(before, direction, k)
+        after |= shift_grid(after, direction, -k)
+        k = k*2
+    return before & after
+
+def find_pockets(coords, spacing=1.0, atom_radius=1.8, min_buriedness=6, min_volume=30.0):
+    # cavities of a receptor on a grid (ligsite) : empty cells enclosed by protein in most of 7 directions,
+    # connected cells are one pocket. Returns (cell coordinates, buriedness) of each pocket, the largest first
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    margin = atom_radius+2*spacing
+    origin = coords.min(axis=0)-margin
+    shape = tuple(np.ceil((coords.max(axis=0)+margin-origin)/spacing).astype(int)+1)
+    occupied = np.zeros(shape, dtype=bool)
+    r = int(np.ceil(atom_radius/spacing))
+    stencil = np.array([(i, j, k) for i in range(-r, r+1) for j in range(-r, r+1) for k in range(-r, r+1)
+        if (i*i+j*j+k*k)*spacing**2 <= atom_radius**2])
+    cells = (np.round((coords-origin)/spacing).astype(int)[:, None, :]+stencil[None, :, :]).reshape(-1, 3)
+    occupied[cells[:, 0], cells[:, 1], cells[:, 2]] = True
+    buriedness = np.zeros(shape, dtype=np.int8)
+    for direction in pocket_directions:
+        buriedness += enclosed(occupied, direction)
+    pocket = (buriedness >= min_buriedness) & ~occupied
+    # connected cells get the smallest index among them
+    none = pocket.size
+    labels = np.where(pocket, np.arange(pocket.size).reshape(shape), none)
+    while True:
+        smallest = labels
+        for direction in ((1, 0, 0), (0, 1, 0), (0, 0, 1)):
+            for k in (1, -1):
+                smallest = np.minimum(smallest, shift_grid(labels, direction, k, none))
+        smallest = np.where(pocket, smallest, none)
+        if np.array_equal(smallest, labels):
+            break
+        labels = smallest
+    found, inverse, counts = np.unique(labels[pocket], return_inverse=True, return_counts=True)
+    points = origin+np.argwhere(pocket)*spacing # same order as labels[pocket]
+    depths = buriedness[pocket]
+    pockets = []
+    for index in np.argsort(-counts, kind='stable'):
+        if counts[index]*spacing**3 < min_volume:
+            break
+        members = inverse == index
+        pockets.append((points[members], depths[members]))
+    return pockets
+
+def find_pocket_boxes(objects="", top=5, padding=4, spacing=1.0):
+    '''
+DESCRIPTION
+
+    Finds the cavities of receptor objects on a grid and writes a box
+    around each of the largest as <object>_pocketN_config.txt in the
+    current directory, pocket 1 being the largest.
+
+USAGE
+
+    smina_find_pockets [objects [, top [, padding [, spacing]]]]
+
+    objects : space separated object names, default : all objects
+
+    Returns a dictionary object -> [(center, size, volume), ...] of the
+    pockets of each object with atoms, the largest first.
+    '''
+    names = objects.split() or cmd.get_names("objects")
+    boxes = {}
+    for name in names:
+        coords = cmd.get_coords("(%s) and not hydro" % name, 1)
+        if coords is None or len(coords) == 0:
+            print("No atoms in %s" % name)
+            continue
+        boxes[name] = []
+        for i, (points, depths) in enumerate(find_pockets(coords, float(spacing))[:int(top)]):
+            center, size = fit_box(points, float(padding))
+            write_box_config(name+"_pocket%s_config.txt" % (i+1), center, size)
+            boxes[name].append((center, size, len(points)*float(spacing)**3))
+        print("%s : %s pockets, volumes %s" % (name, len(boxes[name]), ", ".join("%.0f" % box[2] for box in boxes[name])))
+    return boxes
+
 class ScoringTableModel(QtCore.QAbstractTableModel):
     
     def __init__(self, datain, parent=None):
@@ -1401,6 +2257,121 @@ class ScoringTableModel(QtCore.QAbstractTableModel):
             else:
                 return str(section)
 
+class ResultsTableModel(QtCore.QAbstractTableModel):
+    '''
+    Read-only view of the results store, rows are fetched page by page
+    when the view shows them so that screens with millions of poses scroll smoothly
+    '''
+
+    page_size = 256
+    max_pages = 64
+
+    def __init__(self, store, parent=None):
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.store = store
+        self.best_only = False # one row per ligand with its best pose
+        self.filters = {}
+        self.order = 'affinity'
+        self.descending = False
+        self.pages = {}
+        self.total = 0
+        self.set_columns()
+        self.refresh()
+
+    def set_columns(self):
+        if self.best_only:
+            self._header = ['Ligand', 'Best affinity', 'Poses']
+            self._keys = ['ligand', 'best', 'poses']
+        else:
+            self._header = ['Ligand', 'Model', 'Affinity', 'rmsd l.b.', 'rmsd u.b.', 'Receptor', 'Rescored']
+            self._keys = ResultsStore.columns[:7]
+
+    def set_filters(self, best_only=False, **filters):
+        self.beginResetModel()
+        if best_only != self.best_only:
+            self.best_only = best_only
+            self.order = 'best' if best_only else 'affinity'
+            self.descending = False
+            self.set_columns()
+        self.filters = filters
+        self.reload()
+        self.endResetModel()
+
+    def refresh(self): # new poses have been stored
+        self.beginResetModel()
+        self.reload()
+        self.endResetModel()
+
+    def reload(self):
+        self.pages = {}
+        if self.best_only:
+            self.total = self.store.ligand_count(**self.filters)
+        else:
+            self.total = self.store.count(**self.filters)
+
+    def page(self, number):
+        if number not in self.pages:
+            if len(self.pages) >= self.max_pages: # forget the page fetched first
+                del self.pages[next(iter(self.pages))]
+            if self.best_only:
+                self.pages[number] = self.store.best_per_ligand(self.page_size, number*self.page_size,
+                    self.order, self.descending, **self.filters)
+            else:
+                after = None
+                if number-1 in self.pages and len(self.pages[number-1]) == self.page_size: # scrolling down
+                    last = self.pages[number-1][-1]
+                    after = (last[self._keys.index(self.order)], last[-1])
+                self.pages[number] = self.store.poses(self.page_size, number*self.page_size,
+                    self.order, self.descending, after, **self.filters)
+        return self.pages[number]
+
+    def row(self, row): # full record of a row
+        rows = self.page(row // self.page_size)
+        if row % self.page_size >= len(rows):
+            return None
+        return rows[row % self.page_size]
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.total
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._header)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.TextAlignmentRole:
+            return QtCore.Qt.AlignCenter
+        elif role != QtCore.Qt.DisplayRole:
+            return None
+        record = self.row(index.row())
+        if record is None:
+            return None
+        value = record[index.column()]
+        if value is None:
+            return ""
+        elif isinstance(value, float):
+            return "%g" % value
+        return str(value)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole:
+            if orientation == QtCore.Qt.Horizontal:
+                return self._header[section]
+            else:
+                return str(section+1)
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder): # sorting is done by sqlite
+        self.beginResetModel()
+        self.order = self._keys[column]
+        self.descending = order == QtCore.Qt.DescendingOrder
+        self.pages = {}
+        self.endResetModel()
+
 class Editor(QtWidgets.QDialog):
 
     def __init__(self, data, scoring_table_dir_path, selected_scoring_table, parent=None):
@@ -1448,5 +2419,2119 @@ class Editor(QtWidgets.QDialog):
     def edit_delete_row(self):
         row = self.scoring_table.currentRow()
         self.scoring_table.removeRow(row)
-        print("Editor deleted row: ", row)    
-        
+        print("Editor deleted row: ", row)
+
+class ReceptorCache:
+    '''
+    Receptor .pdbqt files prepared by openbabel, stored under a hash of the
+    saved atoms of the receptor and of the conversion options
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, pdb_file, options):
+        digest = hashlib.sha1(options.encode())
+        with open(pdb_file, 'rb') as f:
+            for line in f:
+                if line.startswith((b'ATOM', b'HETATM')): # ignore headers pymol may change
+                    digest.update(line)
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        cached = os.path.join(self.cache_dir, key+".pdbqt")
+        if os.path.isfile(cached):
+            return cached
+        return None
+
+    def store(self, key, pdbqt_file):
+        shutil.copyfile(pdbqt_file, os.path.join(self.cache_dir, key+".pdbqt"))
+
+class LigandLibrary:
+    '''
+    Multi-molecule .sdf or .pdbqt file read record by record, so that the
+    memory used does not depend on the size of the library
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.base, self.file_type = os.path.basename(filename).rsplit(".", 1)
+        self.file_type = self.file_type.lower()
+
+    def record_name(self, title, index): # unique and usable as a file name
+        title = re.sub(r'[^A-Za-z0-9_-]+', '_', title.strip())[:40].strip('_')
+        return "%s_%s" % (title or self.base, index)
+
+    def records(self): # yields (name, text) of each molecule
+        index = 0
+        lines = []
+        title = ""
+        in_model = False
+        with open(self.filename, 'r', errors='replace') as f:
+            for line in f:
+                if self.file_type == "sdf":
+                    lines.append(line)
+                    if line.startswith('$$$$'):
+                        index = index + 1
+                        yield self.record_name(lines[0], index), ''.join(lines)
+                        lines = []
+                    continue
+                if line.startswith('MODEL'):
+                    in_model = True
+                    continue
+                if line.startswith('REMARK') and 'Name =' in line:
+                    title = line.split('=', 1)[1]
+                if line.startswith('ENDMDL') or (line.startswith('TORSDOF') and not in_model):
+                    if not in_model:
+                        lines.append(line)
+                    index = index + 1
+                    yield self.record_name(title, index), ''.join(lines)
+                    lines = []
+                    title = ""
+                    in_model = False
+                    continue
+                lines.append(line)
+        if ''.join(lines).strip() != "": # last record without terminator
+            index = index + 1
+            if self.file_type == "sdf":
+                title = lines[0]
+            yield self.record_name(title, index), ''.join(lines)
+
+    def chunks(self, size): # yields lists of at most size records
+        chunk = []
+        for record in self.records():
+            chunk.append(record)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk != []:
+            yield chunk
+
+def count_rotatable_bonds(elements, bonds): # single bonds between two heavy atoms with other heavy neighbours, outside rings
+    # amide bonds are counted, so the count can be higher than the TORSDOF openbabel writes
+    neighbours = {}
+    for a, b, order in bonds:
+        if elements.get(a, 'H') != 'H' and elements.get(b, 'H') != 'H':
+            neighbours.setdefault(a, set()).add(b)
+            neighbours.setdefault(b, set()).add(a)
+    count = 0
+    for a, b, order in bonds:
+        if order != 1 or len(neighbours.get(a, ())) < 2 or len(neighbours.get(b, ())) < 2:
+            continue
+        seen = {a}
+        todo = [n for n in neighbours[a] if n != b]
+        while todo and b not in seen: # b reached from a without the bond : ring bond
+            atom = todo.pop()
+            if atom not in seen:
+                seen.add(atom)
+                todo.extend(neighbours[atom]-seen)
+        if b not in seen:
+            count = count+1
+    return count
+
+def describe_ligand(filename, file_type): # (heavy atoms, rotatable bonds or None) of the first molecule of a ligand file
+    heavy_atoms = 0
+    rotatable_bonds = None
+    with open(filename, 'r', errors='replace') as f:
+        if file_type == "sdf":
+            lines = [f.readline() for i in range(4)]
+            try:
+                atoms, bonds = int(lines[3][0:3]), int(lines[3][3:6])
+            except ValueError:
+                return None, None
+            elements = {}
+            for i in range(atoms):
+                elements[i+1] = f.readline()[31:34].strip()
+            bond_list = []
+            for i in range(bonds):
+                line = f.readline()
+                try:
+                    bond_list.append((int(line[0:3]), int(line[3:6]), int(line[6:9])))
+                except ValueError:
+                    break
+            return sum(1 for element in elements.values() if element != 'H'), count_rotatable_bonds(elements, bond_list)
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                if file_type == "pdbqt":
+                    element = line[77:79].strip()
+                else:
+                    element = line[76:78].strip() or line[12:16].strip()[:1]
+                if element.upper() not in ('H', 'HD'):
+                    heavy_atoms = heavy_atoms+1
+            elif line.startswith('TORSDOF'):
+                rotatable_bonds = int(line.split()[1])
+                break
+            elif line.startswith(('ENDMDL', 'END ')) or line.strip() == 'END':
+                break
+    return heavy_atoms, rotatable_bonds
+
+class LigandIndex:
+    '''
+    Ligand files of the ligand directories with their format, heavy atoms,
+    rotatable bonds and .pdbqt status in an sqlite database, rescanned by
+    modification time so that only new or changed files are read again
+    '''
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS ligands (
+            path TEXT PRIMARY KEY,
+            directory TEXT NOT NULL,
+            name TEXT NOT NULL,
+            format TEXT NOT NULL,
+            mtime REAL,
+            heavy_atoms INTEGER,
+            rotatable_bonds INTEGER,
+            pdbqt_ready INTEGER);
+        CREATE INDEX IF NOT EXISTS ligands_name ON ligands (directory, format, name);
+        CREATE INDEX IF NOT EXISTS ligands_heavy_atoms ON ligands (directory, heavy_atoms);
+        """
+    formats = ['pdbqt', 'pdb', 'sdf']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.schema)
+
+    def scan(self, directory): # (files read again, files removed) since the last scan of the directory
+        directory = os.path.abspath(directory)
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if "." in entry.name and entry.name.rsplit(".", 1)[1].lower() in self.formats and entry.is_file():
+                    files[entry.path] = entry.stat().st_mtime
+        known = dict(self.connection.execute('SELECT path, mtime FROM ligands WHERE directory = ?', (directory,)))
+        changed = [path for path, mtime in files.items() if known.get(path) != mtime]
+        removed = [path for path in known if path not in files]
+        rows = []
+        for path in changed:
+            name, file_type = os.path.basename(path).rsplit(".", 1)
+            try:
+                heavy_atoms, rotatable_bonds = describe_ligand(path, file_type.lower())
+            except (OSError, ValueError, IndexError):
+                heavy_atoms, rotatable_bonds = None, None
+            rows.append((path, directory, name, file_type.lower(), files[path], heavy_atoms, rotatable_bonds))
+        with self.connection: # one transaction, the .pdbqt status follows files added or removed next to the ligand
+            self.connection.executemany('DELETE FROM ligands WHERE path = ?', [(path,) for path in removed])
+            self.connection.executemany('INSERT OR REPLACE INTO ligands (path, directory, name, format, mtime, heavy_atoms, rotatable_bonds)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            if changed != [] or removed != []:
+                self.connection.execute('UPDATE ligands SET pdbqt_ready = (format = \'pdbqt\' OR EXISTS (SELECT 1 FROM ligands AS ready'
+                    ' WHERE ready.directory = ligands.directory AND ready.name = ligands.name AND ready.format = \'pdbqt\')) WHERE directory = ?',
+                    (directory,))
+        return len(changed), len(removed)
+
+    def where(self, directory, name=None, file_type=None, max_heavy_atoms=None, max_rotatable_bonds=None, pdbqt_ready=None):
+        clauses = ['directory = ?']
+        values = [os.path.abspath(directory)]
+        if name:
+            clauses.append('name LIKE ?')
+            values.append(name.replace('*', '%'))
+        if file_type:
+            clauses.append('format = ?')
+            values.append(file_type)
+        if max_heavy_atoms is not None:
+            clauses.append('heavy_atoms <= ?')
+            values.append(max_heavy_atoms)
+        if max_rotatable_bonds is not None:
+            clauses.append('rotatable_bonds <= ?')
+            values.append(max_rotatable_bonds)
+        if pdbqt_ready:
+            clauses.append('pdbqt_ready = 1')
+        return ' WHERE '+' AND '.join(clauses), values
+
+    def names(self, directory, **filters): # ligand names without extension, one per ligand of several formats
+        where, values = self.where(directory, **filters)
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT name FROM ligands%s ORDER BY name' % where, values)]
+
+    def ligands(self, directory, **filters): # (name, format, heavy atoms, rotatable bonds, pdbqt ready) rows
+        where, values = self.where(directory, **filters)
+        return self.connection.execute('SELECT name, format, heavy_atoms, rotatable_bonds, pdbqt_ready FROM ligands%s ORDER BY name, format'
+            % where, values).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+class ResultsStore:
+    '''
+    Poses of all docking runs of a working directory in an indexed sqlite
+    database, for ranking and paging through large screens
+    '''
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS poses (
+            id INTEGER PRIMARY KEY,
+            ligand TEXT NOT NULL,
+            model INTEGER NOT NULL,
+            affinity REAL,
+            rmsd_lb REAL,
+            rmsd_ub REAL,
+            receptor TEXT,
+            params_hash TEXT,
+            outfile TEXT,
+            flexres TEXT,
+            rescored REAL);
+        CREATE INDEX IF NOT EXISTS poses_affinity ON poses (affinity);
+        CREATE INDEX IF NOT EXISTS poses_ligand ON poses (ligand, affinity);
+        CREATE INDEX IF NOT EXISTS poses_receptor ON poses (receptor, affinity);
+        CREATE INDEX IF NOT EXISTS poses_params ON poses (params_hash, affinity);
+        CREATE INDEX IF NOT EXISTS poses_outfile ON poses (outfile);
+        CREATE TABLE IF NOT EXISTS jobs (
+            outfile TEXT PRIMARY KEY,
+            ligand TEXT,
+            params_hash TEXT,
+            state TEXT,
+            mtime REAL,
+            size INTEGER);
+        CREATE TABLE IF NOT EXISTS terms (
+            pose INTEGER,
+            term_set TEXT,
+            num_tors INTEGER,
+            term_values BLOB,
+            PRIMARY KEY (pose, term_set));
+        CREATE TABLE IF NOT EXISTS timings (
+            id INTEGER PRIMARY KEY,
+            torsions INTEGER,
+            heavy_atoms INTEGER,
+            volume REAL,
+            exhaustiveness INTEGER,
+            flexres INTEGER,
+            cpu INTEGER,
+            seconds REAL);
+        """
+    columns = ['ligand', 'model', 'affinity', 'rmsd_lb', 'rmsd_ub', 'receptor', 'rescored', 'params_hash', 'outfile']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.schema)
+        existing = [column[1] for column in self.connection.execute('PRAGMA table_info(poses)')]
+        for column, column_type in (('flexres', 'TEXT'), ('rescored', 'REAL')):
+            if column not in existing: # older database
+                with self.connection:
+                    self.connection.execute('ALTER TABLE poses ADD COLUMN %s %s' % (column, column_type))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS poses_rescored ON poses (rescored)')
+
+    def add_poses(self, ligand, receptor, params_hash, outfile, poses): # poses : (model, affinity, rmsd_lb, rmsd_ub, flexres)
+        with self.connection: # one transaction, a docking written again replaces its old poses
+            self.connection.execute('DELETE FROM terms WHERE pose IN (SELECT id FROM poses WHERE outfile = ?)', (outfile,))
+            self.connection.execute('DELETE FROM poses WHERE outfile = ?', (outfile,))
+            self.connection.executemany('INSERT INTO poses (ligand, model, affinity, rmsd_lb, rmsd_ub, receptor, params_hash, outfile, flexres)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(ligand, model, affinity, rmsd_lb, rmsd_ub, receptor, params_hash, outfile, flexres)
+                    for model, affinity, rmsd_lb, rmsd_ub, flexres in poses])
+
+    def flexres(self, outfile, model): # flexible residues of a pose as pdbqt records
+        row = self.connection.execute('SELECT flexres FROM poses WHERE outfile = ? AND model = ?', (outfile, model)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def where(self, ligand=None, receptor=None, params_hash=None, max_affinity=None):
+        clauses = []
+        values = []
+        if ligand:
+            clauses.append('ligand LIKE ?')
+            values.append(ligand.replace('*', '%'))
+        if receptor:
+            clauses.append('receptor = ?')
+            values.append(receptor)
+        if params_hash:
+            clauses.append('params_hash = ?')
+            values.append(params_hash)
+        if max_affinity is not None:
+            clauses.append('affinity <= ?')
+            values.append(max_affinity)
+        if clauses == []:
+            return '', values
+        return ' WHERE '+' AND '.join(clauses), values
+
+    def poses(self, limit=100, offset=0, order='affinity', descending=False, after=None, **filters): # best poses first
+        # rows end with the pose id, after = (order value, id) of the last row of the previous page
+        # continues from there through the index instead of skipping offset rows
+        # poses without a value (not rescored, no rmsd) come last in both directions
+        if order not in self.columns:
+            order = 'affinity'
+        direction = 'DESC' if descending else 'ASC'
+        compare = '<' if descending else '>'
+        where, values = self.where(**filters)
+        if after is not None:
+            if after[0] is None: # among the poses without a value
+                clause = '%s IS NULL AND id %s ?' % (order, compare)
+                values = values+[after[1]]
+            else:
+                clause = '(%s IS NULL OR (%s, id) %s (?, ?))' % (order, order, compare)
+                values = values+list(after)
+            where = where+(' AND ' if where else ' WHERE ')+clause
+            offset = 0
+        query = 'SELECT %s, id FROM poses%s ORDER BY (%s IS NULL), %s %s, id %s LIMIT ? OFFSET ?' % (', '.join(self.columns), where,
+            order, order, direction, direction)
+        return self.connection.execute(query, values+[limit, offset]).fetchall()
+
+    def count(self, **filters):
+        where, values = self.where(**filters)
+        return self.connection.execute('SELECT COUNT(*) FROM poses'+where, values).fetchone()[0]
+
+    def best_per_ligand(self, limit=100, offset=0, order='best', descending=False, **filters):
+        # (ligand, best affinity, number of poses, model, outfile), sqlite takes model and outfile from the best pose
+        if order not in ('ligand', 'best', 'poses'):
+            order = 'best'
+        where, values = self.where(**filters)
+        query = 'SELECT ligand, MIN(affinity) AS best, COUNT(*) AS poses, model, outfile FROM poses%s GROUP BY ligand ORDER BY %s %s LIMIT ? OFFSET ?' % (where,
+            order, 'DESC' if descending else 'ASC')
+        return self.connection.execute(query, values+[limit, offset]).fetchall()
+
+    def ligand_count(self, **filters):
+        where, values = self.where(**filters)
+        return self.connection.execute('SELECT COUNT(DISTINCT ligand) FROM poses'+where, values).fetchone()[0]
+
+    def ensemble_best(self, members): # ligand -> receptor -> (best affinity, model, outfile) for the (receptor, params_hash) members
+        if members == []:
+            return {}
+        where = ' OR '.join(['(receptor = ? AND params_hash = ?)']*len(members))
+        values = [value for member in members for value in member]
+        best = {}
+        for ligand, receptor, affinity, model, outfile in self.connection.execute(
+                'SELECT ligand, receptor, MIN(affinity), model, outfile FROM poses WHERE %s GROUP BY ligand, receptor' % where, values):
+            if affinity is not None:
+                best.setdefault(ligand, {})[receptor] = (affinity, model, outfile)
+        return best
+
+    # scoring terms : the raw term values of each pose are computed once per set of terms, other weights only need numpy
+
+    def missing_terms(self, term_set): # (receptor, outfile) of the poses without values for these terms
+        return self.connection.execute('SELECT DISTINCT receptor, outfile FROM poses WHERE id NOT IN'
+            ' (SELECT pose FROM terms WHERE term_set = ?) ORDER BY receptor, outfile', (term_set,)).fetchall()
+
+    def add_terms(self, outfile, term_set, terms): # terms : (model, num_tors, term values)
+        ids = dict(self.connection.execute('SELECT model, id FROM poses WHERE outfile = ?', (outfile,)).fetchall())
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO terms (pose, term_set, num_tors, term_values) VALUES (?, ?, ?, ?)',
+                [(ids[model], term_set, num_tors, np.asarray(values, dtype=np.float64).tobytes())
+                    for model, num_tors, values in terms if model in ids])
+
+    def term_matrix(self, term_set): # pose ids, torsions and the (poses, terms) array of the term values
+        rows = self.connection.execute('SELECT pose, num_tors, term_values FROM terms WHERE term_set = ? ORDER BY pose',
+            (term_set,)).fetchall()
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        num_tors = np.array([row[1] for row in rows], dtype=np.float64)
+        values = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.float64).reshape(len(rows), len(term_set.split("\n")))
+        return ids, num_tors, values
+
+    def set_rescored(self, ids, affinities):
+        with self.connection:
+            self.connection.execute('UPDATE poses SET rescored = NULL')
+            self.connection.executemany('UPDATE poses SET rescored = ? WHERE id = ?', zip(affinities.tolist(), ids.tolist()))
+
+    # job journal : a multirun started again skips the jobs finished with the same parameters
+
+    def jobs_started(self, jobs):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO jobs (outfile, ligand, params_hash, state) VALUES (?, ?, ?, ?)',
+                [(job.outfile, job.name, job.params_hash, 'started') for job in jobs])
+
+    def job_done(self, job):
+        state = os.stat(job.outfile)
+        with self.connection:
+            self.connection.execute('UPDATE jobs SET state = ?, mtime = ?, size = ? WHERE outfile = ?',
+                ('done', state.st_mtime, state.st_size, job.outfile))
+
+    def job_failed(self, job):
+        with self.connection:
+            self.connection.execute('UPDATE jobs SET state = ? WHERE outfile = ?', ('failed', job.outfile))
+
+    def is_done(self, job): # finished with the same parameters and its output was not changed since
+        row = self.connection.execute('SELECT params_hash, state, mtime, size FROM jobs WHERE outfile = ?', (job.outfile,)).fetchone()
+        if row is None or row[0] != job.params_hash or row[1] != 'done':
+            return False
+        if not os.path.isfile(job.outfile) or (job.flexout != "" and not os.path.isfile(job.flexout)):
+            return False
+        state = os.stat(job.outfile)
+        return state.st_mtime == row[2] and state.st_size == row[3]
+
+    # runtimes of finished dockings for the cost model
+
+    def add_timings(self, rows): # rows : (features of JobCostModel, seconds)
+        with self.connection:
+            self.connection.executemany('INSERT INTO timings (torsions, heavy_atoms, volume, exhaustiveness, flexres, cpu, seconds)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)', [tuple(features)+(seconds,) for features, seconds in rows])
+
+    def timings(self, limit=5000): # the latest ones
+        rows = self.connection.execute('SELECT torsions, heavy_atoms, volume, exhaustiveness, flexres, cpu, seconds FROM timings'
+            ' ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return [(row[:6], row[6]) for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+def read_smina_table(output): # model -> (affinity, rmsd l.b., rmsd u.b.) from the result table smina prints
+    table = {}
+    in_table = False
+    for line in output.splitlines():
+        if line.startswith('-----+'):
+            in_table = True
+            continue
+        if in_table:
+            fields = line.split()
+            if len(fields) != 4:
+                in_table = False
+                continue
+            try:
+                table[int(fields[0])] = (float(fields[1]), float(fields[2]), float(fields[3]))
+            except ValueError:
+                in_table = False
+    return table
+
+conf_independent_terms = ('num_tors_div', 'num_tors_div_simple', 'num_tors_add', 'num_tors_sqr', 'num_tors_sqr_div',
+    'num_heavy_atoms_div', 'num_heavy_atoms', 'num_hydrophobic_atoms', 'ligand_length', 'constant_term')
+
+def read_smina_terms(output, term_names): # (poses, terms) array of the raw term values smina --score_only prints per pose
+    names = term_names
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('##'):
+            continue
+        fields = line[2:].split()
+        if fields[:1] == ['Name']: # header of the term columns
+            names = fields[1:]
+            continue
+        try:
+            values = [float(field) for field in fields[len(fields)-len(names):]]
+        except ValueError:
+            continue
+        if len(values) == len(names):
+            rows.append(dict(zip(names, values)))
+    return np.array([[row[name] for name in term_names] for row in rows], dtype=np.float64).reshape(len(rows), len(term_names))
+
+def reweight_terms(scoring_list, term_names, values, num_tors): # affinities of all poses for new weights in one product
+    # smina divides the weighted sum by 1+w*num_tors/5 for num_tors_div, w = 0.1*(weight+1)
+    weights = np.zeros(len(term_names))
+    tors_weight = None
+    for weight, term in scoring_list:
+        if term not in term_names:
+            raise ValueError("no cached values of the term %s" % term)
+        if term.split('(')[0] == 'num_tors_div':
+            tors_weight = float(weight)
+        elif term.split('(')[0] in conf_independent_terms:
+            raise ValueError("the term %s can not be reweighted" % term)
+        else:
+            weights[term_names.index(term)] = float(weight)
+    affinities = values.dot(weights)
+    if tors_weight is not None:
+        affinities = affinities/(1+0.1*(tors_weight+1)*num_tors/5.0)
+    return affinities
+
+class PdbqtResult:
+    '''
+    Models of a smina output file : model numbers, affinities, remarks and
+    the atom coordinates of all models in one float32 array
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.models = [] # model numbers
+        self.affinities = None # numpy array, nan where a model has no affinity remark
+        self.remarks = [] # dict of the REMARK fields of each model
+        self.torsdof = [] # every TORSDOF of the file, more than one if flexible residues are included
+        self.atom_types = [] # autodock types of the atoms of the first model
+        self.coordinates = None # (atoms of all models, 3)
+        self.offsets = None # first atom of each model in coordinates, plus the total
+
+    def model_coordinates(self, i):
+        return self.coordinates[self.offsets[i]:self.offsets[i+1]]
+
+    def coordinate_array(self): # (models, atoms, 3) when all models have the same atoms
+        counts = np.diff(self.offsets)
+        if len(counts) == 0 or np.any(counts != counts[0]):
+            raise ValueError("models of %s have different atoms" % self.filename)
+        return self.coordinates.reshape(len(counts), counts[0], 3)
+
+    def heavy_atoms(self): # mask of the non hydrogen atoms of a model
+        return np.array([atom_type not in ('H', 'HD', 'HS') for atom_type in self.atom_types], dtype=bool)
+
+def parse_pdbqt(filename, block_atoms=65536): # reads a smina output file in a single pass
+    result = PdbqtResult(filename)
+    affinities = []
+    offsets = []
+    blocks = []
+    columns = bytearray() # fixed width x, y, z columns, converted block by block to keep memory low
+    atoms = 0
+    model = None
+    remarks = None
+    affinity = float('nan')
+    in_model = False
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line[:4] == b'ATOM' or line[:6] == b'HETATM':
+                if model is None: # file without MODEL records
+                    model, remarks, affinity = 1, {}, float('nan')
+                    offsets.append(atoms)
+                columns += line[30:54]
+                atoms = atoms+1
+                if len(offsets) == 1:
+                    result.atom_types.append(line[77:79].strip().decode())
+                if atoms % block_atoms == 0:
+                    blocks.append(np.frombuffer(bytes(columns), dtype='S8').astype(np.float32))
+                    columns = bytearray()
+            elif line.startswith(b'MODEL'):
+                model, remarks, affinity = int(line.split()[1]), {}, float('nan')
+                offsets.append(atoms)
+                in_model = True
+            elif line.startswith(b'REMARK'):
+                if model is None:
+                    model, remarks, affinity = 1, {}, float('nan')
+                    offsets.append(atoms)
+                fields = line[6:].split(None, 1)
+                if len(fields) == 2:
+                    key, value = fields[0].decode(), fields[1].strip().decode()
+                    if key == 'VINA': # REMARK VINA RESULT: affinity rmsd_lb rmsd_ub
+                        values = value.split()[1:]
+                        affinity = float(values[0])
+                        remarks['rmsd_lb'], remarks['rmsd_ub'] = values[1], values[2]
+                    elif key == 'minimizedAffinity':
+                        affinity = float(value)
+                    remarks[key] = value
+            elif line.startswith(b'TORSDOF'):
+                result.torsdof.append(int(line.split()[1]))
+            elif line.startswith(b'ENDMDL') and in_model:
+                result.models.append(model)
+                result.remarks.append(remarks)
+                affinities.append(affinity)
+                model = None
+                in_model = False
+    if model is not None: # last model without ENDMDL
+        result.models.append(model)
+        result.remarks.append(remarks)
+        affinities.append(affinity)
+    if columns:
+        blocks.append(np.frombuffer(bytes(columns), dtype='S8').astype(np.float32))
+    if sum(len(block) for block in blocks) != 3*atoms:
+        raise ValueError("truncated ATOM records in %s" % filename)
+    if blocks:
+        result.coordinates = np.concatenate(blocks).reshape(-1, 3)
+    else:
+        result.coordinates = np.zeros((0, 3), dtype=np.float32)
+    result.affinities = np.array(affinities, dtype=np.float64)
+    result.offsets = np.array(offsets[:len(result.models)]+[atoms], dtype=np.int64)
+    return result
+
+def combine_flexres(flexout): # merges all residues of the same model in one pass, yields (model, records) starting with model 1
+    # smina writes one MODEL block per flexible residue, the blocks of a pose share the same MODEL line
+    model = 1
+    actual_model = None
+    records = []
+    with open(flexout, 'r') as file:
+        for line in file:
+            if line.startswith('MODEL'):
+                if actual_model is None:
+                    actual_model = line
+                elif line != actual_model:
+                    yield model, ''.join(records)
+                    model = model+1
+                    actual_model = line
+                    records = []
+            elif not line.startswith('ENDMDL'):
+                records.append(line)
+    if records != [] or actual_model is not None:
+        yield model, ''.join(records)
+
+def split_smina_output(output): # the text smina printed for each ligand of a multi-ligand run, each part ends with its result table
+    parts = []
+    lines = []
+    in_table = False
+    for line in output.splitlines(True):
+        if in_table:
+            fields = line.split()
+            if len(fields) != 4 or not fields[0].isdigit():
+                parts.append(''.join(lines))
+                lines = []
+                in_table = False
+        lines.append(line)
+        if line.startswith('-----+'):
+            in_table = True
+    if in_table:
+        parts.append(''.join(lines))
+    elif parts != []: # text after the last table
+        parts[-1] = parts[-1]+''.join(lines)
+    return parts
+
+def split_batch(job): # writes the poses and the output of each ligand of a batch job to the files of its ligand jobs
+    # smina numbers the poses of every ligand from MODEL 1 on, False if the poses do not match the ligands
+    if not os.path.isfile(job.outfile):
+        return False
+    part = -1
+    out = None
+    matched = True
+    try:
+        with open(job.outfile, 'r') as f:
+            for line in f:
+                if line.startswith('MODEL') and line.split()[1] == '1':
+                    if out is not None:
+                        out.close()
+                        out = None
+                    part = part+1
+                    if part == len(job.parts):
+                        matched = False
+                        break
+                    out = open(job.parts[part].outfile, 'w')
+                elif out is None:
+                    matched = False
+                    break
+                out.write(line)
+    finally:
+        if out is not None:
+            out.close()
+    if part != len(job.parts)-1:
+        matched = False
+    os.remove(job.outfile)
+    if not matched: # written parts would be taken for results
+        for ligand_job in job.parts:
+            if os.path.isfile(ligand_job.outfile):
+                os.remove(ligand_job.outfile)
+        return False
+    outputs = split_smina_output(job.output)
+    for i, ligand_job in enumerate(job.parts):
+        ligand_job.returncode = job.returncode
+        if len(outputs) == len(job.parts):
+            ligand_job.output = outputs[i]
+        if ligand_job.logfile != "": # the log smina would have written for the ligand alone
+            with open(ligand_job.logfile, 'w') as f:
+                f.write(ligand_job.output)
+    return True
+
+def split_poses(job): # writes each pose refined or scored by a batch job to the outfile of its job, False if they do not match
+    # smina writes one model per input pose, ending with ENDMDL or, without MODEL records, with the TORSDOF of the ligand
+    if not os.path.isfile(job.outfile):
+        return False
+    part = 0
+    out = None
+    in_model = False
+    matched = True
+    try:
+        with open(job.outfile, 'r') as f:
+            for line in f:
+                if out is None:
+                    if line.strip() == "":
+                        continue
+                    if part == len(job.parts):
+                        matched = False
+                        break
+                    out = open(job.parts[part].outfile, 'w')
+                if line.startswith('MODEL'): # numbered like the output of a single pose
+                    line = "MODEL 1\n"
+                    in_model = True
+                out.write(line)
+                if line.startswith('ENDMDL') or (line.startswith('TORSDOF') and not in_model):
+                    out.close()
+                    out = None
+                    part = part+1
+                    in_model = False
+    finally:
+        if out is not None:
+            out.close()
+            matched = False # last pose incomplete
+    os.remove(job.outfile)
+    if not matched or part != len(job.parts):
+        for pose_job in job.parts:
+            if os.path.isfile(pose_job.outfile):
+                os.remove(pose_job.outfile)
+        return False
+    for pose_job in job.parts:
+        pose_job.returncode = job.returncode
+    return True
+
+def store_docking_results(store, job, flexres={}): # all poses of a finished job with their affinity, rmsd bounds and flexible residues
+    table = read_smina_table(job.output)
+    result = parse_pdbqt(job.outfile)
+    poses = []
+    for model, affinity, remarks in zip(result.models, result.affinities.tolist(), result.remarks):
+        rmsd_lb, rmsd_ub = table.get(model, (None, None, None))[1:]
+        if rmsd_lb is None and 'rmsd_lb' in remarks: # vina style result remark
+            rmsd_lb, rmsd_ub = float(remarks['rmsd_lb']), float(remarks['rmsd_ub'])
+        poses.append((model, affinity, rmsd_lb, rmsd_ub, flexres.get(model)))
+    store.add_poses(job.name, job.receptor, job.params_hash, job.outfile, poses)
+    return poses
+
+def extract_model(outfile, model, filename): # writes one pose of a docked file as a single molecule .pdbqt
+    found = False
+    with open(outfile, 'r') as f, open(filename, 'w') as pose:
+        for line in f:
+            if line.startswith('MODEL'):
+                found = int(line.split()[1]) == model
+            elif line.startswith('ENDMDL'):
+                if found:
+                    break
+            elif found:
+                pose.write(line)
+    return found
+
+def pose_rmsd_matrix(coords): # (poses, poses) rmsd of (poses, atoms, 3) coordinates without superposition, like smina
+    flat = coords.reshape(len(coords), -1).astype(np.float64)
+    squares = np.einsum('ij,ij->i', flat, flat)
+    distances = squares[:, None]+squares[None, :]-2.0*flat.dot(flat.T) # |a-b|^2 from one matrix product
+    return np.sqrt(np.maximum(distances, 0.0)/max(1, coords.shape[1]))
+
+def cluster_poses(coords, affinities, cutoff=2.0): # cluster of each pose and the representative of each cluster
+    # greedy : the best pose not clustered yet takes all others within the cutoff, poses without affinity come last
+    rmsd = pose_rmsd_matrix(coords)
+    clusters = np.full(len(coords), -1)
+    representatives = []
+    for i in np.argsort(affinities, kind='stable'):
+        if clusters[i] >= 0:
+            continue
+        clusters[(clusters < 0) & (rmsd[i] <= cutoff)] = len(representatives)
+        representatives.append(int(i))
+    return clusters, representatives
+
+def heavy_atom_coordinates(result): # (models, heavy atoms, 3) of a parsed docked file
+    coords = result.coordinate_array()
+    return coords[:, result.heavy_atoms()] if len(result.atom_types) == coords.shape[1] else coords
+
+def docked_representatives(outfiles, cutoff=2.0): # (outfile, model, affinity) of the cluster representatives of docked files of one ligand
+    groups = {} # heavy atoms -> poses, files of different atoms are clustered apart
+    for outfile in outfiles:
+        result = parse_pdbqt(outfile)
+        if result.models == []:
+            continue
+        coords = heavy_atom_coordinates(result)
+        group = groups.setdefault(coords.shape[1], ([], [], []))
+        group[0].append(coords)
+        group[1].append(result.affinities)
+        group[2].extend((outfile, model) for model in result.models)
+    representatives = []
+    for coords, affinities, poses in groups.values():
+        affinities = np.concatenate(affinities)
+        clusters, best = cluster_poses(np.concatenate(coords), affinities, cutoff)
+        representatives.extend(poses[i]+(float(affinities[i]),) for i in best)
+    return sorted(representatives, key=lambda pose: pose[2])
+
+def replicas_converged(outfiles, rmsd=2.0, affinity=0.5): # the best pose of the replicas is found again by another replica
+    best = [] # (affinity, heavy atom coordinates) of the best pose of each replica
+    for outfile in outfiles:
+        result = parse_pdbqt(outfile)
+        if result.models == [] or np.all(np.isnan(result.affinities)):
+            continue
+        i = int(np.nanargmin(result.affinities))
+        best.append((float(result.affinities[i]), heavy_atom_coordinates(result)[i]))
+    best.sort(key=lambda pose: pose[0])
+    if len(best) < 2 or any(coords.shape != best[0][1].shape for score, coords in best):
+        return False
+    distances = pose_rmsd_matrix(np.array([coords for score, coords in best]))[0]
+    return any(distances[i] <= rmsd and best[i][0]-best[0][0] <= affinity for i in range(1, len(best)))
+
+def benchmark_pdbqt_parser(files="", gigabytes=1.0):
+    '''
+DESCRIPTION
+
+    Times parse_pdbqt against the former readlines() parsing on smina output
+    files, or on a generated output set of the given size.
+
+USAGE
+
+    smina_benchmark_parser [files [, gigabytes]]
+
+    files : glob pattern of _docked.pdbqt files
+    '''
+    filenames = glob(files) if files else []
+    generated = None
+    if filenames == []:
+        generated = tempfile.mkdtemp()
+        model = "REMARK minimizedAffinity -8.12345\nROOT\n"+"".join("ATOM  %5d  C   UNL     1    %8.3f%8.3f%8.3f  0.00  0.00    +0.000 C \n"
+            % (i+1, i*0.5, -i*0.25, 1.0) for i in range(30))+"ENDROOT\nTORSDOF 4\n"
+        models = "".join("MODEL %s\n%sENDMDL\n" % (i+1, model) for i in range(9))
+        size = 0
+        while size < float(gigabytes)*1e9:
+            filename = os.path.join(generated, "lig%s_docked.pdbqt" % len(filenames))
+            with open(filename, 'w') as f:
+                for i in range(1000): # a multi-ligand output file
+                    f.write(models)
+            size = size+os.path.getsize(filename)
+            filenames.append(filename)
+    size = sum(os.path.getsize(filename) for filename in filenames)/1e6
+    print("parsing %s files, %.0f MB" % (len(filenames), size))
+    start = time.time()
+    models = 0
+    for filename in filenames:
+        models = models+len(parse_pdbqt(filename).models)
+    elapsed = time.time()-start
+    print("parse_pdbqt : %s models in %.1f s, %.0f MB/s" % (models, elapsed, size/elapsed))
+    largest = max(filenames, key=os.path.getsize)
+    tracemalloc.start() # slows parsing down, measured apart
+    parse_pdbqt(largest)
+    peak = tracemalloc.get_traced_memory()[1]/1e6
+    tracemalloc.stop()
+    print("peak memory for the largest file (%.0f MB) : %.0f MB" % (os.path.getsize(largest)/1e6, peak))
+    start = time.time()
+    for filename in filenames: # the parsing parse_pdbqt replaced, affinities only
+        score_list = []
+        for line in open(filename, 'r').readlines():
+            if 'MODEL' in line:
+                modnum = line.strip(" MODEL\n")
+            if 'minimizedAffinity' in line:
+                score_list.append(modnum+";"+line.strip('REMAK minzedAfty\n'))
+    elapsed = time.time()-start
+    print("readlines : %.1f s, %.0f MB/s" % (elapsed, size/elapsed))
+    if generated is not None:
+        shutil.rmtree(generated)
+
+class TopK:
+    '''
+    The k best (lowest) scores pushed so far with their keys, in a heap
+    whose root is the worst kept score, so each push costs log k. A key
+    pushed again replaces its score, better or worse (docked again)
+    '''
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = [] # (-score, key)
+        self.scores = {} # key -> score of the kept keys
+
+    def __contains__(self, key):
+        return key in self.scores
+
+    def __len__(self):
+        return len(self.scores)
+
+    def push(self, key, score): # returns the keys that are not among the k best anymore, key itself if it is not kept
+        if score != score: # nan
+            return [] if key in self.scores else [key]
+        if key in self.scores:
+            self.heap.remove((-self.scores[key], key)) # scored again, rare
+            heapq.heapify(self.heap)
+            del self.scores[key]
+        if len(self.heap) >= self.k:
+            if self.k == 0 or score >= -self.heap[0][0]:
+                return [key]
+            worst, dropped = heapq.heapreplace(self.heap, (-score, key))
+            del self.scores[dropped]
+            self.scores[key] = score
+            return [dropped]
+        heapq.heappush(self.heap, (-score, key))
+        self.scores[key] = score
+        return []
+
+    def best(self): # (score, key) of the kept keys, best first
+        return sorted((score, key) for key, score in self.scores.items())
+
+class Leaderboard(TopK):
+    '''
+    Best ligands of a run while it goes on : each finished docking job
+    pushes the best pose of its ligand, over all receptors of an ensemble
+    '''
+
+    def __init__(self, k):
+        TopK.__init__(self, k)
+        self.poses = {} # ligand -> (affinity, receptor, model, outfile) of its best pose
+        self.changed = False
+
+    def add_poses(self, job, poses): # poses as stored by store_docking_results
+        best = None
+        for model, affinity, rmsd_lb, rmsd_ub, flexres in poses:
+            if affinity == affinity and (best is None or affinity < best[0]): # not nan
+                best = (affinity, job.receptor, model, job.outfile)
+        if best is None:
+            return
+        if job.name in self.poses and self.poses[job.name][0] <= best[0]: # better pose on another receptor
+            return
+        dropped = self.push(job.name, best[0])
+        if self.scores.get(job.name) == best[0]:
+            self.poses[job.name] = best
+            self.changed = True
+        for ligand in dropped:
+            self.poses.pop(ligand, None)
+
+    def rows(self): # (ligand, affinity, receptor, model, outfile), best first
+        return [(ligand,)+self.poses[ligand] for score, ligand in self.best()]
+
+class JobCostModel:
+    '''
+    Predicted runtime of a docking job from the torsions and heavy atoms of
+    the ligand, the box volume, exhaustiveness, flexible residues and cores.
+    log(seconds) is linear in the logs of these, fitted by least squares to
+    the timings of finished jobs and pulled towards a guess while few are known
+    '''
+
+    # seconds ~ (1+torsions) * heavy atoms * volume^0.5 * exhaustiveness * (1+flexres) / cpu, 20 s for the typical ligand
+    # docked with exhaustiveness 8 on 8 cores
+    prior = np.array([np.log(20.0/(6*25*np.sqrt(8000.0))), 1.0, 1.0, 0.5, 1.0, 1.0, -1.0])
+    typical = (5, 25, 8000.0) # torsions, heavy atoms and box volume when the files do not tell
+
+    def __init__(self, timings=(), weight=1.0):
+        self.weight = weight # of the guess, as many timings
+        self.xtx = weight*np.eye(len(self.prior)) # normal equations, timings are added without keeping them
+        self.xty = weight*self.prior
+        self.timings = 0
+        self.volumes = {} # config file -> (mtime, box volume)
+        self.coefficients = self.prior
+        self.add(timings)
+
+    def design(self, features):
+        torsions, heavy_atoms, volume, exhaustiveness, flexres, cpu = features
+        return [1.0, np.log1p(max(torsions, 0)), np.log(max(heavy_atoms, 1)), np.log(max(volume, 1.0)), np.log(max(exhaustiveness, 1)),
+            np.log1p(max(flexres, 0)), np.log(max(cpu, 1))]
+
+    def add(self, timings): # (features, seconds) of finished jobs, fits again
+        rows = [(self.design(features), np.log(seconds)) for features, seconds in timings if seconds is not None and seconds > 0]
+        if rows == []:
+            return
+        x = np.array([row for row, seconds in rows])
+        self.xtx = self.xtx+x.T @ x
+        self.xty = self.xty+x.T @ np.array([seconds for row, seconds in rows])
+        self.timings = self.timings+len(rows)
+        self.coefficients = np.linalg.solve(self.xtx, self.xty)
+
+    def box_volume(self, config): # size_x * size_y * size_z of a smina config file
+        try:
+            mtime = os.path.getmtime(config)
+        except OSError:
+            return self.typical[2]
+        if self.volumes.get(config, (None,))[0] != mtime:
+            size = {}
+            with open(config, 'r') as f:
+                for line in f:
+                    key, separator, value = line.partition('=')
+                    if separator and key.strip() in ('size_x', 'size_y', 'size_z'):
+                        try:
+                            size[key.strip()] = float(value)
+                        except ValueError:
+                            pass
+            volume = size['size_x']*size['size_y']*size['size_z'] if len(size) == 3 else self.typical[2]
+            self.volumes[config] = (mtime, volume)
+        return self.volumes[config][1]
+
+    def features(self, ligand_pdbqt, config, exhaustiveness, flexres, cpu):
+        torsions, heavy_atoms = None, None
+        if os.path.isfile(ligand_pdbqt):
+            try:
+                heavy_atoms, torsions = describe_ligand(ligand_pdbqt, "pdbqt")
+            except (OSError, ValueError, IndexError):
+                pass
+        return (torsions if torsions is not None else self.typical[0], heavy_atoms or self.typical[1], self.box_volume(config),
+            exhaustiveness, flexres, cpu)
+
+    def predict(self, features): # seconds
+        return float(np.exp(np.dot(self.design(features), self.coefficients)))
+
+    def cost(self, job): # seconds of a docking job or of all ligands of a batch job with the current fit, None for other jobs
+        parts = job.parts if job.parts != [] else [job]
+        if any(part.features is None for part in parts):
+            return None
+        return sum(self.predict(part.features) for part in parts)
+
+    def observe(self, job): # (features, seconds) of a finished docking, the ligands of a batch share its runtime as predicted
+        if job.runtime is None or job.returncode != 0:
+            return []
+        parts = job.parts if job.parts != [] else [job]
+        if any(part.features is None for part in parts):
+            return []
+        predicted = [self.predict(part.features) for part in parts]
+        timings = [(part.features, job.runtime*cost/sum(predicted)) for part, cost in zip(parts, predicted)]
+        self.add(timings)
+        return timings
+
+def format_duration(seconds): # 1 h 05 min, 3 min 20 s, 40 s
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%s h %02d min" % (seconds//3600, seconds%3600//60)
+    if seconds >= 60:
+        return "%s min %02d s" % (seconds//60, seconds%60)
+    return "%s s" % seconds
+
+class SminaJob:
+    '''
+    One smina invocation and the files it writes
+    '''
+
+    def __init__(self, name, command, outfile, flexout="", logfile="", config="", ligands=None):
+        self.name = name
+        self.command = command # argv list
+        self.outfile = outfile
+        self.flexout = flexout
+        self.logfile = logfile
+        self.config = config
+        self.ligands = ligands if ligands is not None else [] # input files of a batch job
+        self.parts = [] # docking jobs of the ligands of a multi-ligand smina process
+        self.replica = None # (ligand, receptor of the ensemble, replica) of a multi-seed docking
+        self.ligand = "" # ligand path without .pdbqt of a docking job
+        self.features = None # what its runtime depends on, see JobCostModel
+        self.cost = None # predicted seconds, the costliest waiting job starts first, jobs without cost before all others
+        self.started = None
+        self.runtime = None # seconds the process ran
+        self.terms = [] # names of the term values a --score_only job prints
+        self.receptor = ""
+        self.params_hash = ""
+        self.collect = None # replaces the collect function of the run for this job
+        self.returncode = None
+        self.progress = 0 # percent, read from the stars smina prints while docking
+        self.output = ""
+        self.cancelled = False
+
+def failure_reason(job): # why a job has no result : the error starting its process, else the exit code
+    if job.returncode is None:
+        return job.output or "not started"
+    return "exit code %s" % job.returncode
+
+class SminaScheduler:
+    '''
+    Runs smina jobs in a pool of at most max_jobs concurrent processes.
+    Finished jobs are handed back through a queue so that the Qt event loop
+    never waits on a process.
+    '''
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max(1, int(max_jobs))
+        self.lookahead = 8*self.max_jobs # jobs a run keeps submitted, so that longer ones can be started first
+        self.pool = ThreadPoolExecutor(max_workers=self.max_jobs)
+        self.pending = {} # submitted jobs not yet handed back, finished jobs are forgotten
+        self.waiting = [] # heap of the submitted jobs not started yet
+        self.running = {}
+        self.processes = {}
+        self.finished = queue.Queue()
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.stopped = False # stop() : jobs not started yet are handed back as cancelled, unless keep(job)
+        self.keep = None
+        self.submitted = 0
+        self.done = 0
+
+    def submit(self, job): # also possible while jobs are running
+        self.submit_all([job])
+
+    def submit_all(self, jobs): # all of them wait before the first one starts, so that the costliest one starts first
+        with self.lock:
+            for index, job in enumerate(jobs):
+                heapq.heappush(self.waiting, ((0, 0.0) if job.cost is None else (1, -job.cost), self.submitted+index, job))
+        for job in jobs:
+            self.pending[id(job)] = job
+            self.submitted = self.submitted + 1
+            self.pool.submit(self.execute_next)
+
+    def execute_next(self): # one task per submitted job, it runs the waiting job with the highest priority
+        with self.lock:
+            if self.waiting == []: # handed back by cancel or stop
+                return None
+            job = heapq.heappop(self.waiting)[2]
+            self.running[id(job)] = job
+        try:
+            return self.execute(job)
+        finally:
+            with self.lock:
+                del self.running[id(job)]
+
+    def execute(self, job): # runs in a worker thread, the process itself does the work
+        try:
+            if self.cancelled or (self.stopped and not self.keep(job)):
+                job.cancelled = True
+                return job
+            job.started = time.time()
+            try:
+                if sys.platform.startswith('win'):
+                    proc = subprocess.Popen(job.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                        creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+                else:
+                    proc = subprocess.Popen(job.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                        start_new_session=True)
+            except OSError as error: # executable not found, no wsl, no permission
+                job.output = "could not start %s : %s" % (job.command[0], error)
+                return job
+            with self.lock:
+                self.processes[id(job)] = proc
+                cancelled = self.cancelled
+            if cancelled: # cancel() listed the processes before this one was added
+                kill_process_tree(proc)
+            output = []
+            stars = 0
+            while True:
+                chunk = proc.stdout.read1(4096)
+                if not chunk:
+                    break
+                output.append(chunk)
+                stars = stars + chunk.count(b'*')
+                job.progress = min(100, stars*2//max(1, len(job.parts)))
+            job.returncode = proc.wait()
+            job.runtime = time.time()-job.started
+            job.output = b''.join(output).decode(errors='replace')
+            with self.lock:
+                del self.processes[id(job)]
+            if self.cancelled:
+                job.cancelled = True
+            job.progress = 100
+            return job
+        finally:
+            self.finished.put(job)
+
+    def finished_jobs(self, block=False, timeout=None): # returns the jobs finished since the last call
+        # block waits at most timeout seconds for the first one
+        jobs = []
+        if block:
+            try:
+                jobs.append(self.finished.get(timeout=timeout))
+            except queue.Empty:
+                pass
+        while True:
+            try:
+                jobs.append(self.finished.get_nowait())
+            except queue.Empty:
+                break
+        for job in jobs:
+            del self.pending[id(job)]
+        self.done = self.done + len(jobs)
+        return jobs
+
+    def progress(self):
+        if self.submitted == 0:
+            return 100
+        running = sum(job.progress for job in self.pending.values())
+        return int((self.done*100+running)/self.submitted)
+
+    def eta(self, cost=None): # seconds until the submitted jobs are finished, None when no job has a cost
+        # cost(job) : seconds the job takes, job.cost by default
+        cost = cost or (lambda job: job.cost)
+        now = time.time()
+        with self.lock:
+            running = list(self.running.values())
+            waiting = [job for key, index, job in sorted(self.waiting)]
+        costs = [cost(job) for job in running+waiting]
+        if all(seconds is None for seconds in costs):
+            return None
+        workers = [max(0.0, (seconds or 0.0)-(now-(job.started or now))) for job, seconds in zip(running, costs)]
+        workers = workers+[0.0]*(self.max_jobs-len(workers))
+        heapq.heapify(workers)
+        for seconds in costs[len(running):]: # each one starts on the first process free
+            heapq.heappush(workers, heapq.heappop(workers)+(seconds or 0.0))
+        return max(workers)
+
+    def is_finished(self):
+        return self.pending == {}
+
+    def cancel(self):
+        self.cancelled = True
+        with self.lock:
+            waiting = [job for key, index, job in self.waiting]
+            self.waiting = []
+            processes = list(self.processes.values())
+        for job in waiting: # never started, hand it back as cancelled
+            job.cancelled = True
+            self.finished.put(job)
+        for proc in processes:
+            kill_process_tree(proc)
+
+    def stop(self, keep=lambda job: False): # the running processes finish, no other one is started except the kept ones
+        self.keep = keep
+        self.stopped = True
+        with self.lock:
+            waiting = [job for key, index, job in self.waiting]
+            self.waiting = [entry for entry in self.waiting if keep(entry[2])]
+            heapq.heapify(self.waiting)
+        for job in waiting:
+            if not keep(job):
+                job.cancelled = True
+                self.finished.put(job)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+def kill_process_tree(proc): # smina and the processes it started (wsl)
+    if proc.poll() is not None:
+        return
+    if sys.platform.startswith('win'):
+        subprocess.call('taskkill /F /T /PID %s' % proc.pid, shell=True,
+            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+    else:
+        os.killpg(proc.pid, signal.SIGTERM)
+
+class NativeExecutor:
+    '''
+    Runs smina and openbabel directly : commands are argv lists given to
+    subprocess without a shell, paths are used as they are
+    '''
+
+    name = 'native'
+
+    def __init__(self, smina_exe, openbabel_exe):
+        self.smina_exe = smina_exe
+        self.openbabel_exe = openbabel_exe
+
+    def path(self, filename): # filename as smina sees it
+        return filename
+
+    def smina(self, arguments):
+        return [self.smina_exe]+arguments
+
+    def openbabel(self, arguments): # openbabel always runs natively
+        return [self.openbabel_exe]+arguments
+
+class WslExecutor(NativeExecutor):
+    '''
+    Runs smina.static in the windows subsystem for linux, wsl.exe is started
+    without cmd.exe and the paths smina reads or writes are translated here
+    '''
+
+    name = 'wsl'
+
+    def path(self, filename): # C:\\dir\\file -> /mnt/c/dir/file
+        drive = "c"
+        if filename[1:2] == ":":
+            drive, filename = filename[0].lower(), filename[2:]
+        return "/mnt/"+drive+filename.translate(str.maketrans('\\','/',''))
+
+    def smina(self, arguments):
+        return ['wsl', self.path(self.smina_exe)]+arguments
+
+executors = {'native': NativeExecutor, 'wsl': WslExecutor}
+
+class SminaPipeline:
+    '''
+    Docking, post-refinement and scoring without the dialog. The smina and
+    openbabel commands are built from a settings dictionary, the dialog
+    fills it from its widgets and headless runs read it from a job spec file.
+    '''
+
+    defaults = {
+        'smina_exe': '',
+        'openbabel_exe': '',
+        'executor': 'wsl' if sys.platform.startswith('win') else 'native', # wsl : smina.static runs in the linux subsystem
+        'workdir': '', # default : current directory
+        'receptor': '', # name of the receptor in the working directory, or a .pdb/.pdbqt file
+        'ensemble': [], # receptors each ligand is docked against instead of the receptor, names or .pdb/.pdbqt files
+        'config': '', # box file, default : <receptor>_config.txt
+        'ligands': [], # single molecule files or glob patterns
+        'libraries': [], # multi-molecule .sdf or .pdbqt files
+        'charge_model': 'gasteiger',
+        'ph': None, # protonation, else openbabel adds hydrogens
+        'exhaustiveness': 8,
+        'num_modes': 9,
+        'seed': None,
+        'replicas': 1, # dockings of each ligand with the seeds seed, seed+1, ..., two at first, more until the best poses agree
+        'replica_rmsd': 2.0, # best poses of two replicas agree within this rmsd
+        'replica_affinity': 0.5, # and this affinity difference (kcal/mol)
+        'flexres': [], # chain:residue of flexible side chains
+        'custom_scoring': '', # scoring table file
+        'parallel_jobs': 1,
+        'ligand_chunk': 1, # ligands docked by one smina process, rigid docking only
+        'log': False,
+        'suffix': '',
+        'skip_finished': True,
+        'refine_top': 0, # number of best ligands post-refined after a headless docking
+        'minimize': False,
+        'local_only': False,
+        'autobox_add': 4,
+        'randomize': False,
+        'approximation': 'linear',
+        'accurate_line': False,
+        'minimize_early_term': False,
+        'minimize_iters': None,
+        'factor': None,
+        'force_cap': None,
+        'refinement_log': False,
+        'score': False, # rescore the best poses with --score_only
+        'funnel_top': 0, # funnel screen : a cheap first stage docks all ligands, only its best ones are docked with the settings above
+        'funnel_percent': 0.0, # best part of the ligands re-docked, if funnel_top is not set
+        'funnel_exhaustiveness': 2, # first stage, rigid side chains
+        'funnel_num_modes': 3,
+        'cluster_rmsd': 0.0, # refine every cluster representative of the refine_top ligands, poses within this rmsd are redundant
+    }
+
+    def __init__(self, settings=None, **overrides):
+        self.settings = dict(self.defaults)
+        self.settings.update(settings or {})
+        self.settings.update(overrides)
+        if self.settings['executor'] not in executors:
+            raise ValueError("unknown executor %s, use one of %s" % (self.settings['executor'], ", ".join(executors)))
+        self.executor = executors[self.settings['executor']](self.settings['smina_exe'], self.settings['openbabel_exe'])
+        self.receptor_keys = {} # receptor.pdbqt -> cache key of its current content
+        self.receptor_cache = None
+        self.record_users = {} # library record -> its dockings not collected yet
+        self.replica_runs = {} # (receptor, ligand) -> [replicas launched, outfiles of the collected ones]
+        self.store = None
+        self.cost_model = None # predicts the runtime of docking jobs, see job_costs
+        self.report = print # status messages, the dialog shows them in its status line
+
+    # paths and commands
+
+    def workfile(self, name):
+        return os.path.join(self.settings['workdir'] or os.getcwd(), name)
+
+    def path(self, filename): # filename as smina sees it
+        return self.executor.path(filename)
+
+    def openbabel_options(self): # charge model and protonation used for all .pdbqt conversions
+        options = '--partialcharge %s' % (self.settings['charge_model'])
+        if self.settings['ph'] is not None:
+            options = options+' -p %s' % (float(self.settings['ph']))
+        else :
+            options = options+' -h'
+        return options
+
+    def convert_ligand(self, ligand): # single ligand file to .pdbqt, waits for openbabel
+        ligand_pdbqt = ligand.rsplit(".", 1)[0]+".pdbqt"
+        command = self.executor.openbabel([ligand, '-O', ligand_pdbqt]+self.openbabel_options().split())
+        print(subprocess.list2cmdline(command))
+        subprocess.call(command)
+        return ligand_pdbqt
+
+    def receptor_name(self, receptor=None): # name of the receptor object and of its files in the working directory
+        receptor = receptor or self.settings['receptor']
+        if receptor.endswith(('.pdb', '.pdbqt')):
+            return os.path.basename(receptor).rsplit(".", 1)[0]
+        return receptor
+
+    def receptor_file(self, receptor=None):
+        return self.workfile(self.receptor_name(receptor)+".pdbqt")
+
+    def receptors(self): # the receptors each ligand is docked against, the box of the receptor is used for all of them
+        return self.settings['ensemble'] or [self.settings['receptor']]
+
+    def config_file(self):
+        return self.settings['config'] or self.workfile(self.receptor_name()+"_config.txt")
+
+    def conversion_job(self, ligand_files): # one openbabel process converting each file to .pdbqt next to it
+        command = self.executor.openbabel(ligand_files+['-opdbqt', '-m']+self.openbabel_options().split())
+        return SminaJob("openbabel (%s ligands)" % len(ligand_files), command, "", ligands=ligand_files)
+
+    def parameters_hash(self, receptor, config): # identifies receptor, box and docking settings but not the ligand
+        digest = hashlib.sha1(self.receptor_keys.get(receptor, receptor).encode())
+        for filename in (config, self.settings['custom_scoring']):
+            if filename != "" and os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    digest.update(f.read())
+        settings = [self.settings['exhaustiveness'], self.settings['num_modes']]
+        if self.settings['flexres'] != []:
+            settings.append(sorted(self.settings['flexres']))
+        if self.settings['seed'] is not None:
+            settings.append(int(self.settings['seed']))
+        digest.update(repr(settings).encode())
+        return digest.hexdigest()
+
+    def flexibles(self): # A:ARG12 -> A:12
+        flex_raw = []
+        for flexible in self.settings['flexres']:
+            A = flexible.split(":")[0]
+            B = flexible.split(":")[-1].strip(':ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+            flex_raw.append(A+":"+B)
+        return ",".join(flex_raw)
+
+    def docking_job(self, ligand, member=None, replica=None): # smina command of one ligand (path without .pdbqt) without running it
+        # member : receptor of the ensemble, replica : number of a multi-seed docking, both are added to the output files
+        s = self.settings
+        receptor = self.receptor_file(member)
+        config = self.config_file()
+        if not os.path.isfile(config): # check presence of smina config file for receptor
+            self.report('ERROR : Could not find %s' % config)
+            return None
+        ligand_name = ligand.translate(str.maketrans('\\','/','')).split("/")[-1]
+        if s['suffix'] != "": # add suffix to outfile
+            ligand_name = ligand_name+"_"+s['suffix']
+        file_name = ligand_name
+        if member is not None:
+            file_name = ligand_name+"_"+self.receptor_name(member)
+        if replica is not None:
+            file_name = file_name+"_r%s" % replica
+        outfile = self.workfile(file_name+"_docked.pdbqt")
+        flexout = ""
+        logfile = ""
+        command = ['-r', self.path(receptor), '-l', self.path(ligand)+'.pdbqt', '--config', self.path(config), '-o', self.path(outfile),
+            '--flex_hydrogens', '--exhaustiveness', str(s['exhaustiveness']), '--num_modes', str(s['num_modes'])]
+        if s['flexres'] != []: # run smina with flexibles
+            flexout = self.workfile(file_name+"_flexres.pdbqt")
+            command = command+['--flexres', self.flexibles(), '--out_flex', self.path(flexout)]
+        if replica is not None:
+            command = command+['--seed', str(int(s['seed'] or 0)+replica)]
+        elif s['seed'] is not None:
+            command = command+['--seed', str(int(s['seed']))]
+        if s['custom_scoring'] != "":
+            command = command+['--custom_scoring', self.path(s['custom_scoring'])]
+        if s['parallel_jobs'] > 1: # share the cores between the concurrent smina processes
+            command = command+['--cpu', str(max(1, (os.cpu_count() or 1)//s['parallel_jobs']))]
+        if s['log'] == True: # write smina Logfile, with the suffix too
+            logfile = receptor.rsplit(".", 1)[0]+'_'+ligand_name+'.log'
+            if replica is not None:
+                logfile = receptor.rsplit(".", 1)[0]+'_'+ligand_name+'_r%s.log' % replica
+            command = command+['--log', self.path(logfile)]
+        command = self.executor.smina(command)
+        job = SminaJob(ligand_name, command, outfile, flexout, logfile, config)
+        job.receptor = self.receptor_name(member)
+        job.params_hash = self.parameters_hash(receptor, config)
+        job.ligand = ligand
+        if replica is not None:
+            job.replica = (ligand, member, replica)
+        return job
+
+    def ligand_jobs(self, ligand): # docking jobs of one ligand, per receptor of the ensemble and first replicas, None without box file
+        replicas = [None]
+        if self.settings['replicas'] > 1:
+            replicas = list(range(min(2, self.settings['replicas'])))
+        jobs = []
+        for member in self.settings['ensemble'] or [None]:
+            for replica in replicas:
+                job = self.docking_job(ligand, member, replica)
+                if job is None:
+                    return None
+                jobs.append(job)
+        return jobs
+
+    def replica_jobs(self, job): # the next replica of a collected one while the finished replicas do not agree, else []
+        if job.replica is None:
+            return []
+        ligand, member = job.replica[:2]
+        store = self.results_store()
+        run = self.replica_runs.setdefault((job.receptor, job.name), [min(2, self.settings['replicas']), set()])
+        run[1].add(job.outfile)
+        launched = [self.docking_job(ligand, member, i) for i in range(run[0])]
+        if any(other.outfile not in run[1] and not store.is_done(other) for other in launched):
+            return [] # still running
+        done = [other.outfile for other in launched if store.is_done(other)]
+        while run[0] < self.settings['replicas'] and not replicas_converged(done, self.settings['replica_rmsd'], self.settings['replica_affinity']):
+            replica = self.docking_job(ligand, member, run[0])
+            run[0] = run[0]+1
+            if self.settings['skip_finished'] == True and store.is_done(replica):
+                done.append(replica.outfile)
+                continue
+            store.jobs_started([replica])
+            self.estimate(replica)
+            return [replica]
+        return []
+
+    def next_replica(self, job): # the first seed not docked yet of a ligand whose finished replicas do not agree, else []
+        # for skip finished : the replicas stored by an earlier run are not collected again
+        if job.replica is None:
+            return []
+        ligand, member = job.replica[:2]
+        store = self.results_store()
+        done = []
+        for i in range(self.settings['replicas']):
+            replica = self.docking_job(ligand, member, i)
+            if store.is_done(replica):
+                done.append(replica.outfile)
+                continue
+            if i < min(2, self.settings['replicas']) or replicas_converged(done, self.settings['replica_rmsd'], self.settings['replica_affinity']):
+                return [] # the first replicas are docked anyway
+            return [replica]
+        return []
+
+    def unfinished(self, jobs): # the jobs not docked yet with the same parameters, and the next seed of finished replicas
+        store = self.results_store()
+        todo = [job for job in jobs if not store.is_done(job)]
+        for job in jobs:
+            if job.replica is not None and job.replica[2] == 0 and job not in todo:
+                todo.extend(self.next_replica(job))
+        return todo
+
+    def batch_job(self, jobs): # one smina process docking the ligands of several docking jobs
+        # the receptor and the grids are set up once for all of them, split_batch writes the poses of each ligand
+        if len(jobs) == 1:
+            return jobs[0]
+        outfile = jobs[0].outfile.rsplit(".", 1)[0]+"_batch.pdbqt" # one per receptor of an ensemble
+        command = self.combined_command(jobs, outfile) # split_batch writes the log of each ligand
+        job = SminaJob("%s (+%s ligands)" % (jobs[0].name, len(jobs)-1), command, outfile, config=jobs[0].config)
+        job.parts = list(jobs)
+        job.collect = self.collect_batch
+        return job
+
+    def combined_command(self, jobs, outfile, logfile=""): # command of the first job with the inputs of all of them
+        command = []
+        arguments = iter(jobs[0].command)
+        for argument in arguments:
+            if argument == '-l':
+                next(arguments)
+                for job in jobs:
+                    command = command+['-l', job.command[job.command.index('-l')+1]]
+            elif argument == '-o':
+                next(arguments)
+                command = command+['-o', self.path(outfile)]
+            elif argument == '--log':
+                next(arguments)
+                if logfile != "":
+                    command = command+['--log', self.path(logfile)]
+            else:
+                command.append(argument)
+        return command
+
+    def batched(self, jobs): # groups ligand_chunk docking jobs of the same receptor and seed to one smina process, other jobs are passed on
+        size = self.settings['ligand_chunk']
+        chunks = {} # (receptor, replica) -> jobs
+        for job in jobs:
+            if size > 1 and job.params_hash != "" and job.flexout == "": # flexible residues are written to a second file
+                key = (job.receptor, job.replica[2] if job.replica is not None else None)
+                chunk = chunks.setdefault(key, [])
+                chunk.append(job)
+                if len(chunk) < size:
+                    continue
+                del chunks[key]
+                job = self.batch_job(chunk)
+            self.estimate(job)
+            yield job
+        for chunk in chunks.values():
+            job = self.batch_job(chunk)
+            self.estimate(job)
+            yield job
+
+    def job_costs(self): # runtime model calibrated on the timings of the results database
+        if self.cost_model is None:
+            self.cost_model = JobCostModel(self.results_store().timings())
+        return self.cost_model
+
+    def estimate(self, job): # predicted seconds of a docking job or of all ligands of a batch job, None for other jobs
+        s = self.settings
+        cpu = os.cpu_count() or 1
+        if s['parallel_jobs'] > 1:
+            cpu = max(1, cpu//s['parallel_jobs'])
+        for part in (job.parts if job.parts != [] else [job]):
+            if part.ligand != "":
+                part.features = self.job_costs().features(part.ligand+".pdbqt", part.config, s['exhaustiveness'], len(s['flexres']), cpu)
+        job.cost = self.job_costs().cost(job)
+        return job.cost
+
+    def record_runtime(self, job): # calibrates the cost model on a finished docking
+        timings = self.job_costs().observe(job)
+        if timings != []:
+            self.results_store().add_timings(timings)
+
+    def pose_batch_job(self, jobs): # one smina process refining or scoring the poses of several jobs, see split_poses
+        if len(jobs) == 1:
+            return jobs[0]
+        outfile = jobs[0].outfile.rsplit(".", 1)[0]+"_batch.pdbqt"
+        logfile = ""
+        if jobs[0].logfile != "":
+            logfile = outfile.rsplit(".", 1)[0]+".log"
+        command = self.combined_command(jobs, outfile, logfile)
+        job = SminaJob("%s (+%s poses)" % (jobs[0].name, len(jobs)-1), command, outfile, logfile=logfile, config=jobs[0].config)
+        job.parts = list(jobs)
+        job.collect = self.collect_pose_batch
+        return job
+
+    def batched_poses(self, jobs): # the same refinement of many poses in a few smina processes, one per parallel job
+        jobs = list(jobs)
+        size = max(1, min(100, -(-len(jobs)//self.settings['parallel_jobs']))) # stay below the windows command line limit
+        groups = {}
+        for job in jobs:
+            if '--autobox_ligand' in job.command: # local docking, the box depends on the pose
+                yield job
+                continue
+            key = []
+            arguments = iter(job.command)
+            for argument in arguments:
+                if argument in ('-l', '-o', '--log'):
+                    next(arguments)
+                else:
+                    key.append(argument)
+            group = groups.setdefault(tuple(key), [])
+            group.append(job)
+            if len(group) == size:
+                yield self.pose_batch_job(group)
+                groups[tuple(key)] = []
+        for group in groups.values():
+            if group != []:
+                yield self.pose_batch_job(group)
+
+    def minimize_job(self, ligand, member=None): # post-refinement of one pose (path without .pdbqt) without running it
+        s = self.settings
+        receptor = self.path(self.receptor_file(member))
+        config = self.config_file()
+        if not os.path.isfile(config):
+            self.report('ERROR : Could not find %s' % config)
+            return None
+        ligand_path = self.path(ligand)
+        outfile = ""
+        logfile = ""
+        command = ['-r', receptor, '-l', ligand_path+'.pdbqt', '--config', self.path(config)]
+        if s['custom_scoring'] != "":
+            command = command+['--custom_scoring', self.path(s['custom_scoring'])]
+        if s['local_only'] == True:
+            outfile = ligand+"_localdocked.pdbqt"
+            command = ['-r', receptor, '-l', ligand_path+'.pdbqt', '-o', self.path(outfile), '--local_only',
+                '--autobox_ligand', ligand_path+'.pdbqt', '--autobox_add', str(s['autobox_add'])]
+        if s['randomize'] == True:
+            outfile = ligand+"_randomize.pdbqt"
+            command = command+['--randomized_only', '-o', self.path(outfile)]
+        if s['minimize'] == True:
+            if s['randomize'] == True or s['local_only'] == True: # d'ont change their -out filename
+                command = command+['--minimize']
+            else:
+                outfile = ligand+"_minimized.pdbqt"
+                command = command+['--minimize', '-o', self.path(outfile)]
+            command = command+['--approximation', s['approximation']]
+            if s['accurate_line'] == True:
+                command = command+['--accurate_line']
+            if s['minimize_early_term'] == True:
+                command = command+['--minimize_early_term']
+            if s['minimize_iters'] is not None:
+                command = command+['--minimize_iters', str(s['minimize_iters'])]
+            if s['factor'] is not None:
+                command = command+['--factor', str(s['factor'])]
+            if s['force_cap'] is not None:
+                command = command+['--force_cap', str(s['force_cap'])]
+        if outfile == "":
+            self.report("ERROR : Select post refinement method first")
+            return None
+        if s['refinement_log'] == True: # write smina Logfile
+            logfile = outfile.rsplit(".", 1)[0]+'.log'
+            command = command+['--log', self.path(logfile)]
+        command = self.executor.smina(command)
+        return SminaJob(ligand.translate(str.maketrans('\\','/','')).split("/")[-1], command, outfile, logfile=logfile, config=config)
+
+    def score_job(self, ligand, member=None): # --score_only command of one pose (path without .pdbqt) without running it
+        outfile = ligand+"_scored.pdbqt"
+        if self.settings['suffix'] != "": # add suffix to outfile
+            outfile = ligand+"_scored_"+self.settings['suffix']+".pdbqt"
+        command = ['-r', self.path(self.receptor_file(member)), '-l', self.path(ligand)+'.pdbqt', '--score_only', '-o', self.path(outfile)]
+        if self.settings['custom_scoring'] != "":
+            command = command+['--custom_scoring', self.path(self.settings['custom_scoring'])]
+        command = self.executor.smina(command)
+        return SminaJob(ligand.translate(str.maketrans('\\','/','')).split("/")[-1], command, outfile)
+
+    def terms_job(self, receptor, outfiles, scoring_table=""): # --score_only of all poses of docked files, smina prints their raw term values
+        command = ['-r', self.path(self.workfile(receptor+".pdbqt"))]
+        for outfile in outfiles:
+            command = command+['-l', self.path(outfile)]
+        command = command+['--score_only']
+        if scoring_table != "":
+            command = command+['--custom_scoring', self.path(scoring_table)]
+        job = SminaJob("scoring terms (%s files)" % len(outfiles), self.executor.smina(command), "", ligands=list(outfiles))
+        job.receptor = receptor
+        job.collect = self.collect_terms
+        return job
+
+    # receptor preparation
+
+    def prepare_receptor(self, pdb_file): # (re)creates receptor.pdbqt only when the structure or the conversion options changed
+        job = self.receptor_job(pdb_file)
+        if job is not None:
+            subprocess.call(job.command)
+            self.collect_receptor(job)
+        return self.receptor_file(pdb_file)
+
+    def receptor_job(self, pdb_file): # openbabel job creating receptor.pdbqt, None when it is up to date or cached
+        receptor = self.receptor_file(pdb_file)
+        key = ""
+        if self.receptor_cache is not None:
+            key = self.receptor_cache.key(pdb_file, self.openbabel_options())
+            if self.receptor_keys.get(receptor) == key and os.path.isfile(receptor):
+                return None
+            cached = self.receptor_cache.lookup(key)
+            if cached is not None:
+                shutil.copyfile(cached, receptor)
+                self.receptor_keys[receptor] = key
+                self.report("Using cached receptor %s" % receptor)
+                return None
+            if os.path.isfile(receptor):
+                os.remove(receptor) # outdated
+        print("running openbable to create %s :" % receptor)
+        command = self.executor.openbabel([pdb_file, '-O', receptor]+self.openbabel_options().split())
+        print(subprocess.list2cmdline(command))
+        job = SminaJob("openbabel (%s)" % os.path.basename(receptor), command, receptor)
+        job.params_hash = key # receptor cache key of the structure and conversion options
+        job.collect = self.collect_receptor
+        return job
+
+    def collect_receptor(self, job): # keeps the created receptor in the cache
+        if not os.path.isfile(job.outfile):
+            self.report("ERROR when trying to create %s (%s)" % (job.outfile, failure_reason(job)))
+            return
+        self.report("Created %s" % job.outfile)
+        if self.receptor_cache is not None:
+            self.receptor_cache.store(job.params_hash, job.outfile)
+            self.receptor_keys[job.outfile] = job.params_hash
+
+    # headless runs
+
+    def results_store(self):
+        if self.store is None:
+            self.store = ResultsStore(self.workfile("smina_results.db"))
+        return self.store
+
+    def run(self, jobs, collect): # runs the jobs and waits for them, collect may return more jobs to run
+        scheduler = SminaScheduler(self.settings['parallel_jobs'])
+        jobs = iter(jobs)
+        follow_up = []
+        try:
+            while True:
+                submitted = []
+                while len(scheduler.pending)+len(submitted) < scheduler.lookahead: # keep the queue short
+                    job = follow_up.pop() if follow_up != [] else next(jobs, None)
+                    if job is None:
+                        break
+                    submitted.append(job)
+                scheduler.submit_all(submitted)
+                if scheduler.is_finished():
+                    break
+                for job in scheduler.finished_jobs(block=True, timeout=1.0):
+                    if job.cancelled:
+                        continue
+                    self.record_runtime(job)
+                    try:
+                        follow_up.extend((job.collect or collect)(job) or [])
+                    except Exception as error: # keep collecting the others
+                        self.report("ERROR : could not load results of %s (%s)" % (job.name, error))
+                        continue
+                    self.report("Finished %s (%s/%s)" % (job.name, scheduler.done, scheduler.submitted))
+        except KeyboardInterrupt:
+            scheduler.cancel()
+            raise
+        finally:
+            scheduler.shutdown()
+
+    def ligand_files(self): # the single molecule files of the spec
+        files = []
+        for pattern in self.settings['ligands']:
+            files.extend(sorted(glob(pattern)) or [pattern])
+        return files
+
+    def docking_jobs(self, only=None): # docking jobs of all ligands, conversion jobs for the ones without .pdbqt file
+        # only : names of the ligands to dock, as ranked_ligands returns them
+        store = self.results_store()
+        skipped = 0
+        for ligand_file in self.ligand_files():
+            ligand, file_type = ligand_file.rsplit(".", 1)
+            if only is not None and ligand.translate(str.maketrans('\\','/','')).split("/")[-1] not in only:
+                continue
+            if file_type != "pdbqt" and not os.path.isfile(ligand+".pdbqt"):
+                job = self.conversion_job([ligand_file])
+                job.collect = self.collect_conversion
+                yield job
+                continue
+            jobs = self.ligand_jobs(ligand)
+            if jobs is None:
+                return
+            if self.settings['skip_finished'] == True:
+                todo = self.unfinished(jobs)
+                skipped = skipped+len([job for job in jobs if job not in todo])
+                jobs = todo
+            for job in jobs:
+                store.jobs_started([job])
+                yield job
+        for filename in self.settings['libraries']:
+            library = LigandLibrary(filename)
+            record_dir = self.workfile(library.base+"_records")
+            if not os.path.isdir(record_dir):
+                os.mkdir(record_dir)
+            for chunk in library.chunks(max(8, 4*self.settings['parallel_jobs'])):
+                ligand_files = []
+                for record_name, record in chunk:
+                    if only is not None and record_name not in only:
+                        continue
+                    ligand = os.path.join(record_dir, record_name)
+                    jobs = self.ligand_jobs(ligand)
+                    if jobs is None:
+                        return
+                    if self.settings['skip_finished'] == True and self.unfinished(jobs) == []:
+                        skipped = skipped+len(jobs)
+                        continue
+                    with open(ligand+"."+library.file_type, 'w') as f:
+                        f.write(record)
+                    ligand_files.append(ligand+"."+library.file_type)
+                if ligand_files == []:
+                    continue
+                if library.file_type == "pdbqt":
+                    for ligand_file in ligand_files:
+                        for job in self.record_jobs(ligand_file):
+                            yield job
+                else:
+                    job = self.conversion_job(ligand_files)
+                    job.collect = self.collect_record_conversion
+                    yield job
+        if skipped > 0:
+            self.report("Skipped %s dockings already done with the same parameters" % skipped)
+
+    def record_jobs(self, ligand_pdbqt): # docks one record of a library, it is removed once all its dockings are collected
+        store = self.results_store()
+        jobs = self.ligand_jobs(ligand_pdbqt.rsplit(".", 1)[0]) or []
+        if self.settings['skip_finished'] == True:
+            jobs = self.unfinished(jobs)
+        for job in jobs:
+            job.ligands = [ligand_pdbqt]
+            job.collect = self.collect_record
+        if jobs == [] and os.path.isfile(ligand_pdbqt):
+            os.remove(ligand_pdbqt)
+        self.record_users[ligand_pdbqt] = len(jobs)
+        store.jobs_started(jobs)
+        return jobs
+
+    def collect_conversion(self, job):
+        jobs = []
+        for ligand in job.ligands:
+            if not os.path.isfile(ligand.rsplit(".", 1)[0]+".pdbqt"):
+                self.report("ERROR : openbabel could not convert %s (%s)" % (ligand, failure_reason(job)))
+                continue
+            dockings = self.ligand_jobs(ligand.rsplit(".", 1)[0]) or []
+            self.results_store().jobs_started(dockings)
+            jobs.extend(dockings)
+        return list(self.batched(jobs))
+
+    def collect_record_conversion(self, job):
+        jobs = []
+        for ligand in job.ligands:
+            ligand_pdbqt = ligand.rsplit(".", 1)[0]+".pdbqt"
+            os.remove(ligand)
+            if os.path.isfile(ligand_pdbqt):
+                jobs.extend(self.record_jobs(ligand_pdbqt))
+            else:
+                self.report("ERROR : openbabel could not convert %s (%s)" % (ligand, failure_reason(job)))
+        return list(self.batched(jobs))
+
+    def collect_docking(self, job): # returns the next replica if the job is one
+        store = self.results_store()
+        if not os.path.isfile(job.outfile):
+            self.report('ERROR : smina failed for %s (%s)' % (job.name, failure_reason(job)))
+            store.job_failed(job)
+            return self.replica_jobs(job)
+        flexres = {}
+        if job.flexout != "" and os.path.isfile(job.flexout):
+            flexres = dict(combine_flexres(job.flexout))
+        store_docking_results(store, job, flexres)
+        store.job_done(job)
+        return self.replica_jobs(job)
+
+    def collect_record(self, job):
+        jobs = self.collect_docking(job)
+        for replica in jobs: # the record is kept for the next replica
+            replica.ligands = list(job.ligands)
+            replica.collect = self.collect_record
+            for ligand in job.ligands:
+                self.record_users[ligand] = self.record_users.get(ligand, 0)+1
+        for ligand in job.ligands:
+            self.record_users[ligand] = self.record_users.get(ligand, 1)-1
+            if self.record_users[ligand] > 0: # still docked against other receptors of the ensemble
+                continue
+            del self.record_users[ligand]
+            if os.path.isfile(ligand): # the record is not needed anymore
+                os.remove(ligand)
+        return jobs
+
+    def collect_batch(self, job): # ligands the poses could not be split for are docked one by one
+        if not split_batch(job):
+            self.report("ERROR : could not split the poses of %s, docking its ligands one by one" % job.name)
+            return job.parts
+        jobs = []
+        for ligand_job in job.parts:
+            jobs.extend((ligand_job.collect or self.collect_docking)(ligand_job) or [])
+        return jobs
+
+    def collect_pose_batch(self, job): # poses that could not be split are refined one by one
+        if not split_poses(job):
+            self.report("ERROR : could not split the poses of %s, refining them one by one" % job.name)
+            return job.parts
+        for pose_job in job.parts:
+            (pose_job.collect or self.collect_refinement)(pose_job)
+
+    def terms_jobs(self, scoring_list, scoring_table=""): # computes the term values of a scoring table the store does not have yet
+        store = self.results_store()
+        terms = [term for weight, term in scoring_list]
+        outfiles = {}
+        for receptor, outfile in store.missing_terms("\n".join(terms)):
+            outfiles.setdefault(receptor, []).append(outfile)
+        for receptor in outfiles:
+            if not os.path.isfile(self.workfile(receptor+".pdbqt")):
+                self.report("ERROR : Could not find %s" % self.workfile(receptor+".pdbqt"))
+                continue
+            for i in range(0, len(outfiles[receptor]), 50): # stay below the windows command line limit
+                job = self.terms_job(receptor, outfiles[receptor][i:i+50], scoring_table)
+                job.terms = terms
+                yield job
+
+    def collect_terms(self, job): # smina scores the models of each file in order
+        values = read_smina_terms(job.output, job.terms)
+        results = [parse_pdbqt(outfile) for outfile in job.ligands]
+        if sum(len(result.models) for result in results) != len(values):
+            self.report("ERROR : smina printed %s term values for %s poses (%s)" % (len(values),
+                sum(len(result.models) for result in results), job.name))
+            return
+        store = self.results_store()
+        row = 0
+        for outfile, result in zip(job.ligands, results):
+            count = len(result.models)
+            num_tors = result.torsdof if len(result.torsdof) == count else (result.torsdof[:1] or [0])*count
+            store.add_terms(outfile, "\n".join(job.terms), zip(result.models, num_tors, values[row:row+count]))
+            row = row+count
+
+    def rescore(self, scoring_list): # ranks the stored poses with new weights, from cached term values
+        store = self.results_store()
+        terms = [term for weight, term in scoring_list]
+        ids, num_tors, values = store.term_matrix("\n".join(terms))
+        store.set_rescored(ids, reweight_terms(scoring_list, terms, values, num_tors))
+        return len(ids)
+
+    def collect_refinement(self, job): # affinities of refined or scored poses go to smina_refined.csv
+        if not os.path.isfile(job.outfile):
+            self.report('ERROR : smina failed for %s (%s)' % (job.name, failure_reason(job)))
+            return
+        result = parse_pdbqt(job.outfile)
+        with open(self.workfile("smina_refined.csv"), 'a') as f:
+            for affinity in result.affinities.tolist():
+                print("%s,%s,%g" % (job.name, os.path.basename(job.outfile), affinity), file=f)
+
+    def install_receptor(self, receptor): # puts receptor.pdbqt in the working directory, False if it is missing
+        receptor_file = self.receptor_file(receptor)
+        if receptor.endswith('.pdb'):
+            self.prepare_receptor(receptor)
+        else: # prepared receptor
+            if receptor.endswith('.pdbqt') and os.path.abspath(receptor) != os.path.abspath(receptor_file):
+                shutil.copyfile(receptor, receptor_file)
+            if self.receptor_cache is not None and os.path.isfile(receptor_file):
+                self.receptor_keys[receptor_file] = self.receptor_cache.key(receptor_file, "")
+        if not os.path.isfile(receptor_file):
+            self.report("ERROR : Could not find %s" % receptor_file)
+            return False
+        return True
+
+    def dock(self):
+        for receptor in self.receptors():
+            if not self.install_receptor(receptor):
+                return
+        only = None
+        if self.settings['funnel_top'] > 0 or self.settings['funnel_percent'] > 0:
+            stage = self.funnel_stage()
+            stage.run(stage.batched(stage.docking_jobs()), stage.collect_docking)
+            only = set(self.funnel_hits(stage))
+            self.report("Funnel : docking the best %s ligands of the first stage with exhaustiveness %s" % (len(only),
+                self.settings['exhaustiveness']))
+        self.run(self.batched(self.docking_jobs(only)), self.collect_docking)
+        if self.settings['ensemble'] != []:
+            self.report("Best affinities of %s ligands over %s receptors in %s" % (self.ensemble_summary(),
+                len(self.settings['ensemble']), self.workfile("smina_ensemble.csv")))
+
+    def funnel_stage(self): # pipeline of the cheap first stage of a funnel screen, its outfiles have the funnel suffix
+        s = self.settings
+        stage = SminaPipeline(s, exhaustiveness=s['funnel_exhaustiveness'], num_modes=s['funnel_num_modes'], flexres=[],
+            suffix=s['suffix']+"_funnel" if s['suffix'] != "" else "funnel", funnel_top=0, funnel_percent=0.0, replicas=1)
+        stage.receptor_keys = self.receptor_keys
+        stage.receptor_cache = self.receptor_cache
+        stage.store = self.results_store()
+        stage.cost_model = self.job_costs()
+        stage.report = self.report
+        return stage
+
+    def funnel_hits(self, stage): # the ligands the first stage ranks best, funnel_top of them or funnel_percent
+        ranked = stage.ranked_ligands()
+        count = self.settings['funnel_top']
+        if count <= 0:
+            count = int(np.ceil(len(ranked)*self.settings['funnel_percent']/100.0))
+        return ranked[:count]
+
+    def ranked_ligands(self): # names of the docked ligands without suffix, best affinity first
+        store = self.results_store()
+        if self.settings['ensemble'] != []:
+            ranked = [ligand for ligand, affinity, receptor, model, outfile in self.ensemble_best(store.ensemble_best(self.ensemble_members()))]
+        else:
+            ranked = [ligand for ligand, best, poses, model, outfile in store.best_per_ligand(-1, receptor=self.receptor_name(),
+                params_hash=self.parameters_hash(self.receptor_file(), self.config_file())) if best is not None]
+        if self.settings['suffix'] != "":
+            ranked = [ligand[:-len(self.settings['suffix'])-1] for ligand in ranked]
+        return ranked
+
+    def ensemble_members(self): # (receptor name, params_hash) of each receptor of the ensemble
+        return [(self.receptor_name(member), self.parameters_hash(self.receptor_file(member), self.config_file()))
+            for member in self.settings['ensemble']]
+
+    def ensemble_best(self, poses): # (ligand, best affinity, receptor, model, outfile) over the ensemble, best ligands first
+        best = []
+        for ligand in poses:
+            receptor = min(poses[ligand], key=lambda receptor: poses[ligand][receptor][0])
+            best.append((ligand, poses[ligand][receptor][0], receptor)+poses[ligand][receptor][1:])
+        return sorted(best, key=lambda ligand: ligand[1])
+
+    def ensemble_summary(self): # smina_ensemble.csv : best affinity of each ligand over the ensemble and per receptor
+        members = self.ensemble_members()
+        names = [name for name, params_hash in members]
+        poses = self.results_store().ensemble_best(members)
+        best = self.ensemble_best(poses)
+        with open(self.workfile("smina_ensemble.csv"), 'w') as f:
+            print(",".join(["ligand", "best", "receptor"]+names), file=f)
+            for ligand, affinity, receptor, model, outfile in best:
+                print(",".join([ligand, "%g" % affinity, receptor]+["%g" % poses[ligand][name][0] if name in poses[ligand] else ""
+                    for name in names]), file=f)
+        return len(best)
+
+    def refinement_jobs(self): # best pose of the refine_top best ligands
+        store = self.results_store()
+        if self.settings['ensemble'] != []: # with the receptor of the ensemble it was docked best in
+            best = [(ligand, affinity, model, outfile, receptor)
+                for ligand, affinity, receptor, model, outfile in self.ensemble_best(store.ensemble_best(self.ensemble_members()))[:self.settings['refine_top']]]
+        else:
+            best = [(ligand, affinity, model, outfile, None) for ligand, affinity, poses, model, outfile in store.best_per_ligand(
+                self.settings['refine_top'], receptor=self.receptor_name(), params_hash=self.parameters_hash(self.receptor_file(), self.config_file()))]
+        for ligand, affinity, model, outfile, member in best:
+            models = [model]
+            if self.settings['cluster_rmsd'] > 0: # each distinct pose of the ligand, not only the best one
+                models = [model for outfile, model, affinity in docked_representatives([outfile], self.settings['cluster_rmsd'])]
+            for model in models:
+                pose = self.workfile("pose%s_%s" % (model, ligand))
+                if not extract_model(outfile, model, pose+".pdbqt"):
+                    continue
+                if self.settings['minimize'] == True or self.settings['local_only'] == True or self.settings['randomize'] == True:
+                    job = self.minimize_job(pose, member)
+                    if job is not None:
+                        yield job
+                if self.settings['score'] == True:
+                    yield self.score_job(pose, member)
+
+    def refine(self):
+        if self.settings['refine_top'] > 0:
+            self.run(self.batched_poses(self.refinement_jobs()), self.collect_refinement)
+
+    def screen(self): # the whole pipeline of a job spec
+        self.dock()
+        self.refine()
+        if self.store is not None:
+            self.report("%s poses of %s ligands in %s" % (self.store.count(receptor=self.receptor_name()),
+                self.store.ligand_count(receptor=self.receptor_name()), self.store.filename))
+
+def read_job_spec(filename): # key = value lines like the plugin configuration files, lists are comma separated
+    settings = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line[0] == '#':
+                continue
+            key, value = [entry.strip() for entry in line.split('=', 1)]
+            if key not in SminaPipeline.defaults:
+                raise ValueError("unknown job spec key %s in %s" % (key, filename))
+            default = SminaPipeline.defaults[key]
+            if isinstance(default, list):
+                settings[key] = [entry.strip() for entry in value.split(',') if entry.strip() != ""]
+            elif isinstance(default, bool):
+                settings[key] = value.lower() in ('1', 'yes', 'true', 'on')
+            elif isinstance(default, int):
+                settings[key] = int(value)
+            elif value.lower() in ('', 'none'):
+                settings[key] = None if default is None else ""
+            elif key in ('seed', 'minimize_iters', 'factor', 'force_cap'):
+                settings[key] = int(value)
+            elif key in ('ph', 'cluster_rmsd', 'funnel_percent', 'replica_rmsd', 'replica_affinity'):
+                settings[key] = float(value)
+            else:
+                settings[key] = value
+    return settings
+
+def run_job_spec(spec, parallel_jobs=0): # docks, refines and scores as a job spec file says, without the dialog
+    settings = read_job_spec(spec)
+    if int(parallel_jobs) > 0:
+        settings['parallel_jobs'] = int(parallel_jobs)
+    if settings.get('workdir', '') == "": # relative paths of the spec are relative to its directory
+        settings['workdir'] = os.path.dirname(os.path.abspath(spec))
+    pipeline = SminaPipeline(settings)
+    pipeline.receptor_cache = ReceptorCache(os.path.join(os.path.expanduser('~'), '.PyMol_plugin', 'receptor_cache'))
+    cwd = os.getcwd()
+    os.chdir(pipeline.settings['workdir'])
+    try:
+        pipeline.screen()
+    finally:
+        if pipeline.store is not None:
+            pipeline.store.close()
+        os.chdir(cwd)
+
+def main(argv=None): # python __init__.py spec.txt [-j 8], or pymol -cq __init__.py -- spec.txt [-j 8]
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs smina screens described by job spec files without the plugin dialog")
+    parser.add_argument('specs', nargs='+', help="job spec files (key = value lines)")
+    parser.add_argument('-j', '--jobs', type=int, default=0, help="parallel smina processes, overrides parallel_jobs of the specs")
+    args = parser.parse_args(argv)
+    for spec in args.specs:
+        run_job_spec(spec, args.jobs)
+
+if __name__ in ('__main__', 'pymol'): # run as a script by python or by pymol -cq
+    main(sys.argv[1:])
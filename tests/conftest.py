@@ -0,0 +1,45 @@
+import importlib.util
+import os
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+# the plugin is a single __init__.py at the top of the repository, it is loaded
+# here without PyMol : pymol and its Qt wrapper are replaced by stand-ins, the
+# module level code tested does not use them
+
+class QtCore:
+    QAbstractTableModel = object
+    QModelIndex = object
+
+    class Qt:
+        DisplayRole = 0
+        AscendingOrder = 0
+
+class QtWidgets:
+    QDialog = object
+
+def stub_pymol():
+    pymol = types.ModuleType('pymol')
+    pymol.__path__ = []
+    pymol.cmd = mock.MagicMock()
+    qt = types.ModuleType('pymol.Qt')
+    qt.QtCore = QtCore
+    qt.QtWidgets = QtWidgets
+    cgo = types.ModuleType('pymol.cgo')
+    vfont = types.ModuleType('pymol.vfont')
+    vfont.plain = {}
+    modules = {'pymol': pymol, 'pymol.Qt': qt, 'pymol.cgo': cgo, 'pymol.vfont': vfont}
+    for name, module in modules.items():
+        sys.modules.setdefault(name, module)
+
+@pytest.fixture(scope='session')
+def smina():
+    stub_pymol()
+    filename = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '__init__.py')
+    spec = importlib.util.spec_from_file_location('smina_plugin', filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
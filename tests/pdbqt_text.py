@@ -0,0 +1,17 @@
+# smina output written by the tests
+
+def atom(serial, x, y, z, atom_type='C'):
+    return "ATOM  %5d  C   LIG A   1    %8.3f%8.3f%8.3f  0.00  0.00     0.000 %-2s\n" % (serial, x, y, z, atom_type)
+
+def docked_pose(model, affinity, shift, atoms=3):
+    lines = ["MODEL %s\n" % model, "REMARK minimizedAffinity %s\n" % affinity]
+    lines += [atom(i+1, shift+i, shift, -shift, 'HD' if i == atoms-1 else 'C') for i in range(atoms)]
+    return ''.join(lines+["TORSDOF 2\n", "ENDMDL\n"])
+
+def docked_text(poses):
+    return ''.join(docked_pose(model, affinity, float(model)) for model, affinity in poses)
+
+def smina_table(affinities):
+    lines = ["mode |   affinity | dist from best mode\n", "     | (kcal/mol) | rmsd l.b.| rmsd u.b.\n", "-----+------------+----------+----------\n"]
+    lines += ["%d       %.1f      0.000      0.000\n" % (i+1, affinity) for i, affinity in enumerate(affinities)]
+    return ''.join(lines)
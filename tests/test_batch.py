@@ -0,0 +1,63 @@
+import os
+import types
+
+from pdbqt_text import atom, docked_pose, docked_text, smina_table
+
+def part_job(tmp_path, name):
+    return types.SimpleNamespace(outfile=str(tmp_path/(name+"_docked.pdbqt")), logfile="", output="", returncode=None)
+
+def test_split_batch_round_trip(smina, tmp_path):
+    ligands = {'a': [(1, -7.0), (2, -6.0)], 'b': [(1, -9.0)], 'c': [(1, -5.5), (2, -5.0), (3, -4.5)]}
+    parts = [part_job(tmp_path, name) for name in ligands]
+    job = types.SimpleNamespace(outfile=str(tmp_path/"batch_docked.pdbqt"), parts=parts, returncode=0,
+        output=''.join("Refine time 0.1\n"+smina_table([affinity for model, affinity in poses]) for poses in ligands.values()))
+    with open(job.outfile, 'w') as f:
+        f.write(''.join(docked_text(poses) for poses in ligands.values()))
+    assert smina.split_batch(job) == True
+    for part, poses in zip(parts, ligands.values()):
+        assert open(part.outfile).read() == docked_text(poses)
+        assert part.returncode == 0
+        assert part.output.count('Refine time') == 1
+        assert smina.read_smina_table(part.output)[1][0] == poses[0][1]
+
+def test_split_batch_mismatch(smina, tmp_path):
+    parts = [part_job(tmp_path, name) for name in "ab"]
+    job = types.SimpleNamespace(outfile=str(tmp_path/"batch_docked.pdbqt"), parts=parts, returncode=0, output="")
+    with open(job.outfile, 'w') as f:
+        f.write(docked_text([(1, -7.0), (2, -6.0)])) # poses of one ligand only
+    assert smina.split_batch(job) == False
+    assert not any(os.path.isfile(part.outfile) for part in parts)
+
+def test_split_smina_output(smina):
+    output = "Using random seed: 1\n"+smina_table([-7.0, -6.0])+"Refine time 0.1\n"+smina_table([-9.0])+"Loop time 0.2\n"
+    parts = smina.split_smina_output(output)
+    assert len(parts) == 2
+    assert ''.join(parts) == output
+    assert parts[1].endswith("Loop time 0.2\n")
+
+def test_split_poses_round_trip(smina, tmp_path):
+    poses = [docked_pose(1, -7.0, 1.0), docked_pose(1, -6.5, 2.0), docked_pose(1, -6.0, 3.0)]
+    parts = [part_job(tmp_path, "pose%s_lig" % i) for i in range(len(poses))]
+    job = types.SimpleNamespace(outfile=str(tmp_path/"poses_minimized.pdbqt"), parts=parts, returncode=0)
+    with open(job.outfile, 'w') as f:
+        f.write(''.join(pose.replace("MODEL 1", "MODEL %s" % (i+1)) for i, pose in enumerate(poses)))
+    assert smina.split_poses(job) == True
+    assert [open(part.outfile).read() for part in parts] == poses
+    assert smina.parse_pdbqt(parts[1].outfile).affinities.tolist() == [-6.5]
+
+def test_split_poses_without_model_records(smina, tmp_path):
+    poses = [atom(1, 0.0, 0.0, float(i))+"TORSDOF 1\n" for i in range(2)]
+    parts = [part_job(tmp_path, "pose%s_lig" % i) for i in range(len(poses))]
+    job = types.SimpleNamespace(outfile=str(tmp_path/"poses_scored.pdbqt"), parts=parts, returncode=0)
+    with open(job.outfile, 'w') as f:
+        f.write(''.join(poses))
+    assert smina.split_poses(job) == True
+    assert [open(part.outfile).read() for part in parts] == poses
+
+def test_split_poses_incomplete(smina, tmp_path):
+    parts = [part_job(tmp_path, "pose%s_lig" % i) for i in range(2)]
+    job = types.SimpleNamespace(outfile=str(tmp_path/"poses_minimized.pdbqt"), parts=parts, returncode=0)
+    with open(job.outfile, 'w') as f:
+        f.write(docked_pose(1, -7.0, 1.0)+"MODEL 2\n")
+    assert smina.split_poses(job) == False
+    assert not any(os.path.isfile(part.outfile) for part in parts)
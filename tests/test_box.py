@@ -0,0 +1,22 @@
+import time
+
+import numpy as np
+
+def test_residue_selection(smina):
+    assert smina.residue_selection("ARG12,TYR7") == "resi 12+7"
+    assert smina.residue_selection("ARG 12, TYR-7A,") == "resi 12+-7A"
+    assert smina.residue_selection("45") == "resi 45"
+    assert smina.residue_selection("chain A and resi 12") is None
+    assert smina.residue_selection("ARG12,,TYR7") is None
+
+def test_residue_selection_with_a_typo_returns_quickly(smina):
+    typos = ["1"*24+"!", "ARG1234,TYR7345,LYS4556,GLU1009,ASP2001,HIS3003,SER4004,THR5005,LYS6006,GLY7007;", "A"*5000+"1"*5000+"?"]
+    start = time.time()
+    for site in typos:
+        assert smina.residue_selection(site) is None
+    assert time.time()-start < 1.0
+
+def test_fit_box(smina):
+    center, size = smina.fit_box(np.array([[0.0, 0.0, 0.0], [2.0, 4.0, 6.0]]), 1.0)
+    assert list(center) == [1.0, 2.0, 3.0]
+    assert list(size) == [4.0, 6.0, 8.0]
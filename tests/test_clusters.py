@@ -0,0 +1,18 @@
+import numpy as np
+
+def test_cluster_poses(smina):
+    rng = np.random.RandomState(2)
+    ligand = rng.uniform(-3, 3, (10, 3))
+    coords = np.array([ligand+rng.normal(0, 0.1, ligand.shape)+shift for shift in (0, 0, 8, 0, 8, 20)])
+    affinities = np.array([-7.0, -8.0, -6.5, float('nan'), -7.5, -5.0])
+    clusters, representatives = smina.cluster_poses(coords, affinities)
+    assert representatives == [1, 4, 5] # best pose of each site first
+    assert clusters.tolist() == [0, 0, 1, 0, 1, 2]
+    clusters, representatives = smina.cluster_poses(coords, affinities, cutoff=0.0)
+    assert sorted(representatives) == list(range(6))
+    assert representatives[-1] == 3 # no affinity
+
+def test_pose_rmsd_matrix(smina):
+    coords = np.array([[[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]], [[0.0, 3.0, 4.0], [1.0, 0.0, 0.0]]])
+    rmsd = smina.pose_rmsd_matrix(coords)
+    np.testing.assert_allclose(rmsd, [[0.0, np.sqrt(12.5)], [np.sqrt(12.5), 0.0]], atol=1e-12)
@@ -0,0 +1,41 @@
+import pytest
+
+from pdbqt_text import atom, docked_text
+
+def test_parse_pdbqt(smina, tmp_path):
+    filename = tmp_path/"lig_docked.pdbqt"
+    filename.write_text(docked_text([(1, -7.5), (2, -6.25), (3, -5.0)]))
+    for block_atoms in (65536, 2): # coordinates converted in one block or several
+        result = smina.parse_pdbqt(str(filename), block_atoms)
+        assert result.models == [1, 2, 3]
+        assert result.affinities.tolist() == [-7.5, -6.25, -5.0]
+        assert result.torsdof == [2, 2, 2]
+        assert result.atom_types == ['C', 'C', 'HD']
+        assert result.heavy_atoms().tolist() == [True, True, False]
+        assert result.coordinate_array().shape == (3, 3, 3)
+        assert result.model_coordinates(1).tolist() == [[2.0, 2.0, -2.0], [3.0, 2.0, -2.0], [4.0, 2.0, -2.0]]
+
+def test_parse_pdbqt_without_model_records(smina, tmp_path):
+    filename = tmp_path/"lig.pdbqt"
+    filename.write_text("REMARK VINA RESULT:    -8.1      1.500      2.500\n"+atom(1, 1.0, 2.0, 3.0)+"TORSDOF 0\n")
+    result = smina.parse_pdbqt(str(filename))
+    assert result.models == [1]
+    assert result.affinities.tolist() == [-8.1]
+    assert result.remarks[0]['rmsd_lb'] == '1.500'
+
+def test_parse_pdbqt_truncated(smina, tmp_path):
+    filename = tmp_path/"lig_docked.pdbqt"
+    filename.write_text(docked_text([(1, -7.5)])[:-60])
+    with pytest.raises(ValueError):
+        smina.parse_pdbqt(str(filename))
+
+def test_combine_flexres(smina, tmp_path):
+    filename = tmp_path/"lig_flexout.pdbqt"
+    blocks = []
+    for model in (1, 2):
+        for residue in ("TYR", "ARG"): # one MODEL block per residue, same MODEL line for a pose
+            blocks.append("MODEL %s\nBEGIN_RES %s A %s\nEND_RES %s A %s\nENDMDL\n" % (model, residue, model, residue, model))
+    filename.write_text(''.join(blocks))
+    models = list(smina.combine_flexres(str(filename)))
+    assert [model for model, records in models] == [1, 2]
+    assert models[1][1] == "BEGIN_RES TYR A 2\nEND_RES TYR A 2\nBEGIN_RES ARG A 2\nEND_RES ARG A 2\n"
@@ -0,0 +1,30 @@
+import numpy as np
+
+def hollow_sphere(center, radius=8.0, rings=30, points=60):
+    theta = np.linspace(0, np.pi, rings)[:, None]
+    phi = np.linspace(0, 2*np.pi, points, endpoint=False)[None, :]
+    shell = np.stack([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)*np.ones_like(phi)], axis=-1)
+    return np.asarray(center)+radius*shell.reshape(-1, 3)
+
+def test_find_pockets_in_a_cavity(smina):
+    center = np.array([10.0, -4.0, 3.0])
+    pockets = smina.find_pockets(hollow_sphere(center))
+    assert len(pockets) == 1
+    points, depths = pockets[0]
+    assert np.linalg.norm(points.mean(axis=0)-center) < 1.0
+    assert np.all(np.linalg.norm(points-center, axis=1) < 8.0-1.8+1.0) # inside the shell, off the atoms
+    assert depths.min() >= 6
+    center, size = smina.fit_box(points, 4.0)
+    assert np.all(np.array(size) < 2*8.0+8.0)
+
+def test_find_pockets_largest_first(smina):
+    small = hollow_sphere([30.0, 0.0, 0.0], radius=6.0)
+    large = hollow_sphere([0.0, 0.0, 0.0])
+    pockets = smina.find_pockets(np.concatenate([small, large]))
+    assert len(pockets) == 2
+    assert len(pockets[0][0]) > len(pockets[1][0])
+    assert np.linalg.norm(pockets[0][0].mean(axis=0)) < 1.0
+
+def test_find_pockets_without_cavity(smina):
+    x, y, z = np.meshgrid(np.arange(5.0), np.arange(5.0), np.arange(5.0)) # filled cube
+    assert smina.find_pockets(np.stack([x, y, z], axis=-1)*1.5) == []
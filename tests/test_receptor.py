@@ -0,0 +1,41 @@
+import os
+import sys
+
+def fake_openbabel(tmp_path): # writes the -O file like openbabel
+    script = tmp_path/"obabel"
+    script.write_text("#!%s\nimport sys\nopen(sys.argv[sys.argv.index('-O')+1], 'w').write('ATOM\\n')\n" % sys.executable)
+    script.chmod(0o755)
+    return str(script)
+
+def test_receptor_job_in_the_background(smina, tmp_path):
+    pipeline = smina.SminaPipeline(openbabel_exe=fake_openbabel(tmp_path), executor='native', workdir=str(tmp_path))
+    pipeline.receptor_cache = smina.ReceptorCache(str(tmp_path/"cache"))
+    pipeline.report = lambda message: None
+    pdb_file = str(tmp_path/"prot.pdb")
+    with open(pdb_file, 'w') as f:
+        f.write("ATOM\n")
+    job = pipeline.receptor_job(pdb_file)
+    receptor = pipeline.receptor_file(pdb_file)
+    assert job.outfile == receptor and not os.path.isfile(receptor)
+    scheduler = smina.SminaScheduler(1)
+    scheduler.submit(job)
+    finished = scheduler.finished_jobs(block=True, timeout=20)
+    scheduler.shutdown()
+    job.collect(finished[0])
+    assert os.path.isfile(receptor)
+    assert pipeline.receptor_job(pdb_file) is None # up to date
+    os.remove(receptor)
+    assert pipeline.receptor_job(pdb_file) is None # copied from the cache
+    assert os.path.isfile(receptor)
+    with open(pdb_file, 'a') as f:
+        f.write("ATOM\n")
+    assert pipeline.receptor_job(pdb_file) is not None # structure changed
+    assert not os.path.isfile(receptor)
+
+def test_prepare_receptor_waits_for_openbabel(smina, tmp_path):
+    pipeline = smina.SminaPipeline(openbabel_exe=fake_openbabel(tmp_path), executor='native', workdir=str(tmp_path))
+    pipeline.report = lambda message: None
+    pdb_file = str(tmp_path/"prot.pdb")
+    with open(pdb_file, 'w') as f:
+        f.write("ATOM\n")
+    assert os.path.isfile(pipeline.prepare_receptor(pdb_file))
@@ -0,0 +1,42 @@
+import pytest
+
+@pytest.fixture
+def store(smina, tmp_path):
+    store = smina.ResultsStore(str(tmp_path/"smina_results.db"))
+    poses = []
+    for i in range(600):
+        rmsd = float(i % 7) if i % 3 else None
+        poses.append((i % 9+1, -5.0-(i*37 % 600)/100.0, rmsd, rmsd, None))
+    store.add_poses("lig", "prot", "hash", "lig_docked.pdbqt", poses)
+    ids = [row[0] for row in store.connection.execute('SELECT id FROM poses ORDER BY id')]
+    rescored = [(-3.0-(i*13 % 300)/50.0, pose) for i, pose in enumerate(ids) if i % 2 == 0] # half of them rescored
+    with store.connection:
+        store.connection.executemany('UPDATE poses SET rescored = ? WHERE id = ?', rescored)
+    yield store
+    store.close()
+
+def page_through(store, order, descending, size=64):
+    rows = []
+    after = None
+    while True:
+        page = store.poses(size, len(rows), order, descending, after)
+        rows.extend(page)
+        if len(page) < size:
+            return rows
+        after = (page[-1][store.columns.index(order)], page[-1][-1])
+
+@pytest.mark.parametrize('order', ['rescored', 'rmsd_lb', 'affinity'])
+@pytest.mark.parametrize('descending', [False, True])
+def test_keyset_paging_reaches_every_pose(store, order, descending):
+    rows = page_through(store, order, descending)
+    assert len(rows) == 600
+    assert len(set(row[-1] for row in rows)) == 600
+    values = [row[store.columns.index(order)] for row in rows]
+    known = [value for value in values if value is not None]
+    assert values[:len(known)] == known # poses without a value come last
+    assert known == sorted(known, reverse=descending)
+
+def test_keyset_paging_matches_offset_paging(store):
+    for descending in (False, True):
+        rows = page_through(store, 'rescored', descending)
+        assert rows == store.poses(1000, 0, 'rescored', descending)
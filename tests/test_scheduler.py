@@ -0,0 +1,30 @@
+import subprocess
+import sys
+import time
+
+def test_job_that_cannot_start(smina, tmp_path):
+    scheduler = smina.SminaScheduler(2)
+    job = smina.SminaJob("lig", [str(tmp_path/"no_smina"), "--help"], str(tmp_path/"lig_docked.pdbqt"))
+    scheduler.submit(job)
+    finished = scheduler.finished_jobs(block=True, timeout=10)
+    scheduler.shutdown()
+    assert finished == [job]
+    assert job.returncode is None
+    assert job.output.startswith("could not start "+str(tmp_path/"no_smina"))
+    assert smina.failure_reason(job) == job.output
+
+def test_cancel_while_a_process_starts(smina, tmp_path, monkeypatch):
+    scheduler = smina.SminaScheduler(1)
+    popen = subprocess.Popen
+    def cancel_then_start(*args, **kwargs): # cancel() runs before the process is listed
+        scheduler.cancel()
+        return popen(*args, **kwargs)
+    monkeypatch.setattr(smina.subprocess, 'Popen', cancel_then_start)
+    job = smina.SminaJob("lig", [sys.executable, "-c", "import time; time.sleep(30)"], str(tmp_path/"lig_docked.pdbqt"))
+    start = time.time()
+    scheduler.submit(job)
+    finished = scheduler.finished_jobs(block=True, timeout=20)
+    scheduler.shutdown()
+    assert finished == [job]
+    assert job.cancelled
+    assert time.time()-start < 10
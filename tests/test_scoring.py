@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+vina = [(-0.035579, 'gauss(o=0,_w=0.5,_c=8)'), (-0.005156, 'gauss(o=3,_w=2,_c=8)'), (0.840245, 'repulsion(o=0,_c=8)'),
+    (-0.035069, 'hydrophobic(g=0.5,_b=1.5,_c=8)'), (-0.587439, 'non_dir_h_bond(g=-0.7,_b=0,_c=8)'), (1.923, 'num_tors_div')]
+
+def test_reweight_terms_num_tors_div(smina):
+    term_names = [term for weight, term in vina]
+    rng = np.random.RandomState(1)
+    values = rng.uniform(0, 50, (6, len(term_names)))
+    values[:, -1] = 0 # conformation independent, no per pose value
+    num_tors = np.array([0, 1, 3, 5, 8, 12])
+    affinities = smina.reweight_terms(vina, term_names, values, num_tors)
+    for pose, row in enumerate(values): # smina : weighted sum / (1+w*num_tors/5), w = 0.1*(weight+1)
+        total = sum(weight*value for (weight, term), value in zip(vina[:-1], row))
+        assert affinities[pose] == pytest.approx(total/(1+0.1*(1.923+1)*num_tors[pose]/5))
+    # vina 1.1 : e/(1+0.0585*Nrot), rounded
+    assert affinities[4] == pytest.approx(values[4, :-1].dot([w for w, t in vina[:-1]])/(1+0.0585*8), rel=1e-3)
+
+def test_reweight_terms_without_num_tors_div(smina):
+    term_names = [term for weight, term in vina]
+    values = np.ones((2, len(term_names)))
+    affinities = smina.reweight_terms(vina[:2], term_names, values, np.array([4, 4]))
+    assert affinities.tolist() == pytest.approx([-0.040735, -0.040735])
+
+def test_reweight_terms_errors(smina):
+    term_names = [term for weight, term in vina[:-1]]
+    with pytest.raises(ValueError):
+        smina.reweight_terms(vina, term_names, np.ones((1, len(term_names))), np.array([1])) # no cached num_tors_div
+    with pytest.raises(ValueError):
+        smina.reweight_terms([(1.0, 'num_heavy_atoms')], ['num_heavy_atoms'], np.ones((1, 1)), np.array([1]))
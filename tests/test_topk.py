@@ -0,0 +1,31 @@
+def test_push_replaces_the_score_of_a_key(smina):
+    top = smina.TopK(2)
+    assert top.push('a', -5) == []
+    assert top.push('b', -6) == []
+    assert top.push('a', -3) == []
+    assert top.best() == [(-6, 'b'), (-3, 'a')]
+    assert top.push('a', -7) == []
+    assert top.best() == [(-7, 'a'), (-6, 'b')]
+
+def test_push_keeps_the_k_best(smina):
+    top = smina.TopK(2)
+    top.push('a', -5)
+    top.push('b', -6)
+    assert top.push('c', -4) == ['c']
+    assert top.push('c', -8) == ['a']
+    assert top.push('c', -1) == [] # a was dropped already, c keeps its place
+    assert top.best() == [(-6, 'b'), (-1, 'c')]
+    assert top.push('d', float('nan')) == ['d']
+
+def test_leaderboard_keeps_the_best_receptor(smina):
+    class Job:
+        def __init__(self, receptor):
+            self.name = 'lig'
+            self.receptor = receptor
+            self.outfile = 'lig_%s_docked.pdbqt' % receptor
+    board = smina.Leaderboard(3)
+    board.add_poses(Job('r1'), [(1, -8.0, 0.0, 0.0, None), (2, -7.0, 1.0, 2.0, None)])
+    board.add_poses(Job('r2'), [(1, -6.0, 0.0, 0.0, None)])
+    assert board.rows() == [('lig', -8.0, 'r1', 1, 'lig_r1_docked.pdbqt')]
+    board.add_poses(Job('r3'), [(1, -9.0, 0.0, 0.0, None)])
+    assert board.rows() == [('lig', -9.0, 'r3', 1, 'lig_r3_docked.pdbqt')]